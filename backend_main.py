@@ -1,36 +1,76 @@
 """
 LucyGenX Backend v2.0 - Трансформация видео в образовательный контент
-- Анализ и удаление "воды" из видео (30% сокращение)
+- Анализ и удаление "воды" из видео (дедупликация сцен + AI-оценка)
 - Генерация PDF-слайдов из ключевых фреймов
 - Создание нового видео из слайдов + AI озвучка
 - Генерация майндкарт, квизов и flashcards
 """
 
-from fastapi import FastAPI, UploadFile, File, HTTPException, BackgroundTasks
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request, Header, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
-from pydantic import BaseModel, HttpUrl
+from fastapi.responses import Response, JSONResponse, StreamingResponse
+from pydantic import BaseModel, HttpUrl, Field, ValidationError, field_validator, model_validator
 import os
 import uuid
 import subprocess
 import asyncio
-from typing import Optional, List, Dict
-import google.generativeai as genai
-from qdrant_client import QdrantClient
-from qdrant_client.models import Distance, VectorParams, PointStruct
-import cv2
-import numpy as np
+import re
+import tempfile
+import time
+import random
+import hashlib
+import shutil
+import threading
+import sqlite3
+import socket
+import itertools
+import dataclasses
+import sys
+import bisect
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FuturesTimeoutError
+from collections import deque, OrderedDict, Counter
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from functools import partial, lru_cache
+from types import SimpleNamespace
+from typing import TYPE_CHECKING, Optional, List, Dict, Iterator, AsyncIterator, Type
+import importlib
 from pathlib import Path
 import json
-from PIL import Image, ImageDraw, ImageFont
-from reportlab.lib.pagesizes import letter, A4
-from reportlab.pdfgen import canvas
-from reportlab.lib.utils import ImageReader
-from reportlab.lib import colors
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, PageBreak, Table, TableStyle
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import inch
 import io
+import fcntl
+import gzip
+import mimetypes
+from email.utils import formatdate, parsedate_to_datetime
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+if TYPE_CHECKING:
+    from qdrant_client import QdrantClient
+
+class LazyModule:
+    """Тяжёлый модуль импортируется при первом обращении к атрибуту, после чего
+    прокси в глобалах заменяется настоящим модулем (холодный старт serverless)"""
+    
+    def __init__(self, name: str, alias: str):
+        self._name = name
+        self._alias = alias
+    
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        globals()[self._alias] = module
+        return getattr(module, attr)
+
+cv2 = LazyModule("cv2", "cv2")
+np = LazyModule("numpy", "np")
+Image = LazyModule("PIL.Image", "Image")
+ImageDraw = LazyModule("PIL.ImageDraw", "ImageDraw")
+ImageFont = LazyModule("PIL.ImageFont", "ImageFont")
+qmodels = LazyModule("qdrant_client.models", "qmodels")
 
 app = FastAPI(title="LucyGenX API v2.0")
 UPLOAD_DIR = Path("uploads")
@@ -49,18 +89,97 @@ app.add_middleware(
 )
 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "your_api_key_here")
-genai.configure(api_key=GEMINI_API_KEY)
 
-qdrant = QdrantClient(path="./qdrant_storage")
-COLLECTION_NAME = "educational_frames"
+@lru_cache(maxsize=1)
+def get_genai():
+    """google.generativeai импортируется и настраивается при первом обращении к Gemini"""
+    import google.generativeai as genai
+    genai.configure(api_key=GEMINI_API_KEY)
+    return genai
 
-try:
-    qdrant.create_collection(
-        collection_name=COLLECTION_NAME,
-        vectors_config=VectorParams(size=768, distance=Distance.COSINE)
-    )
-except Exception:
-    pass
+# === ВЕКТОРНОЕ ХРАНИЛИЩЕ ===
+
+# Встроенный режим (QDRANT_PATH) — только один процесс. Для нескольких воркеров/узлов
+# нужен сервер: QDRANT_URL=http://localhost:6333 (локально: docker run -p 6333:6333 -p 6334:6334 qdrant/qdrant)
+QDRANT_URL = os.getenv("QDRANT_URL")
+QDRANT_PATH = os.getenv("QDRANT_PATH", "./qdrant_storage")
+QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")
+QDRANT_PREFER_GRPC = os.getenv("QDRANT_PREFER_GRPC", "1") == "1"
+QDRANT_GRPC_PORT = int(os.getenv("QDRANT_GRPC_PORT", "6334"))
+QDRANT_QUANTIZATION = os.getenv("QDRANT_QUANTIZATION", "none")  # none | scalar | product
+QDRANT_ON_DISK = os.getenv("QDRANT_ON_DISK", "0") == "1"  # оригиналы на диске, в RAM — квантованные
+QDRANT_HNSW_M = int(os.getenv("QDRANT_HNSW_M", "16"))
+QDRANT_HNSW_EF_CONSTRUCT = int(os.getenv("QDRANT_HNSW_EF_CONSTRUCT", "100"))
+QDRANT_SEARCH_EF = int(os.getenv("QDRANT_SEARCH_EF", "128"))
+QDRANT_RESCORE_OVERSAMPLING = float(os.getenv("QDRANT_RESCORE_OVERSAMPLING", "2.0"))
+COLLECTION_NAME = os.getenv("QDRANT_COLLECTION", "educational_frames")
+VECTOR_SIZE = 768
+PAYLOAD_INDEXES = ("task_id", "topic")
+
+def create_qdrant_client() -> "QdrantClient":
+    from qdrant_client import QdrantClient
+    if QDRANT_URL:
+        return QdrantClient(
+            url=QDRANT_URL,
+            api_key=QDRANT_API_KEY,
+            prefer_grpc=QDRANT_PREFER_GRPC,
+            grpc_port=QDRANT_GRPC_PORT
+        )
+    return QdrantClient(path=QDRANT_PATH)
+
+def qdrant_quantization_config():
+    if QDRANT_QUANTIZATION == "scalar":
+        return qmodels.ScalarQuantization(scalar=qmodels.ScalarQuantizationConfig(
+            type=qmodels.ScalarType.INT8, quantile=0.99, always_ram=True
+        ))
+    if QDRANT_QUANTIZATION == "product":
+        return qmodels.ProductQuantization(product=qmodels.ProductQuantizationConfig(
+            compression=qmodels.CompressionRatio.X16, always_ram=True
+        ))
+    return None
+
+def qdrant_search_params() -> "qmodels.SearchParams":
+    """hnsw_ef и пересчёт по оригинальным векторам поверх квантованного кандидат-листа"""
+    quantization = None
+    if QDRANT_QUANTIZATION in ("scalar", "product"):
+        quantization = qmodels.QuantizationSearchParams(rescore=True, oversampling=QDRANT_RESCORE_OVERSAMPLING)
+    return qmodels.SearchParams(hnsw_ef=QDRANT_SEARCH_EF, quantization=quantization)
+
+def ensure_collection(client: "QdrantClient"):
+    """Создать коллекцию с настройками HNSW/квантования и payload-индексами, если её нет"""
+    try:
+        client.get_collection(COLLECTION_NAME)
+    except Exception:
+        client.create_collection(
+            collection_name=COLLECTION_NAME,
+            vectors_config=qmodels.VectorParams(
+                size=VECTOR_SIZE, distance=qmodels.Distance.COSINE, on_disk=QDRANT_ON_DISK
+            ),
+            hnsw_config=qmodels.HnswConfigDiff(m=QDRANT_HNSW_M, ef_construct=QDRANT_HNSW_EF_CONSTRUCT),
+            quantization_config=qdrant_quantization_config()
+        )
+    if not QDRANT_URL:
+        return  # встроенный режим payload-индексы не поддерживает
+    for field in PAYLOAD_INDEXES:
+        try:
+            client.create_payload_index(
+                COLLECTION_NAME, field_name=field, field_schema=qmodels.PayloadSchemaType.KEYWORD
+            )
+        except Exception as e:
+            print(f"Payload index {field} not created: {e}")
+
+_qdrant: Optional["QdrantClient"] = None
+_qdrant_lock = threading.Lock()
+
+def get_qdrant() -> "QdrantClient":
+    """Клиент Qdrant создаётся при первом обращении (встроенное хранилище открывается один раз)"""
+    global _qdrant
+    with _qdrant_lock:
+        if _qdrant is None:
+            client = create_qdrant_client()
+            ensure_collection(client)
+            _qdrant = client
+    return _qdrant
 
 class VideoRequest(BaseModel):
     url: Optional[HttpUrl] = None
@@ -72,90 +191,2232 @@ class ProcessingResult(BaseModel):
     current_step: str
     frames_extracted: int
     water_removed_percent: float
+    frames_deduplicated: int = 0
     new_video_url: Optional[str] = None
     pdf_url: Optional[str] = None
     mindmap_url: Optional[str] = None
     quiz_data: Optional[Dict] = None
     flashcards: Optional[List[Dict]] = None
 
-tasks_status = {}
+# === ХРАНИЛИЩЕ ЗАДАЧ ===
 
-# === AI АНАЛИЗ И УДАЛЕНИЕ "ВОДЫ" ===
+TASK_STORE = os.getenv("TASK_STORE", "sqlite")  # memory | sqlite | redis
+TASK_STORE_PATH = os.getenv("TASK_STORE_PATH", "tasks.db")
+TASK_STORE_URL = os.getenv("TASK_STORE_URL", "redis://localhost:6379/0")
+TASK_TTL = int(os.getenv("TASK_TTL", str(7 * 24 * 3600)))  # хранение завершённых задач, сек
+TASK_ORPHAN_TIMEOUT = int(os.getenv("TASK_ORPHAN_TIMEOUT", "3600"))  # без heartbeat -> сирота
+TASK_HEARTBEAT_INTERVAL = float(os.getenv("TASK_HEARTBEAT_INTERVAL", "60"))  # владелец продлевает свои задачи
+FINISHED_STATUSES = {"completed", "failed", "cancelled"}
+# Нонс запуска отличает перезапущенный процесс с тем же PID (uvicorn как PID 1 в контейнере)
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
 
-async def analyze_video_content(video_path: Path) -> Dict:
-    """Полный AI-анализ видео для определения ключевых моментов"""
-    cap = cv2.VideoCapture(str(video_path))
-    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    fps = cap.get(cv2.CAP_PROP_FPS)
-    duration = total_frames / fps
+class TaskStore:
+    """Хранилище статусов задач, общее для всех воркеров"""
     
-    # Извлекаем фреймы каждые N секунд для анализа
-    sample_interval = 5  # каждые 5 секунд
-    sample_frames = []
+    def get(self, task_id: str) -> Optional[Dict]:
+        raise NotImplementedError
     
-    for i in range(0, int(duration), sample_interval):
-        cap.set(cv2.CAP_PROP_POS_FRAMES, int(i * fps))
-        ret, frame = cap.read()
-        if ret:
-            sample_frames.append((i, frame))
+    def set(self, task_id: str, state: Dict):
+        """Полная замена состояния задачи"""
+        raise NotImplementedError
     
-    cap.release()
+    def update(self, task_id: str, fields: Dict):
+        """Атомарное слияние полей в состояние задачи"""
+        raise NotImplementedError
     
-    # Анализируем каждый фрейм через Gemini
-    key_moments = []
-    model = genai.GenerativeModel('gemini-2.0-flash-exp')
+    def delete(self, task_id: str):
+        raise NotImplementedError
+    
+    def active_tasks(self) -> List:
+        """[(task_id, status, worker_id, updated_at)] незавершённых задач"""
+        raise NotImplementedError
+    
+    def touch(self, task_ids: List[str]):
+        """Heartbeat владельца: обновить worker_id/updated_at, не меняя состояние"""
+        raise NotImplementedError
+    
+    def purge_expired(self) -> int:
+        return 0
+    
+    def recover_orphans(self) -> int:
+        """Пометить как failed задачи, чей воркер умер (тот же узел — по PID)
+        или перестал слать heartbeat (любой узел: PID мог достаться другому процессу)"""
+        host = socket.gethostname()
+        own_pid = str(os.getpid())
+        now = time.time()
+        recovered = 0
+        for task_id, status, worker_id, updated_at in self.active_tasks():
+            if worker_id == WORKER_ID:
+                continue
+            worker_host, _, worker_pid = (worker_id or "").partition(":")
+            worker_pid = worker_pid.partition(":")[0]
+            orphaned = now - (updated_at or 0) > TASK_ORPHAN_TIMEOUT
+            if worker_host == host:
+                # Тот же PID с другим нонсом — наш прошлый запуск
+                orphaned = orphaned or worker_pid == own_pid or not pid_alive(worker_pid)
+            if orphaned:
+                self.update(task_id, {
+                    "status": "failed",
+                    "progress": 0,
+                    "current_step": "Ошибка",
+                    "error": "Обработка прервана: воркер завершился до окончания задачи"
+                })
+                recovered += 1
+        return recovered
+
+def pid_alive(pid: str) -> bool:
+    try:
+        os.kill(int(pid), 0)
+    except (ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def task_expires_at(state: Dict) -> Optional[float]:
+    return time.time() + TASK_TTL if state.get("status") in FINISHED_STATUSES else None
+
+class MemoryTaskStore(TaskStore):
+    """Словарь в памяти процесса (один воркер, без персистентности)"""
+    
+    def __init__(self):
+        self.tasks: Dict[str, Dict] = {}
+        self.meta: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+    
+    def get(self, task_id: str) -> Optional[Dict]:
+        with self._lock:
+            meta = self.meta.get(task_id)
+            if meta and meta["expires_at"] and meta["expires_at"] < time.time():
+                self.tasks.pop(task_id, None)
+                self.meta.pop(task_id, None)
+            state = self.tasks.get(task_id)
+            return dict(state) if state is not None else None
+    
+    def set(self, task_id: str, state: Dict):
+        with self._lock:
+            self.tasks[task_id] = dict(state)
+            self._touch(task_id)
+    
+    def update(self, task_id: str, fields: Dict):
+        with self._lock:
+            self.tasks.setdefault(task_id, {}).update(fields)
+            self._touch(task_id)
+    
+    def _touch(self, task_id: str):
+        self.meta[task_id] = {
+            "worker_id": WORKER_ID,
+            "updated_at": time.time(),
+            "expires_at": task_expires_at(self.tasks[task_id])
+        }
+    
+    def touch(self, task_ids: List[str]):
+        with self._lock:
+            for task_id in task_ids:
+                if task_id in self.meta:
+                    self.meta[task_id].update(worker_id=WORKER_ID, updated_at=time.time())
+    
+    def delete(self, task_id: str):
+        with self._lock:
+            self.tasks.pop(task_id, None)
+            self.meta.pop(task_id, None)
+    
+    def active_tasks(self) -> List:
+        with self._lock:
+            return [
+                (task_id, state.get("status"), self.meta[task_id]["worker_id"], self.meta[task_id]["updated_at"])
+                for task_id, state in self.tasks.items()
+                if state.get("status") not in FINISHED_STATUSES
+            ]
+    
+    def purge_expired(self) -> int:
+        now = time.time()
+        with self._lock:
+            expired = [t for t, m in self.meta.items() if m["expires_at"] and m["expires_at"] < now]
+            for task_id in expired:
+                self.tasks.pop(task_id, None)
+                self.meta.pop(task_id, None)
+        return len(expired)
+
+class SQLiteTaskStore(TaskStore):
+    """SQLite в режиме WAL: общий файл для всех воркеров на одном узле, переживает рестарт"""
+    
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS tasks (
+                    task_id TEXT PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    status TEXT,
+                    worker_id TEXT,
+                    updated_at REAL,
+                    expires_at REAL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS tasks_status_idx ON tasks (status)")
+            conn.execute("CREATE INDEX IF NOT EXISTS tasks_expires_idx ON tasks (expires_at)")
+    
+    def _conn(self) -> sqlite3.Connection:
+        # Соединение на поток: sqlite3 не разрешает делить его между потоками
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+    
+    def get(self, task_id: str) -> Optional[Dict]:
+        row = self._conn().execute(
+            "SELECT state FROM tasks WHERE task_id = ? AND (expires_at IS NULL OR expires_at >= ?)",
+            (task_id, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def _write(self, conn: sqlite3.Connection, task_id: str, state: Dict):
+        conn.execute(
+            "INSERT OR REPLACE INTO tasks (task_id, state, status, worker_id, updated_at, expires_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (task_id, json.dumps(state, ensure_ascii=False), state.get("status"),
+             WORKER_ID, time.time(), task_expires_at(state))
+        )
     
-    for timestamp, frame in sample_frames[:15]:  # Лимит для MVP
-        _, buffer = cv2.imencode('.jpg', frame)
-        image_data = buffer.tobytes()
+    def set(self, task_id: str, state: Dict):
+        self._write(self._conn(), task_id, state)
+    
+    def update(self, task_id: str, fields: Dict):
+        conn = self._conn()
+        # BEGIN IMMEDIATE берёт write-lock сразу: чтение и запись без гонок между воркерами
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT state FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+            state = json.loads(row[0]) if row else {}
+            state.update(fields)
+            self._write(conn, task_id, state)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    
+    def touch(self, task_ids: List[str]):
+        now = time.time()
+        self._conn().executemany(
+            "UPDATE tasks SET worker_id = ?, updated_at = ? WHERE task_id = ?",
+            [(WORKER_ID, now, task_id) for task_id in task_ids]
+        )
+    
+    def delete(self, task_id: str):
+        self._conn().execute("DELETE FROM tasks WHERE task_id = ?", (task_id,))
+    
+    def active_tasks(self) -> List:
+        placeholders = ",".join("?" * len(FINISHED_STATUSES))
+        return self._conn().execute(
+            f"SELECT task_id, status, worker_id, updated_at FROM tasks "
+            f"WHERE status IS NULL OR status NOT IN ({placeholders})",
+            tuple(FINISHED_STATUSES)
+        ).fetchall()
+    
+    def purge_expired(self) -> int:
+        cursor = self._conn().execute("DELETE FROM tasks WHERE expires_at < ?", (time.time(),))
+        return cursor.rowcount
+
+class RedisTaskStore(TaskStore):
+    """Redis-совместимое хранилище (Redis/Valkey/KeyDB) для нескольких узлов.
+    Поля задачи лежат в hash по отдельности, поэтому update — один атомарный HSET."""
+    
+    META_FIELDS = ("_worker_id", "_updated_at")
+    
+    def __init__(self, client=None, url: str = TASK_STORE_URL, prefix: str = "lucygenx:task:"):
+        if client is None:
+            import redis  # опциональная зависимость, нужна только для TASK_STORE=redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+    
+    def _key(self, task_id: str) -> str:
+        return f"{self.prefix}{task_id}"
+    
+    def _decode(self, raw: Dict) -> Dict:
+        decoded = {}
+        for field, value in raw.items():
+            field = field.decode() if isinstance(field, bytes) else field
+            if field not in self.META_FIELDS:
+                decoded[field] = json.loads(value)
+        return decoded
+    
+    def get(self, task_id: str) -> Optional[Dict]:
+        raw = self.client.hgetall(self._key(task_id))
+        return self._decode(raw) if raw else None
+    
+    def _write(self, task_id: str, fields: Dict, replace: bool):
+        key = self._key(task_id)
+        mapping = {field: json.dumps(value, ensure_ascii=False) for field, value in fields.items()}
+        mapping["_worker_id"] = WORKER_ID
+        mapping["_updated_at"] = time.time()
+        pipe = self.client.pipeline(transaction=True)
+        if replace:
+            pipe.delete(key)
+        pipe.hset(key, mapping=mapping)
+        if fields.get("status") in FINISHED_STATUSES:
+            pipe.expire(key, TASK_TTL)
+        elif "status" in fields:
+            pipe.persist(key)
+        pipe.execute()
+    
+    def set(self, task_id: str, state: Dict):
+        self._write(task_id, state, replace=True)
+    
+    def update(self, task_id: str, fields: Dict):
+        self._write(task_id, fields, replace=False)
+    
+    def touch(self, task_ids: List[str]):
+        # HSET по истёкшему ключу создал бы пустую задачу — продлеваем только существующие
+        pipe = self.client.pipeline(transaction=False)
+        for task_id in task_ids:
+            pipe.exists(self._key(task_id))
+        existing = [task_id for task_id, exists in zip(task_ids, pipe.execute()) if exists]
+        pipe = self.client.pipeline(transaction=False)
+        for task_id in existing:
+            pipe.hset(self._key(task_id), mapping={"_worker_id": WORKER_ID, "_updated_at": time.time()})
+        pipe.execute()
+    
+    def delete(self, task_id: str):
+        self.client.delete(self._key(task_id))
+    
+    def active_tasks(self) -> List:
+        active = []
+        for key in self.client.scan_iter(match=f"{self.prefix}*"):
+            status, worker_id, updated_at = self.client.hmget(key, "status", "_worker_id", "_updated_at")
+            status = json.loads(status) if status else None
+            if status in FINISHED_STATUSES:
+                continue
+            key = key.decode() if isinstance(key, bytes) else key
+            active.append((
+                key[len(self.prefix):],
+                status,
+                worker_id.decode() if isinstance(worker_id, bytes) else worker_id,
+                float(updated_at) if updated_at else None
+            ))
+        return active
+
+def create_task_store(kind: str = TASK_STORE) -> TaskStore:
+    if kind == "memory":
+        return MemoryTaskStore()
+    if kind == "redis":
+        return RedisTaskStore()
+    return SQLiteTaskStore(TASK_STORE_PATH)
+
+task_store = create_task_store()
+
+async def purge_expired_tasks_loop(interval: float = 600):
+    while True:
+        try:
+            await asyncio.to_thread(task_store.purge_expired)
+            await asyncio.to_thread(purge_stale_uploads)
+        except Exception as e:
+            print(f"Task store purge error: {e}")
+        await asyncio.sleep(interval)
+
+# === СОБЫТИЯ ПРОГРЕССА ===
+
+EVENTS_POLL_INTERVAL = float(os.getenv("EVENTS_POLL_INTERVAL", "1.0"))  # опрос хранилища (задачи других воркеров)
+EVENTS_KEEPALIVE = 15.0
+HEAVY_STATUS_FIELDS = ("quiz_data", "flashcards")
+
+class TaskEvents:
+    """Pub/sub событий задач внутри процесса (SSE/WebSocket подписчики)"""
+    
+    def __init__(self):
+        self.subscribers: Dict[str, set] = {}
+    
+    def subscribe(self, task_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=256)
+        self.subscribers.setdefault(task_id, set()).add(queue)
+        return queue
+    
+    def unsubscribe(self, task_id: str, queue: asyncio.Queue):
+        queues = self.subscribers.get(task_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self.subscribers[task_id]
+    
+    def publish(self, task_id: str, event: str, data: Dict):
+        for queue in self.subscribers.get(task_id, ()):
+            try:
+                queue.put_nowait((event, data))
+            except asyncio.QueueFull:
+                pass  # медленный клиент догонит снимком статуса при следующем опросе
+
+task_events = TaskEvents()
+
+def status_etag(state: Dict) -> str:
+    payload = json.dumps(state, sort_keys=True, ensure_ascii=False, default=str)
+    return '"' + hashlib.sha1(payload.encode("utf-8")).hexdigest() + '"'
+
+def light_status(state: Dict) -> Dict:
+    """Статус без тяжёлых полей (квиз, флешкарты) — они приходят отдельными событиями"""
+    return {k: v for k, v in state.items() if k not in HEAVY_STATUS_FIELDS}
+
+# Запись в хранилище — вне event loop: SQLite BEGIN IMMEDIATE может ждать блокировку до 30 с
+
+async def report_progress(task_id: str, fields: Dict):
+    await asyncio.to_thread(task_store.update, task_id, fields)
+    task_events.publish(task_id, "progress", fields)
+
+async def report_artifact(task_id: str, name: str, fields: Dict):
+    """Артефакт готов: сразу виден в /status и уходит подписчикам, не дожидаясь конца пайплайна"""
+    await asyncio.to_thread(task_store.update, task_id, fields)
+    task_events.publish(task_id, "artifact", {"name": name, **fields})
+
+async def finish_task(task_id: str, state: Dict):
+    await asyncio.to_thread(task_store.set, task_id, state)
+    task_events.publish(task_id, "done", light_status(state))
+
+async def task_event_stream(task_id: str):
+    """(event, data): снимок статуса, затем события стадий до завершения задачи"""
+    queue = task_events.subscribe(task_id)
+    try:
+        state = await asyncio.to_thread(task_store.get, task_id)
+        if state is None:
+            yield "error", {"detail": "Task not found"}
+            return
+        last_etag = status_etag(state)
+        yield "status", light_status(state)
+        if state.get("status") in FINISHED_STATUSES:
+            yield "done", light_status(state)
+            return
         
-        prompt = """Проанализируй этот фрейм из образовательного видео.
-        Определи:
-        1. Это ключевой момент с важной информацией? (да/нет)
-        2. Краткое описание содержания (1 предложение)
-        3. Уровень важности (1-10)
+        idle = 0.0
+        while True:
+            try:
+                event, data = await asyncio.wait_for(queue.get(), timeout=EVENTS_POLL_INTERVAL)
+                idle = 0.0
+                yield event, data
+                if event == "done":
+                    return
+                continue
+            except asyncio.TimeoutError:
+                idle += EVENTS_POLL_INTERVAL
+            
+            # Задача может выполняться в другом воркере — подхватываем изменения из хранилища
+            state = await asyncio.to_thread(task_store.get, task_id)
+            if state is None:
+                yield "error", {"detail": "Task expired"}
+                return
+            etag = status_etag(state)
+            if etag != last_etag:
+                last_etag = etag
+                idle = 0.0
+                yield "status", light_status(state)
+            if state.get("status") in FINISHED_STATUSES:
+                yield "done", light_status(state)
+                return
+            if idle >= EVENTS_KEEPALIVE:
+                idle = 0.0
+                yield "keepalive", {}
+    finally:
+        task_events.unsubscribe(task_id, queue)
+
+# === МЕТРИКИ И ТРАССИРОВКА ===
+
+METRICS_PREFIX = "lucygenx"
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+TASK_TRACE = os.getenv("TASK_TRACE", "0") == "1"  # trace JSON (формат Chrome/Perfetto) на каждую задачу
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "0") == "1"  # GET /debug/profile
+PROFILER_INTERVAL = float(os.getenv("PROFILER_INTERVAL", "0.005"))
+PROFILER_MAX_SECONDS = 60
+
+METRIC_HELP = {
+    "stage_duration_seconds": "Wall time of an instrumented stage call",
+    "stage_cpu_seconds": "CPU time of a stage call (worker process or thread)",
+    "stage_queue_wait_seconds": "Time spent waiting for a stage slot or LLM rate limit",
+    "stage_bytes_total": "Bytes consumed and produced by stages",
+    "stage_errors_total": "Failed stage calls",
+    "pipeline_duration_seconds": "Wall time of a pipeline DAG stage per task",
+    "pipeline_errors_total": "Failed pipeline DAG stages",
+    "llm_retries_total": "Retried LLM calls",
+    "llm_tokens_total": "Prompt and output tokens reported by the LLM",
+    "llm_parse_failures_total": "LLM responses that failed JSON parsing or schema validation",
+    "llm_reasks_total": "Follow-up LLM requests for missing or invalid items",
+    "frame_analysis_requests_total": "Frame analysis LLM requests by mode (single/batch)",
+    "frame_analysis_frames_total": "Frames analyzed by the LLM by mode (single/batch)",
+    "frame_analysis_parse_failures_total": "Batch responses that could not be parsed",
+    "frame_analysis_fallback_frames_total": "Frames re-analyzed one by one after a failed batch",
+    "job_queue_wait_seconds": "Time a job spent in the processing queue",
+}
+
+# Задача, к которой относятся спаны; наследуется дочерними asyncio-задачами и to_thread
+current_task_id: ContextVar[Optional[str]] = ContextVar("current_task_id", default=None)
+
+class Histogram:
+    """Гистограмма с фиксированными бакетами (le), как в Prometheus"""
+    
+    def __init__(self, buckets: tuple = DURATION_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self, value: float):
+        self.sum += value
+        self.count += 1
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.counts):
+            self.counts[i] += 1
+
+def format_labels(labels) -> str:
+    if not labels:
+        return ""
+    escaped = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        escaped.append(f'{key}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+class MetricsRegistry:
+    """Счётчики и гистограммы с метками в памяти процесса; render() — текстовый формат Prometheus"""
+    
+    def __init__(self):
+        self.counters: Dict[str, Dict[tuple, float]] = {}
+        self.histograms: Dict[str, Dict[tuple, Histogram]] = {}
+        self._lock = threading.Lock()
+    
+    def inc(self, name: str, value: float = 1.0, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+    
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self.histograms.setdefault(name, {}).setdefault(key, Histogram()).observe(value)
+    
+    def render(self, extra: List[tuple] = ()) -> str:
+        """extra — [(имя, тип, help, {метки}, значение)] из снапшотов очереди/кэша/LLM"""
+        lines = []
+        
+        def header(name: str, kind: str, help_text: str):
+            lines.append(f"# HELP {METRICS_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {METRICS_PREFIX}_{name} {kind}")
         
-        Верни JSON:
-        {
+        with self._lock:
+            for name, series in sorted(self.counters.items()):
+                header(name, "counter", METRIC_HELP.get(name, name))
+                for labels, value in sorted(series.items()):
+                    lines.append(f"{METRICS_PREFIX}_{name}{format_labels(labels)} {value:g}")
+            for name, series in sorted(self.histograms.items()):
+                header(name, "histogram", METRIC_HELP.get(name, name))
+                for labels, hist in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(hist.buckets, hist.counts):
+                        cumulative += count
+                        bucket_labels = format_labels(labels + (("le", f"{bound:g}"),))
+                        lines.append(f"{METRICS_PREFIX}_{name}_bucket{bucket_labels} {cumulative}")
+                    lines.append(f"{METRICS_PREFIX}_{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {hist.count}")
+                    lines.append(f"{METRICS_PREFIX}_{name}_sum{format_labels(labels)} {hist.sum:.6f}")
+                    lines.append(f"{METRICS_PREFIX}_{name}_count{format_labels(labels)} {hist.count}")
+        
+        seen = set()
+        for name, kind, help_text, labels, value in extra:
+            if name not in seen:
+                header(name, kind, help_text)
+                seen.add(name)
+            lines.append(f"{METRICS_PREFIX}_{name}{format_labels(tuple(sorted(labels.items())))} {value:g}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+
+class TaskTracer:
+    """Спаны по задачам -> trace JSON (chrome://tracing, ui.perfetto.dev)"""
+    
+    def __init__(self):
+        self.spans: Dict[str, List[Dict]] = {}
+        self.lanes: Dict[str, int] = {}
+        self._lock = threading.Lock()
+    
+    def add(self, task_id: str, name: str, started_at: float, duration: float, args: Dict):
+        with self._lock:
+            if task_id not in self.spans:
+                return
+            lane = self.lanes.setdefault(name, len(self.lanes) + 1)
+            self.spans[task_id].append({
+                "name": name, "cat": "stage", "ph": "X",
+                "ts": int(started_at * 1e6), "dur": int(duration * 1e6),
+                "pid": os.getpid(), "tid": lane, "args": args,
+            })
+    
+    def start(self, task_id: str):
+        if TASK_TRACE:
+            with self._lock:
+                self.spans[task_id] = []
+    
+    def dump(self, task_id: str) -> Optional[str]:
+        """Записать trace задачи в outputs и вернуть URL для /download"""
+        with self._lock:
+            spans = self.spans.pop(task_id, None)
+        if spans is None:
+            return None
+        with open(OUTPUT_DIR / f"{task_id}_trace.json", "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": spans, "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+        return f"/download/{task_id}_trace.json"
+
+task_tracer = TaskTracer()
+
+def record_stage(stage: str, wall: float, kind: str = "stage", cpu: Optional[float] = None,
+                 queue_wait: Optional[float] = None, bytes_in: int = 0, bytes_out: int = 0,
+                 error: bool = False, started_at: Optional[float] = None, **attrs):
+    """Метрики одного вызова стадии + спан в trace текущей задачи"""
+    metrics.observe(f"{kind}_duration_seconds", wall, stage=stage)
+    if cpu is not None:
+        metrics.observe(f"{kind}_cpu_seconds", cpu, stage=stage)
+    if queue_wait is not None:
+        metrics.observe(f"{kind}_queue_wait_seconds", queue_wait, stage=stage)
+    if bytes_in:
+        metrics.inc(f"{kind}_bytes_total", bytes_in, stage=stage, direction="in")
+    if bytes_out:
+        metrics.inc(f"{kind}_bytes_total", bytes_out, stage=stage, direction="out")
+    if error:
+        metrics.inc(f"{kind}_errors_total", stage=stage)
+    
+    task_id = current_task_id.get()
+    if task_id:
+        args = {"cpu": cpu, "queue_wait": queue_wait, "bytes_in": bytes_in, "bytes_out": bytes_out,
+                "error": error, **attrs}
+        task_tracer.add(
+            task_id, stage if kind == "stage" else f"{kind}:{stage}",
+            started_at if started_at is not None else time.time() - wall, wall,
+            {k: v for k, v in args.items() if v}
+        )
+
+@asynccontextmanager
+async def track_stage(stage: str, kind: str = "stage", **attrs):
+    """Замер стадии; вызывающий дописывает в span cpu/queue_wait/bytes_in/bytes_out"""
+    span = {"cpu": None, "queue_wait": None, "bytes_in": 0, "bytes_out": 0, **attrs}
+    started_at = time.time()
+    started = time.perf_counter()
+    error = False
+    try:
+        yield span
+    except Exception:
+        error = True
+        raise
+    finally:
+        record_stage(stage, time.perf_counter() - started, kind=kind, error=error, started_at=started_at, **span)
+
+def call_with_cpu(fn, *args):
+    """Воркер пула: результат вызова и CPU-время процесса на него"""
+    started = time.process_time()
+    result = fn(*args)
+    return result, time.process_time() - started
+
+def payload_size(value) -> int:
+    """Примерный объём запроса к LLM в байтах (текст + картинки)"""
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    if isinstance(value, dict):
+        return sum(payload_size(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(payload_size(v) for v in value)
+    return 0
+
+def sample_stacks(seconds: float, interval: float = PROFILER_INTERVAL) -> str:
+    """Сэмплирующий профайлер: стеки всех потоков процесса раз в interval.
+    Результат — collapsed stacks (flamegraph.pl, speedscope). Воркеры пула не видны."""
+    counts: Counter = Counter()
+    me = threading.get_ident()
+    deadline = time.monotonic() + min(seconds, PROFILER_MAX_SECONDS)
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(f"{frame.f_code.co_name} ({Path(frame.f_code.co_filename).name}:{frame.f_lineno})")
+                frame = frame.f_back
+            counts[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+    return "\n".join(f"{stack} {count}" for stack, count in counts.most_common()) + "\n"
+
+# === ПЛАНИРОВЩИК LLM ВЫЗОВОВ ===
+
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.0-flash-exp")
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "8"))
+LLM_RATE_LIMIT = float(os.getenv("LLM_RATE_LIMIT", "10"))  # запросов в секунду, 0 = без лимита
+LLM_RATE_BURST = int(os.getenv("LLM_RATE_BURST", "10"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "20"))
+LLM_FAKE = os.getenv("LLM_FAKE", "0") == "1"  # локальная заглушка вместо Gemini
+LLM_BATCH_SIZE = max(1, int(os.getenv("LLM_BATCH_SIZE", "1")))  # фреймов в одном запросе анализа
+LLM_JSON_MODE = os.getenv("LLM_JSON_MODE", "auto")  # auto (если SDK умеет) | on | off
+LLM_REASK_LIMIT = int(os.getenv("LLM_REASK_LIMIT", "1"))  # повторных запросов на невалидный ответ
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+class TokenBucket:
+    """Token bucket: не более rate запросов в секунду, всплеск до burst"""
+    
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class LatencyStats:
+    """Скользящее окно латентностей с перцентилями"""
+    
+    def __init__(self, window: int = 1000):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+    
+    def record(self, seconds: float):
+        self.samples.append(seconds)
+        self.count += 1
+        self.total += seconds
+    
+    def percentile(self, q: float) -> float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    
+    def snapshot(self) -> Dict:
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total / self.count * 1000, 2) if self.count else 0.0,
+            "p50_ms": round(self.percentile(0.50) * 1000, 2),
+            "p90_ms": round(self.percentile(0.90) * 1000, 2),
+            "p99_ms": round(self.percentile(0.99) * 1000, 2),
+        }
+
+def is_retryable_llm_error(error: Exception) -> bool:
+    """429/5xx от Gemini (google.api_core) или заглушки"""
+    code = getattr(error, "code", None)
+    if callable(code):
+        try:
+            code = code()
+        except Exception:
+            code = None
+    if isinstance(code, int):
+        return code in RETRYABLE_STATUS_CODES
+    return re.search(r"\b(429|500|502|503|504)\b", str(error)) is not None
+
+class LLMScheduler:
+    """Общий планировщик LLM вызовов: лимит параллельности, rate limit, ретраи, метрики"""
+    
+    def __init__(self, concurrency: int, rate: float, burst: int, max_retries: int):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.bucket = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self.latency: Dict[str, LatencyStats] = {}
+        self.counters = {"calls": 0, "retries": 0, "errors": 0, "in_flight": 0,
+                         "prompt_tokens": 0, "output_tokens": 0}
+    
+    async def run(self, fn, *args, name: str = "generate", **kwargs):
+        """Выполнить блокирующий вызов fn(*args, **kwargs) в пуле потоков"""
+        attempt = 0
+        bytes_out = payload_size(args) + payload_size(kwargs)
+        while True:
+            waited = time.perf_counter()
+            await self.bucket.acquire()
+            async with self.semaphore:
+                self.counters["calls"] += 1
+                self.counters["in_flight"] += 1
+                started = time.perf_counter()
+                try:
+                    async with track_stage("llm", call=name, attempt=attempt) as span:
+                        span["queue_wait"] = started - waited
+                        span["bytes_out"] = bytes_out
+                        result = await asyncio.to_thread(fn, *args, **kwargs)
+                        span["bytes_in"] = len(getattr(result, "text", "") or "")
+                    self.count_tokens(result, name)
+                    return result
+                except Exception as e:
+                    if attempt >= self.max_retries or not is_retryable_llm_error(e):
+                        self.counters["errors"] += 1
+                        raise
+                finally:
+                    self.counters["in_flight"] -= 1
+                    self.latency.setdefault(name, LatencyStats()).record(time.perf_counter() - started)
+            
+            # Экспоненциальный backoff с full jitter, вне семафора
+            attempt += 1
+            self.counters["retries"] += 1
+            metrics.inc("llm_retries_total", call=name)
+            delay = min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * (2 ** attempt))
+            await asyncio.sleep(random.uniform(0, delay))
+    
+    def count_tokens(self, result, name: str):
+        """Токены из usage_metadata ответа, если SDK их отдаёт"""
+        usage = getattr(result, "usage_metadata", None)
+        if usage is None:
+            return
+        for direction, field in (("prompt", "prompt_token_count"), ("output", "candidates_token_count")):
+            tokens = getattr(usage, field, 0) or 0
+            self.counters[f"{direction}_tokens"] += tokens
+            metrics.inc("llm_tokens_total", tokens, call=name, direction=direction)
+    
+    def snapshot(self) -> Dict:
+        return {
+            **self.counters,
+            "latency": {name: stats.snapshot() for name, stats in self.latency.items()},
+            "frame_analysis": dict(frame_analysis_stats),
+        }
+
+llm_scheduler = LLMScheduler(LLM_CONCURRENCY, LLM_RATE_LIMIT, LLM_RATE_BURST, LLM_MAX_RETRIES)
+
+class FakeLLMError(Exception):
+    """Ошибка заглушки с HTTP-кодом, как у google.api_core.exceptions"""
+    
+    def __init__(self, code: int):
+        self.code = code
+        super().__init__(f"{code} fake LLM error")
+
+FAKE_IMAGE_TOKENS = 258  # столько Gemini считает за одно изображение
+
+def estimate_tokens(contents) -> int:
+    """Грубая оценка токенов запроса: ~4 символа на токен, фиксированная цена картинки"""
+    parts = contents if isinstance(contents, list) else [contents]
+    return sum(FAKE_IMAGE_TOKENS if isinstance(part, dict) else len(str(part)) // 4 + 1 for part in parts)
+
+class FakeGenerativeModel:
+    """Локальная заглушка Gemini: задержка, инъекция 429/5xx и битого JSON, подсчёт токенов.
+    На запрос с несколькими картинками отвечает JSON-массивом, как пакетный анализ."""
+    
+    def __init__(self, latency: Optional[float] = None, error_rate: Optional[float] = None,
+                 response_text: Optional[str] = None, malformed_rate: Optional[float] = None):
+        self.latency = float(os.getenv("LLM_FAKE_LATENCY", "0.5")) if latency is None else latency
+        self.error_rate = float(os.getenv("LLM_FAKE_ERROR_RATE", "0.1")) if error_rate is None else error_rate
+        self.malformed_rate = (float(os.getenv("LLM_FAKE_MALFORMED_RATE", "0"))
+                               if malformed_rate is None else malformed_rate)
+        self.response_text = response_text or json.dumps({
+            "is_key_moment": True,
+            "description": "Тестовое описание ключевого момента",
+            "importance": 7,
+            "topic": "Тестовая тема"
+        }, ensure_ascii=False)
+    
+    def generate_content(self, contents, **kwargs):
+        time.sleep(self.latency * random.uniform(0.5, 1.5))
+        if random.random() < self.error_rate:
+            raise FakeLLMError(random.choice([429, 503]))
+        images = sum(isinstance(part, dict) for part in contents) if isinstance(contents, list) else 0
+        if images > 1:
+            item = json.loads(self.response_text)
+            text = json.dumps([{"frame": i + 1, **item} for i in range(images)], ensure_ascii=False)
+        else:
+            text = self.response_text
+        if random.random() < self.malformed_rate:
+            text = text[:len(text) // 2]  # обрыв ответа посередине
+        usage = SimpleNamespace(prompt_token_count=estimate_tokens(contents),
+                                candidates_token_count=len(text) // 4 + 1)
+        return SimpleNamespace(text=text, usage_metadata=usage)
+
+def get_generative_model():
+    """Модель Gemini или локальная заглушка (LLM_FAKE=1)"""
+    if LLM_FAKE:
+        return FakeGenerativeModel()
+    return get_genai().GenerativeModel(GEMINI_MODEL)
+
+def embed_content(**kwargs) -> Dict:
+    """genai.embed_content или случайный вектор в режиме заглушки"""
+    if LLM_FAKE:
+        content = kwargs.get("content")
+        if isinstance(content, list):
+            return {"embedding": np.random.randn(len(content), 768).tolist()}
+        return {"embedding": np.random.randn(768).tolist()}
+    return get_genai().embed_content(**kwargs)
+
+# === СТРУКТУРИРОВАННЫЙ ВЫВОД LLM ===
+
+class FrameAnalysis(BaseModel):
+    is_key_moment: bool
+    description: str = ""
+    importance: int = Field(ge=0, le=10)
+    topic: str = "Прочее"
+    
+    @field_validator("is_key_moment", mode="before")
+    @classmethod
+    def parse_yes_no(cls, value):
+        if isinstance(value, str) and value.strip().lower() in ("да", "нет"):
+            return value.strip().lower() == "да"
+        return value
+
+class FrameBatchItem(FrameAnalysis):
+    frame: int
+
+class QuizQuestion(BaseModel):
+    question: str
+    options: List[str] = Field(min_length=2)
+    correct: int
+    explanation: str = ""
+    
+    @model_validator(mode="after")
+    def check_correct(self):
+        if not 0 <= self.correct < len(self.options):
+            raise ValueError(f"correct={self.correct} is out of options range")
+        return self
+
+class Quiz(BaseModel):
+    questions: List[QuizQuestion]
+
+class Flashcard(BaseModel):
+    front: str
+    back: str
+    category: str = ""
+
+class FlashcardDeck(BaseModel):
+    cards: List[Flashcard]
+
+JSON_FENCE_RE = re.compile(r"```(?:json)?\s*(.*?)(?:```|$)", re.S)
+
+def json_structure(text: str):
+    """(позиция, символ) вне строковых литералов JSON; открывающая кавычка строки тоже выдаётся"""
+    in_string = escape = False
+    for i, ch in enumerate(text):
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+        yield i, ch
+
+def strip_trailing_commas(text: str) -> str:
+    """Убрать висячие запятые перед } и ], не трогая содержимое строк"""
+    drop, last_comma = [], None
+    for i, ch in json_structure(text):
+        if ch.isspace():
+            continue
+        if ch in "}]" and last_comma is not None:
+            drop.append(last_comma)
+        last_comma = i if ch == "," else None
+    for i in reversed(drop):
+        text = text[:i] + text[i + 1:]
+    return text
+
+def close_truncated_json(text: str) -> str:
+    """Обрезанный ответ: откат к последнему законченному объекту/массиву и закрытие открытых скобок"""
+    stack = []
+    safe_end, safe_stack = 0, []
+    for i, ch in json_structure(text):
+        if ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+        elif ch in "}]":
+            if stack:
+                stack.pop()
+            safe_end, safe_stack = i + 1, list(stack)
+            if not stack:
+                break
+    return text[:safe_end] + "".join(reversed(safe_stack))
+
+def extract_json(text: str):
+    """Терпимый разбор ответа LLM: markdown-обёртка, текст вокруг JSON, висячие запятые, обрезанный хвост"""
+    match = JSON_FENCE_RE.search(text)
+    if match:
+        text = match.group(1)
+    starts = [i for i in (text.find("{"), text.find("[")) if i >= 0]
+    if not starts:
+        raise ValueError("no JSON value in LLM response")
+    text = text[min(starts):]
+    decoder = json.JSONDecoder()
+    # Сначала строгий разбор как есть; починка — только если он не удался
+    try:
+        return decoder.raw_decode(text)[0]
+    except json.JSONDecodeError:
+        text = strip_trailing_commas(text)
+    try:
+        return decoder.raw_decode(text)[0]
+    except json.JSONDecodeError:
+        return decoder.raw_decode(close_truncated_json(text))[0]
+
+def parse_structured(text: str, schema: Type[BaseModel]) -> BaseModel:
+    """JSON из ответа, проверенный схемой; ValueError (в т.ч. ValidationError), если не вышло"""
+    return schema.model_validate(extract_json(text))
+
+def parse_structured_items(text: str, schema: Type[BaseModel], field: Optional[str] = None) -> List[Optional[BaseModel]]:
+    """Поэлементная проверка списка (верхнего уровня или в поле field): невалидный элемент — None"""
+    data = extract_json(text)
+    if field and isinstance(data, dict):
+        data = data.get(field)
+    if not isinstance(data, list):
+        raise ValueError("LLM response has no list of items")
+    
+    items = []
+    for item in data:
+        try:
+            items.append(schema.model_validate(item))
+        except ValidationError:
+            items.append(None)
+    return items
+
+@lru_cache(maxsize=1)
+def structured_output_fields() -> frozenset:
+    """Какие поля структурированного вывода понимает GenerationConfig установленного SDK"""
+    if LLM_JSON_MODE == "off":
+        return frozenset()
+    if LLM_FAKE or LLM_JSON_MODE == "on":
+        return frozenset({"response_mime_type", "response_schema"})
+    config = getattr(get_genai().types, "GenerationConfig", None)
+    if config is None or not dataclasses.is_dataclass(config):
+        return frozenset()
+    return frozenset({f.name for f in dataclasses.fields(config)} & {"response_mime_type", "response_schema"})
+
+def json_generation_kwargs(schema=None) -> Dict:
+    """generation_config с JSON mode и схемой ответа, если модель их поддерживает"""
+    fields = structured_output_fields()
+    config = {}
+    if "response_mime_type" in fields:
+        config["response_mime_type"] = "application/json"
+    if schema is not None and "response_schema" in fields:
+        config["response_schema"] = schema
+    return {"generation_config": config} if config else {}
+
+def count_parse_failure(name: str, error: Exception):
+    print(f"Unparseable {name} response: {str(error)[:200]}")
+    metrics.inc("llm_parse_failures_total", call=name)
+
+def reask_contents(contents, error: Exception) -> List:
+    """Тот же запрос плюс причина, по которой предыдущий ответ отклонён"""
+    parts = list(contents) if isinstance(contents, list) else [contents]
+    return parts + [f"Предыдущий ответ не прошёл проверку: {str(error)[:300]}\n"
+                    "Верни только валидный JSON строго по формату выше."]
+
+async def generate_structured(model, contents, schema: Type[BaseModel], name: str) -> BaseModel:
+    """Запрос с ответом по схеме; на невалидный JSON — до LLM_REASK_LIMIT повторов с указанием ошибки"""
+    attempt = 0
+    while True:
+        response = await llm_scheduler.run(
+            model.generate_content, contents, name=name, **json_generation_kwargs(schema)
+        )
+        try:
+            return parse_structured(response.text, schema)
+        except ValueError as e:
+            count_parse_failure(name, e)
+            if attempt >= LLM_REASK_LIMIT:
+                raise
+            attempt += 1
+            metrics.inc("llm_reasks_total", call=name)
+            contents = reask_contents(contents, e)
+
+async def generate_structured_items(model, build_prompt, schema: Type[BaseModel], container: Type[BaseModel],
+                                    field: str, count: int, name: str) -> List[BaseModel]:
+    """Список из count элементов: валидные элементы копятся, повторный запрос — только за недостающими.
+    build_prompt(сколько нужно, уже принятые элементы) -> промпт."""
+    items: List[BaseModel] = []
+    for attempt in range(LLM_REASK_LIMIT + 1):
+        if attempt:
+            metrics.inc("llm_reasks_total", call=name)
+        missing = count - len(items)
+        try:
+            response = await llm_scheduler.run(
+                model.generate_content, build_prompt(missing, items), name=name,
+                **json_generation_kwargs(container)
+            )
+        except Exception as e:
+            print(f"{name} generation error: {e}")
+            break
+        try:
+            parsed = parse_structured_items(response.text, schema, field)
+        except ValueError as e:
+            count_parse_failure(name, e)
+            continue
+        valid = [item for item in parsed if item is not None]
+        if len(valid) < len(parsed):
+            count_parse_failure(name, ValueError(f"{len(parsed) - len(valid)} invalid items"))
+        items += valid[:missing]
+        if len(items) >= count:
+            break
+    return items
+
+# === ОЧЕРЕДЬ ЗАДАЧ И ПУЛ ВОРКЕРОВ ===
+
+JOB_CONCURRENCY = int(os.getenv("JOB_CONCURRENCY", "2"))  # видео в обработке одновременно
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "100"))  # сверх этого /upload отвечает 429
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", str(os.cpu_count() or 2)))
+# fork из процесса с потоками (to_thread, warm-up, SQLite, Qdrant) и загруженным OpenCV может зависнуть;
+# все точки входа пула — функции верхнего уровня, им хватает forkserver/spawn
+WORKER_START_METHOD = os.getenv("WORKER_START_METHOD", "forkserver")
+DEFAULT_JOB_PRIORITY = 5  # меньше — раньше
+JOB_CANCEL_POLL_INTERVAL = float(os.getenv("JOB_CANCEL_POLL_INTERVAL", "2"))  # проверка отмены из других воркеров
+
+# Лимиты параллельности CPU-тяжёлых стадий поверх общего пула процессов
+STAGE_LIMITS = {
+    "decode": int(os.getenv("STAGE_LIMIT_DECODE", "2")),
+    "render": int(os.getenv("STAGE_LIMIT_RENDER", str(WORKER_PROCESSES))),
+    "encode": int(os.getenv("STAGE_LIMIT_ENCODE", "1")),
+    "pdf": int(os.getenv("STAGE_LIMIT_PDF", "2")),
+    "tts": int(os.getenv("STAGE_LIMIT_TTS", str(WORKER_PROCESSES))),
+}
+stage_semaphores = {stage: asyncio.Semaphore(limit) for stage, limit in STAGE_LIMITS.items()}
+
+_cpu_pool: Optional[ProcessPoolExecutor] = None
+_cpu_pool_lock = threading.Lock()
+
+def get_cpu_pool() -> ProcessPoolExecutor:
+    """Пул процессов для OpenCV/PIL/ReportLab — не делит GIL с event loop API"""
+    global _cpu_pool
+    # warm_up создаёт пул из потока, пока run_in_worker может обратиться к нему из loop
+    with _cpu_pool_lock:
+        if _cpu_pool is None:
+            context = multiprocessing.get_context(WORKER_START_METHOD)
+            if WORKER_START_METHOD == "forkserver":
+                # forkserver импортирует модуль один раз, воркеры стартуют без повторного импорта
+                context.set_forkserver_preload([__name__])
+            _cpu_pool = ProcessPoolExecutor(max_workers=WORKER_PROCESSES, mp_context=context)
+    return _cpu_pool
+
+async def run_in_worker(stage: str, fn, *args):
+    """Выполнить fn(*args) в пуле процессов в пределах лимита стадии"""
+    waited = time.perf_counter()
+    async with stage_semaphores[stage]:
+        async with track_stage(stage) as span:
+            span["queue_wait"] = time.perf_counter() - waited
+            loop = asyncio.get_running_loop()
+            result, span["cpu"] = await loop.run_in_executor(get_cpu_pool(), partial(call_with_cpu, fn, *args))
+            return result
+
+async def run_ffmpeg(args: List[str], stage: str = "encode", output: Optional[Path] = None):
+    """ffmpeg как asyncio subprocess: не блокирует loop, убивается при отмене задачи"""
+    waited = time.perf_counter()
+    async with stage_semaphores[stage]:
+        async with track_stage(stage, tool="ffmpeg") as span:
+            span["queue_wait"] = time.perf_counter() - waited
+            proc = await asyncio.create_subprocess_exec(
+                "ffmpeg", "-hide_banner", "-loglevel", "error", *args,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE
+            )
+            try:
+                _, stderr = await proc.communicate()
+            except asyncio.CancelledError:
+                proc.kill()
+                await proc.wait()
+                raise
+            if proc.returncode != 0:
+                raise RuntimeError(f"ffmpeg failed: {stderr.decode(errors='ignore')[-500:]}")
+            if output is not None and output.is_file():
+                span["bytes_out"] = output.stat().st_size
+
+class JobQueue:
+    """Очередь обработки видео: приоритеты, ограничение параллельности, отмена, backpressure"""
+    
+    def __init__(self, concurrency: int, maxsize: int):
+        self.concurrency = concurrency
+        self.maxsize = maxsize
+        self.queue: Optional[asyncio.PriorityQueue] = None
+        self.running: Dict[str, asyncio.Task] = {}
+        self.queue_wait = LatencyStats()
+        self.owned = Counter()  # задачи этого процесса (в очереди, в работе, загрузка) для heartbeat
+        self._workers: List[asyncio.Task] = []
+        self._seq = itertools.count()
+    
+    def start(self):
+        # Ленивый старт: очередь и воркеры привязываются к текущему event loop
+        if self.queue is None:
+            self.queue = asyncio.PriorityQueue(maxsize=self.maxsize)
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+            self._workers.append(asyncio.create_task(self._heartbeat()))
+    
+    def _own(self, task_id: str):
+        self.owned[task_id] += 1
+    
+    def _release(self, task_id: str):
+        self.owned[task_id] -= 1
+        if self.owned[task_id] <= 0:
+            del self.owned[task_id]
+    
+    async def _heartbeat(self):
+        """Очередь и длинные стадии не пишут в хранилище — без heartbeat их сочли бы сиротами"""
+        while True:
+            await asyncio.sleep(TASK_HEARTBEAT_INTERVAL)
+            if self.owned:
+                try:
+                    await asyncio.to_thread(task_store.touch, list(self.owned))
+                except Exception as e:
+                    print(f"Task heartbeat error: {e}")
+    
+    def is_full(self) -> bool:
+        return self.queue is not None and self.queue.full()
+    
+    def _job(self, task_id: str, fn, args, priority: int):
+        return (priority, next(self._seq), time.monotonic(), task_id, fn, args)
+    
+    async def submit(self, task_id: str, fn, *args, priority: int = DEFAULT_JOB_PRIORITY):
+        """Поставить задачу в очередь; 429, если очередь заполнена"""
+        self.start()
+        if self.queue.full():
+            raise HTTPException(status_code=429, detail="Processing queue is full, retry later")
+        # Состояние пишется до постановки в очередь: воркер перечитывает его перед стартом
+        await report_progress(task_id, {"status": "queued", "current_step": "В очереди..."})
+        try:
+            self.queue.put_nowait(self._job(task_id, fn, args, priority))
+        except asyncio.QueueFull:
+            await asyncio.to_thread(task_store.delete, task_id)
+            raise HTTPException(status_code=429, detail="Processing queue is full, retry later")
+        self._own(task_id)
+    
+    async def enqueue(self, task_id: str, fn, *args, priority: int = DEFAULT_JOB_PRIORITY):
+        """Поставить задачу в очередь, дождавшись места (для уже принятых загрузок по URL)"""
+        self.start()
+        # Владеем задачей уже во время ожидания места, чтобы heartbeat не счёл её сиротой
+        self._own(task_id)
+        try:
+            await report_progress(task_id, {"status": "queued", "current_step": "В очереди..."})
+            await self.queue.put(self._job(task_id, fn, args, priority))
+        except BaseException:
+            # Ошибка хранилища или отмена ожидания: в очередь задача не попала
+            self._release(task_id)
+            raise
+    
+    def run_detached(self, task_id: str, coro):
+        """Запустить вне очереди (загрузка по URL), но с возможностью отмены по task_id"""
+        task = asyncio.create_task(coro)
+        self.running[task_id] = task
+        self._own(task_id)
+        task.add_done_callback(lambda done: self._forget(task_id, done))
+        asyncio.create_task(self._watch(task_id, task))
+        return task
+    
+    def _forget(self, task_id: str, task: asyncio.Task):
+        self._release(task_id)
+        # Загрузка могла уже передать task_id задаче обработки — её не трогаем
+        if self.running.get(task_id) is task:
+            del self.running[task_id]
+    
+    async def _worker(self):
+        while True:
+            priority, _, enqueued_at, task_id, fn, args = await self.queue.get()
+            try:
+                # Отмену могли записать в хранилище из любого воркера, пока задача ждала в очереди
+                state = await asyncio.to_thread(task_store.get, task_id)
+                if state and state.get("cancel_requested"):
+                    continue
+                self.queue_wait.record(time.monotonic() - enqueued_at)
+                metrics.observe("job_queue_wait_seconds", time.monotonic() - enqueued_at)
+                task = asyncio.create_task(fn(*args))
+                self.running[task_id] = task
+                await self._watch(task_id, task)
+                if self.running.get(task_id) is task:
+                    del self.running[task_id]
+            except Exception as e:
+                print(f"Job {task_id} crashed: {e}")
+            finally:
+                self._release(task_id)
+                self.queue.task_done()
+    
+    async def _watch(self, task_id: str, task: asyncio.Task):
+        """Дождаться задачи, проверяя флаг отмены: DELETE мог прийти в другой воркер"""
+        while True:
+            # wait() не пробрасывает CancelledError отменённой задачи в воркер
+            done, _ = await asyncio.wait({task}, timeout=JOB_CANCEL_POLL_INTERVAL)
+            if done:
+                return
+            try:
+                state = await asyncio.to_thread(task_store.get, task_id)
+            except Exception as e:
+                print(f"Cancel check for {task_id} failed: {e}")
+                continue
+            if state and state.get("cancel_requested"):
+                task.cancel()
+                await asyncio.wait({task})
+                # Пайплайн мог успеть перезаписать статус после запроса отмены
+                await finish_task(task_id, cancelled_state())
+                return
+    
+    async def cancel(self, task_id: str) -> bool:
+        """Отмена из любого воркера: флаг в хранилище видят очередь и watchdog воркера-владельца"""
+        task = self.running.get(task_id)
+        if task is not None:
+            task.cancel()
+        else:
+            state = await asyncio.to_thread(task_store.get, task_id)
+            if not state or state.get("status") in FINISHED_STATUSES:
+                return False
+        await finish_task(task_id, cancelled_state())
+        return True
+    
+    def snapshot(self) -> Dict:
+        return {
+            "queued": self.queue.qsize() if self.queue else 0,
+            "max_queued": self.maxsize,
+            "running": len(self.running),
+            "concurrency": self.concurrency,
+            "worker_processes": WORKER_PROCESSES,
+            "queue_wait": self.queue_wait.snapshot(),
+        }
+
+def cancelled_state() -> Dict:
+    return {
+        "status": "cancelled",
+        "progress": 0,
+        "current_step": "Отменено",
+        "cancel_requested": True
+    }
+
+job_queue = JobQueue(JOB_CONCURRENCY, JOB_QUEUE_SIZE)
+
+# === КЭШ РЕЗУЛЬТАТОВ ===
+
+CACHE_DIR = Path(os.getenv("CACHE_DIR", "cache"))
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(5 * 1024 ** 3)))
+PROMPT_VERSION = "frame-analysis-v1"  # менять при изменении промптов
+SLIDE_VERSION = "slide-v1"  # менять при изменении вёрстки слайдов
+
+def cache_key(*parts) -> str:
+    """Контентный ключ: sha256 от канонического JSON всех входов стадии"""
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def hash_file(path: Path, chunk_size: int = 1024 * 1024) -> str:
+    """sha256 файла потоково, без загрузки в память"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class ContentCache:
+    """Контентно-адресуемый кэш на диске с LRU-вытеснением по суммарному размеру"""
+    
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, Path]" = OrderedDict()
+        self.sizes: Dict[str, int] = {}
+        self.total_bytes = 0
+        self.stats: Dict[str, Dict[str, int]] = {}
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._dirty = False
+    
+    @property
+    def index_path(self) -> Path:
+        return self.root / "lru.json"
+    
+    def _load_index(self):
+        # Индекс читается при первом обращении (под self._lock), а не при импорте модуля.
+        # Порядок LRU хранится в lru.json, а не в mtime: записи хардлинкаются в outputs/,
+        # и os.utime на попадании менял бы Last-Modified/ETag уже отданных артефактов
+        if self._loaded:
+            return
+        self._loaded = True
+        self.root.mkdir(parents=True, exist_ok=True)
+        files = {
+            p.name.split(".")[0]: p
+            for p in self.root.glob("*/*") if p.is_file() and not p.name.endswith(".tmp")
+        }
+        try:
+            order = json.loads(self.index_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            order = []
+        # Записи, сохранённые после последнего сброса индекса, считаем самыми свежими
+        known = [key for key in order if key in files]
+        fresh = sorted(set(files) - set(known), key=lambda key: files[key].stat().st_mtime)
+        for key in known + fresh:
+            path = files[key]
+            self.entries[key] = path
+            self.sizes[key] = path.stat().st_size
+            self.total_bytes += self.sizes[key]
+    
+    def _flush_index(self):
+        """Сохранить порядок LRU (вызывается под self._lock)"""
+        if not self._dirty:
+            return
+        try:
+            write_json_atomic(self.index_path, list(self.entries))
+            self._dirty = False
+        except OSError as e:
+            print(f"Cache index write failed: {e}")
+    
+    def flush(self):
+        with self._lock:
+            self._flush_index()
+    
+    def _count(self, kind: str, outcome: str):
+        self.stats.setdefault(kind, {"hits": 0, "misses": 0})[outcome] += 1
+    
+    def _lookup(self, key: str, kind: str) -> Optional[Path]:
+        with self._lock:
+            self._load_index()
+            path = self.entries.get(key)
+            if path is None or not path.exists():
+                self._count(kind, "misses")
+                return None
+            self.entries.move_to_end(key)
+            self._dirty = True
+            self._count(kind, "hits")
+        return path
+    
+    def _store(self, key: str, suffix: str, write):
+        path = self.root / key[:2] / f"{key}{suffix}"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+        write(tmp_path)
+        os.replace(tmp_path, path)
+        size = path.stat().st_size
+        with self._lock:
+            self._load_index()
+            if key in self.entries:
+                self.total_bytes -= self.sizes[key]
+            self.entries[key] = path
+            self.entries.move_to_end(key)
+            self.sizes[key] = size
+            self.total_bytes += size
+            self._dirty = True
+            self._evict()
+            self._flush_index()
+    
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            key, path = self.entries.popitem(last=False)
+            self.total_bytes -= self.sizes.pop(key)
+            self.evictions += 1
+            try:
+                path.unlink()
+            except OSError:
+                pass
+    
+    def get_json(self, key: str, kind: str = "json"):
+        path = self._lookup(key, kind)
+        if path is None:
+            return None
+        try:
+            return json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+    
+    def put_json(self, key: str, value, kind: str = "json"):
+        data = json.dumps(value, ensure_ascii=False)
+        self._store(key, ".json", lambda tmp: tmp.write_text(data, encoding="utf-8"))
+    
+    def get_file(self, key: str, dest: Path, kind: str = "file") -> bool:
+        """Скопировать закэшированный артефакт в dest (hardlink, если возможно)"""
+        path = self._lookup(key, kind)
+        if path is None:
+            return False
+        try:
+            if dest.exists():
+                dest.unlink()
+            os.link(path, dest)
+        except OSError:
+            shutil.copyfile(path, dest)
+        return True
+    
+    def put_file(self, key: str, src: Path, kind: str = "file"):
+        self._store(key, src.suffix, lambda tmp: shutil.copyfile(src, tmp))
+    
+    def snapshot(self) -> Dict:
+        with self._lock:
+            self._load_index()
+            return {
+                "entries": len(self.entries),
+                "total_bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+                "stages": {kind: dict(counts) for kind, counts in self.stats.items()},
+            }
+
+result_cache = ContentCache(CACHE_DIR, CACHE_MAX_BYTES)
+
+async def cached_file(kind: str, key: str, output_path: Path, build) -> bool:
+    """Достать артефакт из кэша или собрать через build() и закэшировать; True при попадании"""
+    if await asyncio.to_thread(result_cache.get_file, key, output_path, kind):
+        return True
+    await build()
+    if output_path.exists():
+        await asyncio.to_thread(result_cache.put_file, key, output_path, kind)
+    return False
+
+async def cached_json(kind: str, key: str, build, is_valid=bool):
+    """Достать JSON-результат из кэша или вычислить; невалидные (fallback) результаты не кэшируются"""
+    cached = result_cache.get_json(key, kind=kind)
+    if cached is not None:
+        return cached
+    value = await build()
+    if is_valid(value):
+        result_cache.put_json(key, value, kind=kind)
+    return value
+
+# === ИЗВЛЕЧЕНИЕ ФРЕЙМОВ ===
+
+SAMPLER_MODE = os.getenv("SAMPLER_MODE", "sequential")  # sequential | keyframes
+SAMPLE_INTERVAL = float(os.getenv("SAMPLE_INTERVAL", "5"))  # секунд между сэмплами
+SAMPLE_MAX_FRAMES = int(os.getenv("SAMPLE_MAX_FRAMES", "0"))  # 0 = без лимита
+
+def get_sampling_policy(**overrides) -> Dict:
+    """Политика сэмплирования фреймов (режим, интервал, лимит)"""
+    policy = {
+        "mode": SAMPLER_MODE,
+        "interval": SAMPLE_INTERVAL,
+        "max_frames": SAMPLE_MAX_FRAMES,
+    }
+    policy.update({k: v for k, v in overrides.items() if v is not None})
+    return policy
+
+def probe_video(video_path: Path) -> Dict:
+    """Базовые параметры видео: fps, число кадров, длительность"""
+    cap = cv2.VideoCapture(str(video_path))
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = cap.get(cv2.CAP_PROP_FPS) or 25.0
+    cap.release()
+    return {"fps": fps, "total_frames": total_frames, "duration": total_frames / fps}
+
+FRAME_RESAMPLE_OFFSETS = (0.0, 0.5, 1.0, 2.0, 4.0)  # шаги назад, если кадр по таймстемпу не читается
+
+def read_frame_at(video_path: Path, timestamp: float):
+    """Один фрейм по таймстемпу (для восстановления из кэша, не для сэмплирования).
+    Seek за последний кадр или на битый участок повторяется чуть раньше; None — кадра нет."""
+    cap = cv2.VideoCapture(str(video_path))
+    try:
+        for offset in FRAME_RESAMPLE_OFFSETS:
+            if offset and offset > timestamp:
+                break
+            cap.set(cv2.CAP_PROP_POS_MSEC, max(timestamp - offset, 0.0) * 1000)
+            ret, frame = cap.read()
+            if ret:
+                return frame
+        return None
+    finally:
+        cap.release()
+
+def sample_frames_sequential(video_path: Path, interval: float, max_frames: int = 0,
+                             start: float = 0.0, end: Optional[float] = None) -> Iterator:
+    """Один проход вперёд: grab() на каждом кадре, retrieve() только на целевых.
+    start/end — отрезок шарда; сетка сэмплов общая для всего видео."""
+    cap = cv2.VideoCapture(str(video_path))
+    fps = cap.get(cv2.CAP_PROP_FPS) or 25.0
+    sampled = 0
+    frame_idx = 0
+    next_ts = -(-start // interval) * interval  # первый узел сетки не раньше start
+    if start:
+        # Шард начинается на ключевом кадре — seek не декодирует лишнего
+        cap.set(cv2.CAP_PROP_POS_MSEC, start * 1000)
+        frame_idx = int(round(cap.get(cv2.CAP_PROP_POS_FRAMES)))
+    target_idx = int(next_ts * fps)
+    
+    # grab() только демультиплексирует и декодирует без конвертации в BGR,
+    # поэтому нет повторного декодирования от ключевого кадра, как при seek
+    try:
+        while (end is None or next_ts < end) and cap.grab():
+            if frame_idx >= target_idx:
+                ret, frame = cap.retrieve()
+                if ret:
+                    yield int(next_ts), frame
+                    sampled += 1
+                    if max_frames and sampled >= max_frames:
+                        break
+                next_ts += interval
+                target_idx = int(next_ts * fps)
+            frame_idx += 1
+    finally:
+        cap.release()
+
+def sample_frames_keyframes(video_path: Path, interval: float, max_frames: int = 0,
+                            start: float = 0.0, end: Optional[float] = None) -> Iterator:
+    """Только ключевые кадры через ffmpeg (-skip_frame nokey), не чаще interval"""
+    segment = (["-ss", f"{start:.3f}"] if start else []) + (["-t", f"{end - start:.3f}"] if end is not None else [])
+    with tempfile.TemporaryDirectory(prefix="keyframes_") as tmp_dir:
+        result = subprocess.run([
+            "ffmpeg", "-hide_banner",
+            "-skip_frame", "nokey",
+            *segment,
+            "-i", str(video_path),
+            "-vf", f"select='isnan(prev_selected_t)+gte(t-prev_selected_t\\,{interval})',showinfo",
+            "-vsync", "vfr",
+            str(Path(tmp_dir) / "%06d.png"),
+            "-y"
+        ], capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"ffmpeg keyframe extraction failed: {result.stderr[-500:]}")
+        
+        # showinfo печатает pts_time для каждого выбранного кадра в порядке вывода
+        # (при -ss перед -i время отсчитывается от начала отрезка)
+        timestamps = [start + float(t) for t in re.findall(r"pts_time:\s*([0-9.]+)", result.stderr)]
+        frame_files = sorted(Path(tmp_dir).glob("*.png"))
+        
+        # Кадры читаются с диска по одному, в памяти не копятся
+        sampled = 0
+        for ts, frame_file in zip(timestamps, frame_files):
+            frame = cv2.imread(str(frame_file))
+            if frame is not None:
+                yield int(ts), frame
+                sampled += 1
+                if max_frames and sampled >= max_frames:
+                    break
+
+def sample_video_frames(video_path: Path, policy: Optional[Dict] = None,
+                        start: float = 0.0, end: Optional[float] = None) -> Iterator:
+    """Извлечение фреймов согласно политике сэмплирования (генератор (timestamp, frame))"""
+    policy = policy or get_sampling_policy()
+    if policy["mode"] == "keyframes":
+        yielded = 0
+        try:
+            for sample in sample_frames_keyframes(video_path, policy["interval"], policy["max_frames"], start, end):
+                yielded += 1
+                yield sample
+            return
+        except Exception as e:
+            if yielded:
+                raise
+            print(f"Keyframe sampling failed, falling back to sequential: {e}")
+    yield from sample_frames_sequential(video_path, policy["interval"], policy["max_frames"], start, end)
+
+# === ДЕДУПЛИКАЦИЯ СЦЕН ===
+
+SCENE_HASH_THRESHOLD = int(os.getenv("SCENE_HASH_THRESHOLD", "10"))  # бит Хэмминга из 64
+MAX_ANALYZED_SCENES = int(os.getenv("MAX_ANALYZED_SCENES", "0"))  # 0 = без лимита
+
+def compute_frame_hashes(frames: List) -> "np.ndarray":
+    """Пакетный dHash (64 бита на фрейм) -> bool массив (N, 64)"""
+    if not frames:
+        return np.zeros((0, 64), dtype=bool)
+    small = np.stack([
+        cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), (9, 8), interpolation=cv2.INTER_AREA)
+        for frame in frames
+    ]).astype(np.int16)
+    # Сравнение соседних пикселей по строкам сразу для всей пачки
+    return (small[:, :, 1:] > small[:, :, :-1]).reshape(len(frames), -1)
+
+def frame_hash_hex(bits: "np.ndarray") -> str:
+    return np.packbits(bits).tobytes().hex()
+
+def frame_fingerprint(frame) -> str:
+    """256-битный dHash представителя сцены — ключ кэша анализа фрейма"""
+    gray = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), (17, 16), interpolation=cv2.INTER_AREA)
+    gray = gray.astype(np.int16)
+    return frame_hash_hex((gray[:, 1:] > gray[:, :-1]).ravel())
+
+def iter_scenes(samples, threshold: int = SCENE_HASH_THRESHOLD) -> Iterator[Dict]:
+    """Потоковая склейка подряд идущих почти одинаковых фреймов в сцены.
+    Сцена отдаётся, как только закрылась; в памяти держится только текущий представитель."""
+    scene = None
+    rep_hash = None
+    for timestamp, frame in samples:
+        bits = compute_frame_hashes([frame])[0]
+        if rep_hash is not None and np.count_nonzero(bits != rep_hash) <= threshold:
+            scene["end"] = timestamp
+            scene["frame_count"] += 1
+            continue
+        if scene is not None:
+            yield scene
+        rep_hash = bits
+        scene = {
+            "timestamp": timestamp,
+            "end": timestamp,
+            "frame": frame,
+            "phash": frame_hash_hex(bits),
+            "fingerprint": frame_fingerprint(frame),
+            "frame_count": 1
+        }
+    if scene is not None:
+        yield scene
+
+def limit_scenes(scenes: List[Dict], max_scenes: int = MAX_ANALYZED_SCENES) -> List[Dict]:
+    """Оставить max_scenes самых длинных сцен (в хронологическом порядке)"""
+    if not max_scenes or len(scenes) <= max_scenes:
+        return scenes
+    longest = sorted(scenes, key=lambda sc: sc["frame_count"], reverse=True)[:max_scenes]
+    return sorted(longest, key=lambda sc: sc["timestamp"])
+
+# === ПОТОКОВАЯ ПОДГОТОВКА ФРЕЙМОВ ===
+
+ANALYSIS_MAX_SIDE = int(os.getenv("ANALYSIS_MAX_SIDE", "1024"))  # длинная сторона кадра для Gemini, 0 = как есть
+ANALYSIS_IMAGE_FORMAT = os.getenv("ANALYSIS_IMAGE_FORMAT", "jpeg")  # jpeg | webp
+ANALYSIS_IMAGE_QUALITY = int(os.getenv("ANALYSIS_IMAGE_QUALITY", "85"))
+ANALYSIS_CROP = os.getenv("ANALYSIS_CROP", "")  # "" | auto (срезать чёрные поля) | x0,y0,x1,y1 в долях кадра
+CROP_BLACK_LEVEL = 16  # яркость, ниже которой строка/столбец считаются полем
+SCENE_QUEUE_SIZE = int(os.getenv("SCENE_QUEUE_SIZE", "8"))  # сцен между декодером и анализом
+FRAME_SPILL_DIR = OUTPUT_DIR / "tmp"
+
+IMAGE_FORMATS = {
+    "jpeg": (".jpg", "image/jpeg", "IMWRITE_JPEG_QUALITY"),
+    "webp": (".webp", "image/webp", "IMWRITE_WEBP_QUALITY"),
+}
+
+def get_payload_settings(**overrides) -> Dict:
+    """Параметры подготовки кадра для LLM (размер, формат, качество, кроп)"""
+    settings = {
+        "max_side": ANALYSIS_MAX_SIDE,
+        "format": ANALYSIS_IMAGE_FORMAT,
+        "quality": ANALYSIS_IMAGE_QUALITY,
+        "crop": ANALYSIS_CROP,
+    }
+    settings.update({k: v for k, v in overrides.items() if v is not None})
+    if settings["format"] not in IMAGE_FORMATS:
+        raise ValueError(f"Unknown image format {settings['format']}, expected one of {list(IMAGE_FORMATS)}")
+    return settings
+
+def crop_boxes(frames: List, crop: str) -> List[tuple]:
+    """Область кропа (y0, y1, x0, x1) для каждого кадра.
+    auto — поля ищутся векторно по всей пачке кадров одного размера."""
+    boxes = [(0, frame.shape[0], 0, frame.shape[1]) for frame in frames]
+    if not crop or not frames:
+        return boxes
+    
+    if crop != "auto":
+        x0, y0, x1, y1 = (float(v) for v in crop.split(","))
+        return [
+            (int(y0 * h), max(int(y1 * h), int(y0 * h) + 1), int(x0 * w), max(int(x1 * w), int(x0 * w) + 1))
+            for h, w in (frame.shape[:2] for frame in frames)
+        ]
+    
+    by_shape: Dict[tuple, List[int]] = {}
+    for i, frame in enumerate(frames):
+        by_shape.setdefault(frame.shape, []).append(i)
+    for indices in by_shape.values():
+        # Максимум по каналам -> (N, H, W); строка/столбец — поле, если все пиксели темнее порога
+        luma = np.stack([frames[i] for i in indices]).max(axis=-1)
+        rows = luma.max(axis=2) > CROP_BLACK_LEVEL
+        cols = luma.max(axis=1) > CROP_BLACK_LEVEL
+        for i, row_mask, col_mask in zip(indices, rows, cols):
+            if not row_mask.any() or not col_mask.any():
+                continue  # полностью тёмный кадр — не режем
+            ys = np.flatnonzero(row_mask)
+            xs = np.flatnonzero(col_mask)
+            boxes[i] = (ys[0], ys[-1] + 1, xs[0], xs[-1] + 1)
+    return boxes
+
+def prepare_payloads(frames: List, settings: Optional[Dict] = None) -> List[tuple]:
+    """Пакетная подготовка кадров для LLM: кроп, уменьшение, кодирование -> [(bytes, mime_type)]"""
+    settings = settings or get_payload_settings()
+    ext, mime_type, quality_flag = IMAGE_FORMATS[settings["format"]]
+    payloads = []
+    for frame, (y0, y1, x0, x1) in zip(frames, crop_boxes(frames, settings["crop"])):
+        frame = frame[y0:y1, x0:x1]
+        height, width = frame.shape[:2]
+        scale = settings["max_side"] / max(height, width) if settings["max_side"] else 1
+        if scale < 1:
+            frame = cv2.resize(frame, (max(int(width * scale), 1), max(int(height * scale), 1)),
+                               interpolation=cv2.INTER_AREA)
+        _, buffer = cv2.imencode(ext, frame, [getattr(cv2, quality_flag), settings["quality"]])
+        payloads.append((buffer.tobytes(), mime_type))
+    return payloads
+
+def spill_scene(scene: Dict, frames_dir: Path, settings: Optional[Dict] = None) -> Dict:
+    """Сырой кадр сцены уходит на диск (.npy), в памяти остаются только JPEG и метаданные"""
+    frame = scene.pop("frame")
+    frame_path = frames_dir / f"{scene['timestamp']:08d}_{scene['phash']}.npy"
+    np.save(frame_path, frame)
+    scene["frame_path"] = str(frame_path)
+    scene["image"], scene["mime_type"] = prepare_payloads([frame], settings)[0]
+    return scene
+
+def drop_spilled_frame(scene: Dict):
+    path = scene.pop("frame_path", None)
+    if path:
+        Path(path).unlink(missing_ok=True)
+
+async def stream_scenes(video_path: Path, frames_dir: Path, policy: Optional[Dict] = None) -> AsyncIterator[Dict]:
+    """Декодирование, склейка сцен и подготовка кадров в потоке; сцены отдаются по мере готовности.
+    Ограниченная очередь даёт backpressure: декодер не убегает вперёд анализа."""
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=SCENE_QUEUE_SIZE)
+    stop = threading.Event()
+    done = object()
+    
+    def put(item) -> bool:
+        future = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+        while True:
+            try:
+                future.result(timeout=0.5)
+                return True
+            except FuturesTimeoutError:
+                if stop.is_set():
+                    future.cancel()
+                    return False
+    
+    def produce(queue_wait: float):
+        # OpenCV отпускает GIL на декодировании и resize, поэтому поток, а не процесс
+        started_at, started, cpu_started = time.time(), time.perf_counter(), time.thread_time()
+        scenes, bytes_out, error = 0, 0, False
+        try:
+            for scene in iter_scenes(sample_video_frames(video_path, policy)):
+                scene = spill_scene(scene, frames_dir)
+                scenes += 1
+                bytes_out += len(scene["image"])
+                if stop.is_set() or not put(scene):
+                    return
+        except Exception as e:
+            error = True
+            put(e)
+        else:
+            put(done)
+        finally:
+            # wall включает ожидание анализа (backpressure), CPU — только работу декодера
+            record_stage(
+                "decode", time.perf_counter() - started, cpu=time.thread_time() - cpu_started,
+                queue_wait=queue_wait, bytes_in=video_path.stat().st_size, bytes_out=bytes_out,
+                error=error, started_at=started_at, scenes=scenes
+            )
+    
+    waited = time.perf_counter()
+    async with stage_semaphores["decode"]:
+        producer = asyncio.ensure_future(asyncio.to_thread(produce, time.perf_counter() - waited))
+        try:
+            while True:
+                item = await queue.get()
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            await asyncio.gather(producer, return_exceptions=True)
+
+# === ШАРДИРОВАНИЕ ДЛИННЫХ ВИДЕО ===
+
+SHARD_SECONDS = float(os.getenv("SHARD_SECONDS", "0"))  # длина шарда, 0 = без шардирования
+SHARD_MIN_DURATION = float(os.getenv("SHARD_MIN_DURATION", "1800"))  # шардировать только видео длиннее
+# Каталог шардов; чтобы помогали другие узлы (python backend_main.py shard-worker),
+# он и UPLOAD_DIR должны быть на общем томе по одинаковому пути
+SHARD_DIR = Path(os.getenv("SHARD_DIR", str(FRAME_SPILL_DIR)))
+SHARD_CLAIM_TIMEOUT = float(os.getenv("SHARD_CLAIM_TIMEOUT", "300"))  # захват без heartbeat считается брошенным
+SHARD_POLL_INTERVAL = float(os.getenv("SHARD_POLL_INTERVAL", "0.5"))
+
+def probe_keyframes(video_path: Path) -> List[float]:
+    """Таймстемпы ключевых кадров: ffprobe по пакетам (без декодирования), иначе ffmpeg -skip_frame nokey"""
+    try:
+        result = subprocess.run([
+            "ffprobe", "-v", "error", "-select_streams", "v:0",
+            "-show_entries", "packet=pts_time,flags", "-of", "csv=p=0", str(video_path)
+        ], capture_output=True, text=True)
+        rows = [line.split(",") for line in result.stdout.splitlines()]
+        times = [float(row[0]) for row in rows if len(row) > 1 and "K" in row[-1] and row[0] not in ("", "N/A")]
+    except OSError:
+        result = subprocess.run([
+            "ffmpeg", "-hide_banner", "-skip_frame", "nokey", "-i", str(video_path),
+            "-vf", "showinfo", "-an", "-f", "null", "-"
+        ], capture_output=True, text=True)
+        times = [float(t) for t in re.findall(r"pts_time:\s*([0-9.]+)", result.stderr)]
+    return sorted(set(times))
+
+def plan_shards(keyframes: List[float], duration: float, shard_seconds: float) -> List[tuple]:
+    """Отрезки [start, end) примерно по shard_seconds; каждая граница — ключевой кадр"""
+    bounds = [0.0]
+    for keyframe in keyframes:
+        if keyframe - bounds[-1] >= shard_seconds and duration - keyframe >= shard_seconds / 2:
+            bounds.append(keyframe)
+    bounds.append(duration)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+async def plan_video_shards(video_path: Path, duration: float) -> List[tuple]:
+    if not SHARD_SECONDS or duration < max(SHARD_MIN_DURATION, 2 * SHARD_SECONDS):
+        return [(0.0, duration)]
+    keyframes = await asyncio.to_thread(probe_keyframes, video_path)
+    return plan_shards(keyframes, duration, SHARD_SECONDS)
+
+def write_json_atomic(path: Path, data):
+    tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+    tmp_path.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp_path, path)
+
+def shard_path(job_dir: Path, index: int, suffix: str = "") -> Path:
+    return job_dir / f"shard_{index:04d}{suffix}"
+
+def claim_shard(job_dir: Path, index: int) -> bool:
+    """Атомарный захват шарда (O_EXCL работает и между узлами на общем томе).
+    Захват без heartbeat дольше SHARD_CLAIM_TIMEOUT перехватывается: узел мог умереть.
+    Гонка двух перехватов даёт лишь двойную работу — scenes.json пишется атомарно."""
+    if shard_path(job_dir, index, ".json").exists():
+        return False
+    claim = shard_path(job_dir, index, ".claim")
+    try:
+        fd = os.open(claim, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        try:
+            stale = time.time() - claim.stat().st_mtime > SHARD_CLAIM_TIMEOUT
+        except FileNotFoundError:
+            stale = True
+        if not stale:
+            return False
+        claim.unlink(missing_ok=True)
+        try:
+            fd = os.open(claim, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+    with os.fdopen(fd, "w") as f:
+        f.write(f"{socket.gethostname()}:{os.getpid()}")
+    return True
+
+def decode_shard(job_dir: str, index: int) -> int:
+    """Декодирование и склейка сцен одного шарда (процесс пула или другой узел).
+    Кадры и payload'ы ложатся в каталог шарда, итог — shard_NNNN.json."""
+    job_dir = Path(job_dir)
+    job = json.loads((job_dir / "job.json").read_text(encoding="utf-8"))
+    start, end = job["shards"][index]
+    shard_dir = shard_path(job_dir, index)
+    shard_dir.mkdir(exist_ok=True)
+    claim = shard_path(job_dir, index, ".claim")
+    scenes = []
+    try:
+        samples = sample_video_frames(Path(job["video_path"]), job["policy"], start, end)
+        for scene in iter_scenes(samples, job["threshold"]):
+            scene = spill_scene(scene, shard_dir, job["payload"])
+            image_path = Path(scene["frame_path"]).with_suffix(".img")
+            image_path.write_bytes(scene.pop("image"))
+            scene["frame_path"] = Path(scene["frame_path"]).name
+            scene["image_path"] = image_path.name
+            scene["shard"] = index
+            scenes.append(scene)
+            claim.touch()  # heartbeat: шард ещё в работе
+        write_json_atomic(shard_path(job_dir, index, ".json"), scenes)
+    except Exception as e:
+        shard_path(job_dir, index, ".error").write_text(f"{socket.gethostname()}: {e}", encoding="utf-8")
+        raise
+    return len(scenes)
+
+def load_shard_scenes(job_dir: Path, index: int) -> List[Dict]:
+    shard_dir = shard_path(job_dir, index)
+    scenes = json.loads(shard_path(job_dir, index, ".json").read_text(encoding="utf-8"))
+    for scene in scenes:
+        image_path = shard_dir / scene.pop("image_path")
+        scene["image"] = image_path.read_bytes()
+        image_path.unlink(missing_ok=True)
+        scene["frame_path"] = str(shard_dir / scene["frame_path"])
+    return scenes
+
+async def wait_for_shard(job_dir: Path, index: int) -> List[Dict]:
+    """Сцены шарда; если его никто не взял (или взявший узел пропал) — декодируем сами"""
+    while not shard_path(job_dir, index, ".json").exists():
+        error = shard_path(job_dir, index, ".error")
+        if error.exists():
+            raise RuntimeError(f"Shard {index} failed: {error.read_text(encoding='utf-8')}")
+        if claim_shard(job_dir, index):
+            await run_in_worker("decode", decode_shard, str(job_dir), index)
+            continue
+        await asyncio.sleep(SHARD_POLL_INTERVAL)
+    return await asyncio.to_thread(load_shard_scenes, job_dir, index)
+
+async def stream_sharded_scenes(video_path: Path, frames_dir: Path, shards: List[tuple],
+                                policy: Optional[Dict] = None) -> AsyncIterator[Dict]:
+    """Шарды декодируются параллельно (до STAGE_LIMIT_DECODE процессов на узел плюс shard-worker'ы),
+    сцены отдаются по порядку. Сцена, разрезанная границей шарда, склеивается обратно."""
+    job_dir = SHARD_DIR / frames_dir.name
+    job_dir.mkdir(parents=True, exist_ok=True)
+    write_json_atomic(job_dir / "job.json", {
+        "video_path": str(video_path.resolve()),
+        "shards": shards,
+        "policy": policy or get_sampling_policy(),
+        "payload": get_payload_settings(),
+        "threshold": SCENE_HASH_THRESHOLD,
+    })
+    
+    async def work():
+        for index in range(len(shards)):
+            if claim_shard(job_dir, index):
+                await run_in_worker("decode", decode_shard, str(job_dir), index)
+    
+    workers = [asyncio.create_task(work()) for _ in range(STAGE_LIMITS["decode"])]
+    previous = None
+    try:
+        for index in range(len(shards)):
+            for scene in await wait_for_shard(job_dir, index):
+                if previous is not None:
+                    distance = bin(int(previous["phash"], 16) ^ int(scene["phash"], 16)).count("1")
+                    if distance <= SCENE_HASH_THRESHOLD:
+                        previous["end"] = scene["end"]
+                        previous["frame_count"] += scene["frame_count"]
+                        drop_spilled_frame(scene)
+                        continue
+                    yield previous
+                previous = scene
+        if previous is not None:
+            yield previous
+    finally:
+        # Без job.json другие узлы перестают брать шарды этой задачи
+        (job_dir / "job.json").unlink(missing_ok=True)
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+def run_shard_worker():
+    """Узел-помощник: декодирует незанятые шарды всех задач в общем SHARD_DIR"""
+    print(f"Shard worker on {socket.gethostname()} watching {SHARD_DIR}")
+    while True:
+        for job_file in sorted(SHARD_DIR.glob("*/job.json")):
+            try:
+                count = len(json.loads(job_file.read_text(encoding="utf-8"))["shards"])
+                for index in range(count):
+                    if claim_shard(job_file.parent, index):
+                        scenes = decode_shard(str(job_file.parent), index)
+                        print(f"{job_file.parent.name} shard {index}: {scenes} scenes")
+            except Exception as e:
+                # Задача могла завершиться и удалить каталог, пока мы работали
+                print(f"Shard worker error in {job_file.parent.name}: {e}")
+        time.sleep(SHARD_POLL_INTERVAL)
+
+# === AI АНАЛИЗ И УДАЛЕНИЕ "ВОДЫ" ===
+
+frame_analysis_stats = Counter()  # запросы, фреймы, сбои разбора пачек — для /llm/stats
+
+def frame_cache_key(fingerprint: Optional[str]) -> Optional[str]:
+    """Ключ кэша анализа фрейма; одинаков для одиночного и пакетного режима"""
+    if not fingerprint:
+        return None
+    return cache_key("frame", fingerprint, PROMPT_VERSION, GEMINI_MODEL, get_payload_settings())
+
+def count_frame_analysis(mode: str, frames: int):
+    frame_analysis_stats[f"{mode}_requests"] += 1
+    frame_analysis_stats[f"{mode}_frames"] += frames
+    metrics.inc("frame_analysis_requests_total", mode=mode)
+    metrics.inc("frame_analysis_frames_total", frames, mode=mode)
+
+async def analyze_frame(model, timestamp: int, image_data: bytes, fingerprint: Optional[str] = None,
+                        mime_type: str = "image/jpeg") -> Optional[Dict]:
+    """Анализ одного подготовленного фрейма через Gemini (с кэшем по отпечатку фрейма и версии промпта)"""
+    key = frame_cache_key(fingerprint)
+    if key:
+        cached = result_cache.get_json(key, kind="frame_analysis")
+        if cached is not None:
+            return cached
+    
+    prompt = """Проанализируй этот фрейм из образовательного видео.
+    Определи:
+    1. Это ключевой момент с важной информацией? (да/нет)
+    2. Краткое описание содержания (1 предложение)
+    3. Уровень важности (1-10)
+    
+    Верни JSON:
+    {
+        "is_key_moment": true/false,
+        "description": "...",
+        "importance": 8,
+        "topic": "название темы"
+    }"""
+    
+    try:
+        count_frame_analysis("single", 1)
+        result = await generate_structured(
+            model, [prompt, {"mime_type": mime_type, "data": image_data}], FrameAnalysis, name="analyze_frame"
+        )
+        analysis = result.model_dump()
+        if key:
+            result_cache.put_json(key, analysis, kind="frame_analysis")
+        return analysis
+    except Exception as e:
+        print(f"Analysis error at {timestamp}s: {e}")
+        return None
+
+def parse_batch_analysis(text: str, count: int) -> List[Optional[Dict]]:
+    """Разбор JSON-массива пакетного ответа; фреймы без валидного ответа — None"""
+    results: List[Optional[Dict]] = [None] * count
+    for position, item in enumerate(parse_structured_items(text, FrameBatchItem)):
+        if item is None:
+            continue
+        index = item.frame or position + 1
+        if 1 <= index <= count and results[index - 1] is None:
+            results[index - 1] = item.model_dump(exclude={"frame"})
+    return results
+
+async def analyze_frames_batch(model, scenes: List[Dict]) -> List[Optional[Dict]]:
+    """Анализ пачки фреймов одним запросом (фреймы с таймстемпами, в ответ — JSON-массив).
+    Закэшированные фреймы в запрос не попадают; недостающие ответы добираются по одному."""
+    results: List[Optional[Dict]] = [None] * len(scenes)
+    keys = [frame_cache_key(scene["fingerprint"]) for scene in scenes]
+    missing = []
+    for i, key in enumerate(keys):
+        cached = result_cache.get_json(key, kind="frame_analysis") if key else None
+        if cached is not None:
+            results[i] = cached
+        else:
+            missing.append(i)
+    
+    if len(missing) > 1:
+        prompt = f"""Проанализируй {len(missing)} фреймов из образовательного видео.
+    Перед каждым фреймом указаны его номер и таймстемп.
+    Для КАЖДОГО фрейма определи:
+    1. Это ключевой момент с важной информацией? (да/нет)
+    2. Краткое описание содержания (1 предложение)
+    3. Уровень важности (1-10)
+    
+    Верни JSON-массив из {len(missing)} объектов в порядке фреймов:
+    [
+        {{
+            "frame": 1,
             "is_key_moment": true/false,
             "description": "...",
             "importance": 8,
             "topic": "название темы"
-        }"""
+        }}
+    ]"""
+        contents = [prompt]
+        for number, i in enumerate(missing, 1):
+            contents.append(f"Фрейм {number}, {scenes[i]['timestamp']}s:")
+            contents.append({"mime_type": scenes[i]["mime_type"], "data": scenes[i]["image"]})
         
         try:
-            response = await asyncio.to_thread(
-                model.generate_content,
-                [prompt, {"mime_type": "image/jpeg", "data": image_data}]
+            count_frame_analysis("batch", len(missing))
+            response = await llm_scheduler.run(
+                model.generate_content, contents, name="analyze_frames_batch",
+                **json_generation_kwargs(List[FrameBatchItem])
             )
-            
-            text = response.text.strip()
-            if "```json" in text:
-                text = text.split("```json")[1].split("```")[0]
-            
-            analysis = json.loads(text)
-            
-            if analysis.get("is_key_moment") and analysis.get("importance", 0) >= 6:
-                key_moments.append({
-                    "timestamp": timestamp,
-                    "frame": frame,
-                    "analysis": analysis
-                })
+            parsed = parse_batch_analysis(response.text, len(missing))
         except Exception as e:
-            print(f"Analysis error at {timestamp}s: {e}")
+            print(f"Batch analysis error at {scenes[missing[0]]['timestamp']}s: {e}")
+            frame_analysis_stats["parse_failures"] += 1
+            metrics.inc("frame_analysis_parse_failures_total")
+            parsed = [None] * len(missing)
+        if any(analysis is None for analysis in parsed):
+            metrics.inc("llm_reasks_total", call="analyze_frames_batch")
+        
+        for i, analysis in zip(missing, parsed):
+            if analysis is not None:
+                results[i] = analysis
+                if keys[i]:
+                    result_cache.put_json(keys[i], analysis, kind="frame_analysis")
+        missing = [i for i in missing if results[i] is None]
+        frame_analysis_stats["fallback_frames"] += len(missing)
+        metrics.inc("frame_analysis_fallback_frames_total", len(missing))
     
-    # Подсчёт удалённой "воды"
-    water_removed = ((len(sample_frames) - len(key_moments)) / len(sample_frames)) * 100
+    # Пачка из одного фрейма или невалидные ответы — одиночный запрос только за ними
+    fallback = await asyncio.gather(*[
+        analyze_frame(model, scenes[i]["timestamp"], scenes[i]["image"], scenes[i]["fingerprint"],
+                      scenes[i]["mime_type"])
+        for i in missing
+    ])
+    for i, analysis in zip(missing, fallback):
+        results[i] = analysis
+    return results
+
+def merge_topic_names(key_moments: List[Dict]):
+    """Одна тема — одно имя: варианты, отличающиеся регистром/пробелами/пунктуацией
+    (частый случай на стыке шардов и пачек), сводятся к первому встреченному написанию"""
+    names = {}
+    for moment in key_moments:
+        topic = moment["analysis"].get("topic", "Прочее")
+        normalized = " ".join(re.sub(r"[^\w\s]", " ", topic.lower()).split())
+        moment["analysis"]["topic"] = names.setdefault(normalized, topic)
+
+async def analyze_video_content(video_path: Path, frames_dir: Path) -> Dict:
+    """Полный AI-анализ видео для определения ключевых моментов.
+    Сцены уходят в Gemini по мере декодирования; сырые кадры ключевых сцен лежат в frames_dir."""
+    duration = probe_video(video_path)["duration"]
+    model = get_generative_model()
+    frames_dir.mkdir(parents=True, exist_ok=True)
+    
+    async def analyze_scenes(batch: List[Dict]) -> List[Optional[Dict]]:
+        analyses = await analyze_frames_batch(model, batch)
+        for scene, analysis in zip(batch, analyses):
+            del scene["image"], scene["mime_type"]
+            if not (analysis and analysis.get("is_key_moment") and analysis.get("importance", 0) >= 6):
+                drop_spilled_frame(scene)  # кадр не понадобится для слайда
+        return analyses
+    
+    # Без лимита сцен анализ стартует по мере набора пачек; с лимитом нужно дождаться всех сцен,
+    # чтобы выбрать самые длинные (в памяти при этом только JPEG и метаданные)
+    shards = await plan_video_shards(video_path, duration)
+    if len(shards) > 1:
+        scene_stream = stream_sharded_scenes(video_path, frames_dir, shards)
+    else:
+        scene_stream = stream_scenes(video_path, frames_dir)
+    
+    scenes = []
+    pending = []
+    batch = []
+    try:
+        async for scene in scene_stream:
+            scenes.append(scene)
+            if not MAX_ANALYZED_SCENES:
+                batch.append(scene)
+                if len(batch) >= LLM_BATCH_SIZE:
+                    pending.append(asyncio.create_task(analyze_scenes(batch)))
+                    batch = []
+        if batch:
+            pending.append(asyncio.create_task(analyze_scenes(batch)))
+        
+        analyzed_scenes = limit_scenes(scenes, MAX_ANALYZED_SCENES)
+        if MAX_ANALYZED_SCENES:
+            kept = {id(scene) for scene in analyzed_scenes}
+            for scene in scenes:
+                if id(scene) not in kept:
+                    drop_spilled_frame(scene)
+            pending = [
+                asyncio.create_task(analyze_scenes(analyzed_scenes[i:i + LLM_BATCH_SIZE]))
+                for i in range(0, len(analyzed_scenes), LLM_BATCH_SIZE)
+            ]
+        
+        analyses = [analysis for batch_analyses in await asyncio.gather(*pending) for analysis in batch_analyses]
+    finally:
+        # Отмена задачи или ошибка декодера: уже запущенный анализ не должен писать в кэш
+        # и трогать кадры после того, как вызывающий код удалит frames_dir
+        await scene_stream.aclose()
+        unfinished = [task for task in pending if not task.done()]
+        for task in unfinished:
+            task.cancel()
+        await asyncio.gather(*unfinished, return_exceptions=True)
+    
+    key_moments = []
+    for scene, analysis in zip(analyzed_scenes, analyses):
+        if analysis and analysis.get("is_key_moment") and analysis.get("importance", 0) >= 6:
+            key_moments.append({
+                "timestamp": scene["timestamp"],
+                "frame_path": scene["frame_path"],
+                "phash": scene["phash"],
+                "fingerprint": scene["fingerprint"],
+                "frame_count": scene["frame_count"],
+                "shard": scene.get("shard", 0),
+                "analysis": analysis
+            })
+    merge_topic_names(key_moments)
+    
+    # Подсчёт удалённой "воды": доля сэмплов (времени), не попавших в ключевые сцены
+    frames_sampled = sum(scene["frame_count"] for scene in scenes)
+    kept_samples = sum(m["frame_count"] for m in key_moments)
+    water_removed = (1 - kept_samples / frames_sampled) * 100 if frames_sampled else 0.0
     
     return {
         "key_moments": key_moments,
         "original_duration": duration,
-        "water_removed_percent": min(water_removed, 30),  # до 30%
+        "frames_sampled": frames_sampled,
+        "frames_deduplicated": frames_sampled - len(scenes),
+        "scenes_analyzed": len(analyzed_scenes),
+        "shards": len(shards),
+        "water_removed_percent": round(water_removed, 1),
         "key_topics": list(set([m["analysis"]["topic"] for m in key_moments]))
     }
 
 # === ГЕНЕРАЦИЯ PDF СЛАЙДОВ ===
 
+SHARED_FRAMES_DIR = Path("/dev/shm") if Path("/dev/shm").is_dir() else Path(tempfile.gettempdir())
+
+@lru_cache(maxsize=1)
+def load_slide_fonts():
+    """Шрифты слайдов загружаются один раз на процесс (в каждом воркере пула)"""
+    try:
+        title_font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 60)
+        desc_font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 40)
+        num_font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 80)
+    except:
+        title_font = desc_font = num_font = ImageFont.load_default()
+    return title_font, desc_font, num_font
+
 def create_educational_slide(frame, analysis: Dict, slide_num: int, output_path: Path) -> Path:
     """Создание красивого образовательного слайда из фрейма"""
     img = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
@@ -169,13 +2430,7 @@ def create_educational_slide(frame, analysis: Dict, slide_num: int, output_path:
     slide.paste(img, (img_x, img_y))
     
     draw = ImageDraw.Draw(slide)
-    
-    try:
-        title_font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 60)
-        desc_font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 40)
-        num_font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 80)
-    except:
-        title_font = desc_font = num_font = ImageFont.load_default()
+    title_font, desc_font, num_font = load_slide_fonts()
     
     # Номер слайда
     draw.text((50, 30), f"{slide_num}", fill=(250, 204, 21), font=num_font)
@@ -207,63 +2462,322 @@ def create_educational_slide(frame, analysis: Dict, slide_num: int, output_path:
     for i, line in enumerate(lines[:2]):  # Максимум 2 строки
         draw.text((100, desc_y + i * 50), line, fill=(226, 232, 240), font=desc_font)
     
-    slide.save(output_path, quality=95)
-    return output_path
+    slide.save(output_path, quality=95)
+    return output_path
+
+def placeholder_frame():
+    """Кадр цвета фона слайда для моментов, чей фрейм не удалось прочитать"""
+    return np.full((720, 1280, 3), (42, 23, 15), dtype=np.uint8)  # BGR
+
+def render_slide_from_shared(frames_path: str, offset: int, shape: tuple, analysis: Dict,
+                             slide_num: int, output_path: Path) -> Path:
+    """Воркер пула: фрейм читается из разделяемого memmap-файла, без pickle массива"""
+    frames = np.memmap(frames_path, dtype=np.uint8, mode="r")
+    frame = frames[offset:offset + int(np.prod(shape))].reshape(shape)
+    return create_educational_slide(frame, analysis, slide_num, output_path)
+
+def render_slide_from_spill(frame_path: str, analysis: Dict, slide_num: int, output_path: Path) -> Path:
+    """Воркер пула: фрейм уже лежит на диске после анализа (.npy), отображается в память"""
+    return create_educational_slide(np.load(frame_path, mmap_mode="r"), analysis, slide_num, output_path)
+
+async def render_slides_parallel(jobs: List) -> List[Path]:
+    """Пакетный рендер слайдов [(frame, analysis, slide_num, output_path)] в пуле процессов.
+    frame — массив или путь к сброшенному .npy. Массивы один раз пишутся в файл в /dev/shm,
+    воркеры отображают его в память."""
+    if not jobs:
+        return []
+    arrays = [frame for frame, *_ in jobs if isinstance(frame, np.ndarray)]
+    offsets = {}
+    total = 0
+    for frame in arrays:
+        offsets[id(frame)] = total
+        total += frame.nbytes
+    
+    frames_path = SHARED_FRAMES_DIR / f"lucygenx_frames_{uuid.uuid4().hex}.bin"
+    try:
+        if arrays:
+            shared = np.memmap(frames_path, dtype=np.uint8, mode="w+", shape=(total,))
+            for frame in arrays:
+                offset = offsets[id(frame)]
+                shared[offset:offset + frame.nbytes] = np.ascontiguousarray(frame, dtype=np.uint8).reshape(-1)
+            shared.flush()
+            del shared
+        
+        return await asyncio.gather(*[
+            run_in_worker(
+                "render", render_slide_from_shared,
+                str(frames_path), offsets[id(frame)], frame.shape, analysis, slide_num, output_path
+            ) if isinstance(frame, np.ndarray) else run_in_worker(
+                "render", render_slide_from_spill, str(frame), analysis, slide_num, output_path
+            )
+            for frame, analysis, slide_num, output_path in jobs
+        ])
+    finally:
+        frames_path.unlink(missing_ok=True)
+
+PDF_PROFILES = {
+    "fast": {"dpi": 0, "quality": 0, "compress_pages": False},  # слайды встраиваются как есть, без перекодирования
+    "balanced": {"dpi": 150, "quality": 75, "compress_pages": True},
+    "small": {"dpi": 100, "quality": 60, "compress_pages": True},
+}
+PDF_PROFILE = os.getenv("PDF_PROFILE", "balanced")
+PDF_IMAGE_WIDTH_IN = 6.0  # ширина слайда на странице A4, дюймы
+PDF_FONT_PATHS = (
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
+)
+
+def get_pdf_settings(profile: Optional[str] = None) -> Dict:
+    """Параметры картинок PDF по профилю (PDF_PROFILE по умолчанию)"""
+    name = profile or PDF_PROFILE
+    if name not in PDF_PROFILES:
+        raise ValueError(f"Unknown PDF profile {name}, expected one of {list(PDF_PROFILES)}")
+    return {"profile": name, **PDF_PROFILES[name]}
+
+@lru_cache(maxsize=1)
+def register_pdf_fonts() -> tuple:
+    """TTF с кириллицей для PDF (встроенная Helvetica её не содержит); один раз на процесс"""
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+    try:
+        pdfmetrics.registerFont(TTFont("DejaVuSans", PDF_FONT_PATHS[0]))
+        pdfmetrics.registerFont(TTFont("DejaVuSans-Bold", PDF_FONT_PATHS[1]))
+        return "DejaVuSans", "DejaVuSans-Bold"
+    except Exception as e:
+        print(f"PDF fonts not found, falling back to Helvetica: {e}")
+        return "Helvetica", "Helvetica-Bold"
+
+def prepare_pdf_image(slide_path: Path, settings: Dict, work_dir: Path, seen: Dict[str, Path]) -> Path:
+    """Картинка слайда под печатный размер. Одинаковые слайды дают один файл,
+    а reportlab кэширует XObject по имени файла — картинка попадает в PDF один раз."""
+    digest = hashlib.sha1(slide_path.read_bytes()).hexdigest()
+    if digest in seen:
+        return seen[digest]
+    if not settings["dpi"]:
+        seen[digest] = slide_path
+        return slide_path
+    
+    target_width = int(PDF_IMAGE_WIDTH_IN * settings["dpi"])
+    with Image.open(slide_path) as img:
+        target_height = round(img.height * target_width / img.width)
+        img.draft("RGB", (target_width, target_height))  # JPEG декодируется сразу в уменьшенном масштабе
+        img = img.convert("RGB")
+        if img.width > target_width:
+            img = img.resize((target_width, target_height), Image.Resampling.LANCZOS)
+        image_path = work_dir / f"{digest}.jpg"
+        img.save(image_path, "JPEG", quality=settings["quality"], optimize=True)
+    seen[digest] = image_path
+    return image_path
+
+def generate_pdf_from_slides(slides: List[Path], analysis_data: Dict, output_path: Path,
+                             profile: Optional[str] = None) -> Path:
+    """Генерация PDF курса постранично на canvas: титул, оглавление, по слайду на страницу"""
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.units import inch
+    from reportlab.lib.colors import HexColor
+    from reportlab.lib.utils import simpleSplit
+    from reportlab.pdfgen import canvas
+    from reportlab import rl_config
+    
+    rl_config.useA85 = 0  # JPEG встраивается бинарно, без ASCII85 (+25% размера и лишний проход)
+    settings = get_pdf_settings(profile)
+    regular, bold = register_pdf_fonts()
+    width, height = A4
+    margin = inch
+    pdf = canvas.Canvas(str(output_path), pagesize=A4, pageCompression=int(settings["compress_pages"]))
+    pdf.setTitle("Образовательный курс")
+    
+    # Титульная страница
+    pdf.setFillColor(HexColor('#FACC15'))
+    pdf.setFont(bold, 36)
+    pdf.drawCentredString(width / 2, height - 3 * inch, "Образовательный курс")
+    pdf.setFillColor(HexColor('#000000'))
+    pdf.setFont(regular, 12)
+    pdf.drawCentredString(width / 2, height - 3 * inch - 36, "Сгенерировано LucyGenX AI")
+    
+    # Статистика
+    y = height - 4 * inch
+    for label, value in (
+        ("Исходная длительность:", f"{analysis_data.get('original_duration', 0):.1f} сек"),
+        ("Удалено воды:", f"{analysis_data.get('water_removed_percent', 0):.1f}%"),
+        ("Ключевых моментов:", str(len(slides))),
+    ):
+        pdf.setFont(bold, 12)
+        pdf.drawString(margin, y, label)
+        pdf.setFont(regular, 12)
+        pdf.drawString(margin + pdf.stringWidth(label, bold, 12) + 6, y, value)
+        y -= 18
+    pdf.showPage()
+    
+    # Оглавление (переносится на следующие страницы)
+    pdf.setFont(bold, 24)
+    pdf.drawString(margin, height - margin, "Содержание")
+    y = height - margin - 36
+    for i, topic in enumerate(analysis_data.get('key_topics', []), 1):
+        for line in simpleSplit(f"{i}. {topic}", regular, 12, width - 2 * margin):
+            if y < margin:
+                pdf.showPage()
+                y = height - margin
+            pdf.setFont(regular, 12)
+            pdf.drawString(margin, y, line)
+            y -= 16
+    pdf.showPage()
+    
+    # Слайды: картинки готовятся и декодируются по одной. Готовые страницы (сжатый поток
+    # и JPEG) canvas держит в памяти до save(), так что пик памяти ~ размер итогового PDF.
+    # Частичные canvas со склейкой через pypdf пик не снижают: PdfWriter держит все объекты до write()
+    image_width = PDF_IMAGE_WIDTH_IN * inch
+    image_height = image_width * 9 / 16
+    with tempfile.TemporaryDirectory(prefix="pdf_") as work_dir:
+        seen: Dict[str, Path] = {}
+        for i, slide_path in enumerate(slides, 1):
+            image_path = prepare_pdf_image(Path(slide_path), settings, Path(work_dir), seen)
+            pdf.setFont(bold, 18)
+            pdf.drawString(margin, height - margin, f"Слайд {i}")
+            pdf.drawImage(
+                str(image_path), (width - image_width) / 2, height - margin - 24 - image_height,
+                image_width, image_height, preserveAspectRatio=True, anchor="n"
+            )
+            pdf.showPage()
+        pdf.save()
+    return output_path
+
+# === ГЕНЕРАЦИЯ AI ОЗВУЧКИ ===
+
+TTS_ENGINE = os.getenv("TTS_ENGINE", "auto")  # auto | piper | espeak | silent
+TTS_VOICE = os.getenv("TTS_VOICE", "ru")  # голос espeak-ng
+TTS_RATE = int(os.getenv("TTS_RATE", "160"))  # слов в минуту для espeak-ng
+PIPER_MODEL = os.getenv("PIPER_MODEL", "")  # путь к .onnx модели Piper
+SILENT_SECONDS_PER_WORD = 0.4
+VOICEOVER_SCRIPT_VERSION = "voiceover-script-v1"
+
+async def run_tts_process(args: List[str], text: Optional[str] = None):
+    """CLI синтеза/перекодирования (текст на stdin, если передан); убивается при отмене задачи.
+    Лимит параллельности держит вызывающий (stage_semaphores["tts"])."""
+    proc = await asyncio.create_subprocess_exec(
+        *args,
+        stdin=asyncio.subprocess.PIPE if text is not None else asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        _, stderr = await proc.communicate(text.encode("utf-8") if text is not None else None)
+    except asyncio.CancelledError:
+        proc.kill()
+        await proc.wait()
+        raise
+    if proc.returncode != 0:
+        raise RuntimeError(f"{Path(args[0]).name} failed: {stderr.decode(errors='ignore')[-500:]}")
+
+class TTSEngine:
+    """Локальный синтез речи: текст -> WAV через внешний CLI (текст на stdin)"""
+    name = "base"
+    reads_stdin = True
+    
+    def available(self) -> bool:
+        return False
+    
+    def command(self, text: str, wav_path: Path) -> List[str]:
+        raise NotImplementedError
+    
+    def cache_id(self) -> List:
+        """Всё, от чего зависит звук (движок, голос, модель) — часть ключа кэша"""
+        return [self.name]
+    
+    async def synthesize(self, text: str, wav_path: Path):
+        await run_tts_process(self.command(text, wav_path), text if self.reads_stdin else None)
+        if not wav_path.exists():
+            raise RuntimeError(f"{self.name} produced no audio")
+
+class PiperTTSEngine(TTSEngine):
+    """Piper (нейросетевой VITS на onnxruntime, CPU)"""
+    name = "piper"
+    
+    def available(self) -> bool:
+        return bool(PIPER_MODEL) and Path(PIPER_MODEL).exists() and shutil.which("piper") is not None
+    
+    def command(self, text: str, wav_path: Path) -> List[str]:
+        return ["piper", "--model", PIPER_MODEL, "--output_file", str(wav_path)]
+    
+    def cache_id(self) -> List:
+        return [self.name, Path(PIPER_MODEL).name]
+
+class EspeakTTSEngine(TTSEngine):
+    """espeak-ng (формантный синтез, без моделей)"""
+    name = "espeak"
+    
+    def binary(self) -> Optional[str]:
+        return shutil.which("espeak-ng") or shutil.which("espeak")
+    
+    def available(self) -> bool:
+        return self.binary() is not None
+    
+    def command(self, text: str, wav_path: Path) -> List[str]:
+        return [self.binary(), "-v", TTS_VOICE, "-s", str(TTS_RATE), "--stdin", "-w", str(wav_path)]
+    
+    def cache_id(self) -> List:
+        return [self.name, TTS_VOICE, TTS_RATE]
+
+class SilentTTSEngine(TTSEngine):
+    """Тишина длиной ~0.4 сек/слово — когда локального синтеза нет"""
+    name = "silent"
+    reads_stdin = False
+    
+    def available(self) -> bool:
+        return True
+    
+    def command(self, text: str, wav_path: Path) -> List[str]:
+        duration = max(len(text.split()) * SILENT_SECONDS_PER_WORD, 1.0)
+        return [
+            "ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "error",
+            "-f", "lavfi", "-i", f"anullsrc=r=22050:cl=mono:duration={duration}",
+            str(wav_path), "-y"
+        ]
+
+TTS_ENGINES = {engine.name: engine for engine in (PiperTTSEngine(), EspeakTTSEngine(), SilentTTSEngine())}
 
-def generate_pdf_from_slides(slides: List[Path], analysis_data: Dict, output_path: Path):
-    """Генерация PDF документа из слайдов с оглавлением"""
-    doc = SimpleDocTemplate(str(output_path), pagesize=A4)
-    story = []
-    styles = getSampleStyleSheet()
+@lru_cache(maxsize=1)
+def get_tts_engine() -> TTSEngine:
+    """Движок TTS по TTS_ENGINE; auto — первый доступный из piper, espeak, silent"""
+    if TTS_ENGINE != "auto":
+        engine = TTS_ENGINES[TTS_ENGINE]
+        if engine.available():
+            return engine
+        print(f"TTS engine {TTS_ENGINE} is not available, falling back to auto")
+    return next(engine for engine in TTS_ENGINES.values() if engine.available())
+
+class TTSStats:
+    """Realtime factor синтеза: секунды работы движка на секунду аудио"""
     
-    # Титульная страница
-    title_style = ParagraphStyle(
-        'CustomTitle',
-        parent=styles['Heading1'],
-        fontSize=36,
-        textColor=colors.HexColor('#FACC15'),
-        spaceAfter=30,
-        alignment=1  # Center
-    )
+    def __init__(self):
+        self.latency = LatencyStats()
+        self.synth_seconds = 0.0
+        self.audio_seconds = 0.0
+        self.fallbacks = 0  # сбои движка, озвученные тишиной — в realtime factor не входят
     
-    story.append(Spacer(1, 2*inch))
-    story.append(Paragraph("Образовательный курс", title_style))
-    story.append(Paragraph("Сгенерировано LucyGenX AI", styles['Normal']))
-    story.append(Spacer(1, 0.5*inch))
+    def record(self, synth_seconds: float, audio_seconds: float):
+        self.latency.record(synth_seconds)
+        self.synth_seconds += synth_seconds
+        self.audio_seconds += audio_seconds
     
-    # Статистика
-    stats_text = f"""
-    <b>Исходная длительность:</b> {analysis_data.get('original_duration', 0):.1f} сек<br/>
-    <b>Удалено воды:</b> {analysis_data.get('water_removed_percent', 0):.1f}%<br/>
-    <b>Ключевых моментов:</b> {len(slides)}<br/>
-    """
-    story.append(Paragraph(stats_text, styles['Normal']))
-    story.append(PageBreak())
-    
-    # Оглавление
-    story.append(Paragraph("Содержание", styles['Heading1']))
-    for i, topic in enumerate(analysis_data.get('key_topics', []), 1):
-        story.append(Paragraph(f"{i}. {topic}", styles['Normal']))
-    story.append(PageBreak())
-    
-    # Слайды
-    for i, slide_path in enumerate(slides, 1):
-        img = ImageReader(str(slide_path))
-        story.append(Paragraph(f"Слайд {i}", styles['Heading2']))
-        story.append(Spacer(1, 0.2*inch))
-        # Масштабируем под A4
-        story.append(Image(str(slide_path), width=6*inch, height=3.375*inch))
-        story.append(PageBreak())
-    
-    doc.build(story)
-    return output_path
+    def record_fallback(self):
+        self.fallbacks += 1
+    
+    def snapshot(self) -> Dict:
+        return {
+            "engine": get_tts_engine().name,
+            "concurrency": STAGE_LIMITS["tts"],
+            "synthesis": self.latency.snapshot(),
+            "audio_seconds": round(self.audio_seconds, 2),
+            "realtime_factor": round(self.synth_seconds / self.audio_seconds, 4) if self.audio_seconds else None,
+            "fallbacks": self.fallbacks,
+        }
 
-# === ГЕНЕРАЦИЯ AI ОЗВУЧКИ ===
+tts_stats = TTSStats()
 
-async def generate_voiceover_for_slide(text: str, slide_num: int, output_path: Path) -> Path:
-    """Генерация озвучки через Gemini или Google Cloud TTS"""
-    # Для MVP используем Gemini для генерации скрипта, затем TTS
-    model = genai.GenerativeModel('gemini-2.0-flash-exp')
+async def generate_voiceover_script(text: str, slide_num: int) -> str:
+    """Скрипт озвучки слайда через Gemini; при ошибке читаем описание слайда как есть"""
+    model = get_generative_model()
     
     prompt = f"""Создай короткий образовательный скрипт для озвучки слайда №{slide_num}.
     Контент слайда: {text}
@@ -276,98 +2790,272 @@ async def generate_voiceover_for_slide(text: str, slide_num: int, output_path: P
     Верни только текст скрипта, без комментариев."""
     
     try:
-        response = await asyncio.to_thread(model.generate_content, prompt)
-        script = response.text.strip()
+        response = await llm_scheduler.run(model.generate_content, prompt, name="voiceover")
+        return response.text.strip()
+    except Exception as e:
+        print(f"Voiceover script error: {e}")
+        return ""
+
+async def synthesize_speech(script: str, output_path: Path) -> tuple:
+    """Синтез скрипта в MP3 локальным движком; возвращает (реальная длительность в секундах,
+    движок, который действительно озвучил: при сбое — silent)"""
+    engine = requested = get_tts_engine()
+    wav_path = output_path.with_suffix(".wav")
+    try:
+        waited = time.perf_counter()
+        async with stage_semaphores["tts"], track_stage("tts", engine=engine.name) as span:
+            span["queue_wait"] = time.perf_counter() - waited
+            span["bytes_in"] = len(script.encode("utf-8"))
+            started = time.perf_counter()
+            try:
+                await engine.synthesize(script, wav_path)
+            except Exception as e:
+                print(f"TTS error ({engine.name}): {e}")
+                engine = TTS_ENGINES["silent"]
+                await engine.synthesize(script, wav_path)
+            synth_seconds = time.perf_counter() - started
+            
+            await run_tts_process([
+                "ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "error",
+                "-i", str(wav_path), "-acodec", "libmp3lame", "-q:a", "4",
+                "-metadata", f"title={script[:50]}", str(output_path), "-y"
+            ])
+            span["bytes_out"] = output_path.stat().st_size
+    finally:
+        wav_path.unlink(missing_ok=True)
+    
+    duration = await probe_media_duration(output_path)
+    if engine is requested:
+        tts_stats.record(synth_seconds, duration)
+    else:
+        tts_stats.record_fallback()
+    return duration, engine
+
+async def generate_voiceover_for_slide(text: str, slide_num: int, output_path: Path) -> float:
+    """Озвучка слайда: скрипт (кэш по тексту слайда) -> аудио (кэш по хэшу скрипта).
+    Возвращает реальную длительность аудио для сборки видео."""
+    script = await cached_json(
+        "voiceover_script", cache_key(VOICEOVER_SCRIPT_VERSION, text, slide_num, GEMINI_MODEL),
+        lambda: generate_voiceover_script(text, slide_num)
+    )
+    script = script or text or f"Слайд {slide_num}"
+    
+    engine = get_tts_engine()
+    audio_key = cache_key("tts", script, engine.cache_id())
+    if await asyncio.to_thread(result_cache.get_file, audio_key, output_path, "voiceover"):
+        return await probe_media_duration(output_path)
+    duration, used_engine = await synthesize_speech(script, output_path)
+    # Тишина после сбоя движка не кэшируется под ключом настоящего движка
+    if used_engine is engine:
+        await asyncio.to_thread(result_cache.put_file, audio_key, output_path, "voiceover")
+    return duration
+
+# === СБОРКА НОВОГО ВИДЕО ===
+
+VIDEO_ENCODE_PROFILES = {
+    "fast": {"preset": "veryfast", "crf": 28},
+    "balanced": {"preset": "medium", "crf": 23},
+    "quality": {"preset": "slow", "crf": 18},
+}
+VIDEO_ENCODE_PROFILE = os.getenv("VIDEO_ENCODE_PROFILE", "fast")
+VIDEO_CRF = os.getenv("VIDEO_CRF")  # переопределяет CRF профиля
+VIDEO_FPS = int(os.getenv("VIDEO_FPS", "30"))
+DEFAULT_SLIDE_DURATION = 5.0  # секунд на слайд без озвучки
+# Каждый слайд — 1-2 входа ffmpeg (открытые дескрипторы); длинные презентации
+# собираются сегментами не больше этого числа слайдов и склеиваются без перекодирования
+MAX_SLIDES_PER_ENCODE = int(os.getenv("MAX_SLIDES_PER_ENCODE", "150"))
+
+def get_encode_settings(profile: Optional[str] = None) -> Dict:
+    settings = dict(VIDEO_ENCODE_PROFILES.get(profile or VIDEO_ENCODE_PROFILE, VIDEO_ENCODE_PROFILES["fast"]))
+    if VIDEO_CRF:
+        settings["crf"] = int(VIDEO_CRF)
+    settings["fps"] = VIDEO_FPS
+    return settings
+
+async def probe_media_duration(path: Path) -> float:
+    """Длительность аудио/видео в секундах (ffprobe, при его отсутствии — вывод ffmpeg -i)"""
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            "ffprobe", "-v", "error", "-show_entries", "format=duration",
+            "-of", "default=noprint_wrappers=1:nokey=1", str(path),
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+        )
+        stdout, _ = await proc.communicate()
+        return float(stdout.decode().strip())
+    except (OSError, ValueError):
+        proc = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-hide_banner", "-i", str(path),
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+        )
+        _, stderr = await proc.communicate()
+        match = re.search(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)", stderr.decode(errors="ignore"))
+        if not match:
+            raise RuntimeError(f"Cannot determine duration of {path}")
+        hours, minutes, seconds = match.groups()
+        return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+def build_slideshow_filtergraph(count: int, durations: List[float], with_audio: bool, fps: int) -> str:
+    """Граф фильтров: каждый слайд и его аудио выравниваются по длительности и склеиваются concat"""
+    parts = []
+    labels = []
+    stride = 2 if with_audio else 1
+    for i, duration in enumerate(durations[:count]):
+        video_input = i * stride
+        parts.append(
+            f"[{video_input}:v]scale=1920:1080:force_original_aspect_ratio=decrease,"
+            f"pad=1920:1080:(ow-iw)/2:(oh-ih)/2,setsar=1,fps={fps},format=yuv420p[v{i}]"
+        )
+        labels.append(f"[v{i}]")
+        if with_audio:
+            # Аудио дополняется тишиной/обрезается ровно до длительности слайда — без рассинхрона
+            parts.append(
+                f"[{video_input + 1}:a]aresample=44100,aformat=sample_fmts=fltp:channel_layouts=stereo,"
+                f"apad,atrim=0:{duration:.3f},asetpts=N/SR/TB[a{i}]"
+            )
+            labels.append(f"[a{i}]")
+    outputs = "[v][a]" if with_audio else "[v]"
+    parts.append(f"{''.join(labels)}concat=n={count}:v=1:a={1 if with_audio else 0}{outputs}")
+    return ";\n".join(parts)
+
+async def create_video_from_slides(slides: List[Path], audio_files: List[Path], output_path: Path,
+                                   durations: Optional[List[float]] = None,
+                                   profile: Optional[str] = None) -> Dict:
+    """Сборка финального видео из слайдов с озвучкой одним вызовом ffmpeg"""
+    if not slides:
+        raise ValueError("No slides to assemble")
+    settings = get_encode_settings(profile)
+    with_audio = bool(audio_files)
+    
+    # Длительность слайда = реальная длительность его озвучки
+    if durations is None:
+        if with_audio:
+            durations = list(await asyncio.gather(*[probe_media_duration(a) for a in audio_files]))
+        else:
+            durations = [DEFAULT_SLIDE_DURATION] * len(slides)
+    if len(slides) > MAX_SLIDES_PER_ENCODE:
+        ranges = [(a, min(a + MAX_SLIDES_PER_ENCODE, len(slides)))
+                  for a in range(0, len(slides), MAX_SLIDES_PER_ENCODE)]
+        return await create_video_from_segments(slides, audio_files, output_path, ranges,
+                                                durations=durations, profile=profile)
+    
+    tmp_root = OUTPUT_DIR / "tmp"
+    tmp_root.mkdir(exist_ok=True)
+    work_dir = Path(tempfile.mkdtemp(prefix="assemble_", dir=tmp_root))
+    try:
+        # Слайд читается с 1 fps (JPEG декодируется и масштабируется раз в секунду),
+        # до выходного fps кадры дублирует фильтр fps
+        args = []
+        for i, (slide_path, duration) in enumerate(zip(slides, durations)):
+            args += ["-loop", "1", "-framerate", "1", "-t", f"{duration:.3f}",
+                     "-i", str(slide_path)]
+            if with_audio:
+                args += ["-i", str(audio_files[i])]
         
-        # Генерируем аудио (для MVP - тихий файл с тегами)
-        # В продакшене: Google Cloud TTS или ElevenLabs
-        duration = len(script.split()) * 0.4  # ~0.4 сек на слово
+        filter_script = work_dir / "filtergraph.txt"
+        filter_script.write_text(build_slideshow_filtergraph(len(slides), durations, with_audio, settings["fps"]))
+        args += ["-filter_complex_script", str(filter_script), "-map", "[v]"]
+        if with_audio:
+            args += ["-map", "[a]", "-c:a", "aac", "-b:a", "128k"]
         
-        subprocess.run([
-            "ffmpeg", "-f", "lavfi", "-i", f"anullsrc=duration={duration}",
-            "-metadata", f"title={script[:50]}",
-            "-q:a", "9", "-acodec", "libmp3lame", 
-            str(output_path), "-y"
-        ], capture_output=True)
+        # Временный выход в каталоге задачи: параллельные задачи не пересекаются по путям
+        temp_output = work_dir / "output.mp4"
+        args += [
+            "-c:v", "libx264",
+            "-preset", settings["preset"],
+            "-tune", "stillimage",
+            "-crf", str(settings["crf"]),
+            "-movflags", "+faststart",
+            str(temp_output), "-y"
+        ]
         
-        return output_path
-    except Exception as e:
-        print(f"TTS error: {e}")
-        # Fallback
-        subprocess.run([
-            "ffmpeg", "-f", "lavfi", "-i", "anullsrc=duration=3",
-            "-q:a", "9", "-acodec", "libmp3lame", str(output_path), "-y"
-        ], capture_output=True)
-        return output_path
+        started = time.perf_counter()
+        await run_ffmpeg(args, output=temp_output)
+        encode_seconds = time.perf_counter() - started
+        os.replace(temp_output, output_path)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    
+    output_minutes = sum(durations) / 60
+    return {
+        "path": str(output_path),
+        "profile": settings,
+        "output_seconds": round(sum(durations), 2),
+        "encode_seconds": round(encode_seconds, 2),
+        "encode_seconds_per_output_minute": round(encode_seconds / output_minutes, 2) if output_minutes else 0.0
+    }
 
-# === СБОРКА НОВОГО ВИДЕО ===
+def shard_slide_ranges(key_moments: List[Dict]) -> List[tuple]:
+    """Отрезки слайдов [a, b) по шардам исходника, из которых пришли их ключевые моменты"""
+    ranges = []
+    for i, moment in enumerate(key_moments):
+        if ranges and key_moments[ranges[-1][0]].get("shard", 0) == moment.get("shard", 0):
+            ranges[-1] = (ranges[-1][0], i + 1)
+        else:
+            ranges.append((i, i + 1))
+    return ranges
 
-def create_video_from_slides(slides: List[Path], audio_files: List[Path], output_path: Path):
-    """Сборка финального видео из слайдов с озвучкой"""
-    # Создаём список для concat
-    concat_file = OUTPUT_DIR / "concat_list.txt"
-    
-    with open(concat_file, 'w') as f:
-        for slide_path in slides:
-            f.write(f"file '{slide_path.absolute()}'\n")
-            f.write("duration 5\n")  # 5 секунд на слайд
-        # Дублируем последний слайд
-        f.write(f"file '{slides[-1].absolute()}'\n")
-    
-    # Временное видео без звука
-    temp_video = OUTPUT_DIR / "temp_silent.mp4"
-    subprocess.run([
-        "ffmpeg",
-        "-f", "concat",
-        "-safe", "0",
-        "-i", str(concat_file),
-        "-vf", "fps=30,format=yuv420p",
-        "-c:v", "libx264",
-        "-preset", "medium",
-        str(temp_video),
-        "-y"
-    ], check=True)
-    
-    # Объединяем все аудио
-    if audio_files:
-        audio_list = OUTPUT_DIR / "audio_list.txt"
-        with open(audio_list, 'w') as f:
-            for audio in audio_files:
-                f.write(f"file '{audio.absolute()}'\n")
-        
-        merged_audio = OUTPUT_DIR / "merged_audio.mp3"
-        subprocess.run([
-            "ffmpeg", "-f", "concat", "-safe", "0",
-            "-i", str(audio_list),
-            "-c", "copy", str(merged_audio), "-y"
-        ], check=True)
-        
-        # Финальное видео с аудио
-        subprocess.run([
-            "ffmpeg",
-            "-i", str(temp_video),
-            "-i", str(merged_audio),
-            "-c:v", "copy",
-            "-c:a", "aac",
-            "-shortest",
-            str(output_path),
-            "-y"
-        ], check=True)
-    else:
-        # Если нет аудио, просто копируем
-        temp_video.rename(output_path)
+async def create_video_from_segments(slides: List[Path], audio_files: List[Path], output_path: Path,
+                                     ranges: List[tuple], durations: Optional[List[float]] = None,
+                                     profile: Optional[str] = None) -> Dict:
+    """Шардированная сборка: каждый отрезок слайдов кодируется своим ffmpeg (до STAGE_LIMIT_ENCODE
+    параллельно, профиль общий), затем сегменты склеиваются concat-демуксером без перекодирования"""
+    tmp_root = OUTPUT_DIR / "tmp"
+    tmp_root.mkdir(exist_ok=True)
+    work_dir = Path(tempfile.mkdtemp(prefix="segments_", dir=tmp_root))
+    try:
+        segments = [work_dir / f"segment_{k:04d}.mp4" for k in range(len(ranges))]
+        started = time.perf_counter()
+        segment_stats = await asyncio.gather(*[
+            create_video_from_slides(
+                slides[a:b], audio_files[a:b] if audio_files else [], segment,
+                durations=durations[a:b] if durations is not None else None, profile=profile
+            )
+            for (a, b), segment in zip(ranges, segments)
+        ])
+        
+        concat_list = work_dir / "segments.txt"
+        concat_list.write_text("".join(f"file '{segment.name}'\n" for segment in segments))
+        temp_output = work_dir / "output.mp4"
+        await run_ffmpeg([
+            "-f", "concat", "-safe", "0", "-i", str(concat_list),
+            "-c", "copy", "-movflags", "+faststart",
+            str(temp_output), "-y"
+        ], output=temp_output)
+        encode_seconds = time.perf_counter() - started
+        os.replace(temp_output, output_path)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
     
-    return output_path
+    output_seconds = sum(stats["output_seconds"] for stats in segment_stats)
+    output_minutes = output_seconds / 60
+    return {
+        "path": str(output_path),
+        "profile": segment_stats[0]["profile"],
+        "segments": len(segments),
+        "output_seconds": round(output_seconds, 2),
+        "encode_seconds": round(encode_seconds, 2),
+        "encode_seconds_per_output_minute": round(encode_seconds / output_minutes, 2) if output_minutes else 0.0
+    }
 
 # === ГЕНЕРАЦИЯ ИНТЕРАКТИВНЫХ МАТЕРИАЛОВ ===
 
+QUIZ_QUESTIONS = 5
+FLASHCARDS_COUNT = 8
+
+def already_have(items: List[BaseModel], field: str) -> str:
+    """Хвост промпта для дозапроса: что уже есть и не должно повторяться"""
+    if not items:
+        return ""
+    return "\n    Не повторяй уже готовые: " + json.dumps([getattr(item, field) for item in items], ensure_ascii=False)
+
 async def generate_quiz(key_moments: List[Dict]) -> Dict:
     """Генерация квиза по ключевым моментам"""
-    model = genai.GenerativeModel('gemini-2.0-flash-exp')
+    model = get_generative_model()
     
     topics = [m["analysis"]["topic"] for m in key_moments[:5]]
     
-    prompt = f"""Создай образовательный квиз из 5 вопросов по темам: {', '.join(topics)}
+    def build_prompt(count: int, questions: List[QuizQuestion]) -> str:
+        return f"""Создай образовательный квиз из {count} вопросов по темам: {', '.join(topics)}
     
     Формат JSON:
     {{
@@ -379,24 +3067,21 @@ async def generate_quiz(key_moments: List[Dict]) -> Dict:
                 "explanation": "Объяснение"
             }}
         ]
-    }}"""
+    }}""" + already_have(questions, "question")
     
-    try:
-        response = await asyncio.to_thread(model.generate_content, prompt)
-        text = response.text.strip()
-        if "```json" in text:
-            text = text.split("```json")[1].split("```")[0]
-        return json.loads(text)
-    except:
-        return {"questions": []}
+    questions = await generate_structured_items(
+        model, build_prompt, QuizQuestion, Quiz, "questions", QUIZ_QUESTIONS, name="quiz"
+    )
+    return {"questions": [question.model_dump() for question in questions]}
 
 async def generate_flashcards(key_moments: List[Dict]) -> List[Dict]:
     """Генерация флешкарт (как Quizlet)"""
-    model = genai.GenerativeModel('gemini-2.0-flash-exp')
+    model = get_generative_model()
     
     topics = [m["analysis"] for m in key_moments[:8]]
     
-    prompt = f"""Создай 8 образовательных флешкарт по этим темам: {json.dumps(topics)}
+    def build_prompt(count: int, cards: List[Flashcard]) -> str:
+        return f"""Создай {count} образовательных флешкарт по этим темам: {json.dumps(topics)}
     
     Формат JSON:
     {{
@@ -407,17 +3092,12 @@ async def generate_flashcards(key_moments: List[Dict]) -> List[Dict]:
                 "category": "категория"
             }}
         ]
-    }}"""
+    }}""" + already_have(cards, "front")
     
-    try:
-        response = await asyncio.to_thread(model.generate_content, prompt)
-        text = response.text.strip()
-        if "```json" in text:
-            text = text.split("```json")[1].split("```")[0]
-        data = json.loads(text)
-        return data.get("cards", [])
-    except:
-        return []
+    cards = await generate_structured_items(
+        model, build_prompt, Flashcard, FlashcardDeck, "cards", FLASHCARDS_COUNT, name="flashcards"
+    )
+    return [card.model_dump() for card in cards]
 
 def generate_mindmap_data(key_moments: List[Dict]) -> Dict:
     """Генерация данных для майндкарты"""
@@ -444,173 +3124,992 @@ def generate_mindmap_data(key_moments: List[Dict]) -> Dict:
 
 # === ОСНОВНАЯ ОБРАБОТКА ===
 
-async def process_video_full(task_id: str, video_path: Path):
-    """Полный пайплайн обработки видео"""
+STAGE_TITLES = {
+    "analysis": "Анализ видео",
+    "slides": "Генерация слайдов",
+    "voiceover": "Генерация озвучки",
+    "video": "Сборка видео",
+    "pdf": "Генерация PDF",
+    "quiz": "Генерация квиза",
+    "flashcards": "Генерация флешкарт",
+    "mindmap": "Майндкарта",
+    "index": "Индексация для поиска",
+}
+
+class StageGraph:
+    """DAG стадий пайплайна: стадия стартует, как только готовы её зависимости,
+    независимые стадии выполняются параллельно. Тайминги и прогресс — по завершению каждой."""
+    
+    def __init__(self, task_id: str):
+        self.task_id = task_id
+        self.stages: Dict[str, tuple] = {}
+        self.running = set()
+        self.timings: Dict[str, float] = {}
+    
+    def add(self, name: str, fn, deps: tuple = ()):
+        """fn получает результаты deps позиционно; зависимости должны быть добавлены раньше"""
+        missing = [dep for dep in deps if dep not in self.stages]
+        if missing:
+            raise ValueError(f"Stage {name} depends on unknown stages {missing}")
+        self.stages[name] = (deps, fn)
+    
+    def _current_step(self) -> str:
+        return ", ".join(STAGE_TITLES.get(name, name) for name in sorted(self.running)) + "..."
+    
+    async def _run_stage(self, name: str, tasks: Dict[str, asyncio.Task]):
+        deps, fn = self.stages[name]
+        dep_results = [await tasks[dep] for dep in deps]
+        
+        self.running.add(name)
+        await report_progress(self.task_id, {"current_step": self._current_step()})
+        started = time.perf_counter()
+        try:
+            async with track_stage(name, kind="pipeline"):
+                result = await fn(*dep_results)
+        finally:
+            self.running.discard(name)
+        self.timings[name] = round(time.perf_counter() - started, 3)
+        
+        await report_progress(self.task_id, {
+            "progress": 5 + int(90 * len(self.timings) / len(self.stages)),
+            "current_step": self._current_step() if self.running else f"{STAGE_TITLES.get(name, name)}: готово",
+            "stage_timings": dict(self.timings)
+        })
+        return result
+    
+    async def run(self) -> Dict:
+        tasks: Dict[str, asyncio.Task] = {}
+        for name in self.stages:  # порядок добавления топологический
+            tasks[name] = asyncio.create_task(self._run_stage(name, tasks))
+        try:
+            results = await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            raise
+        return dict(zip(tasks.keys(), results))
+
+async def process_video_full(task_id: str, video_path: Path, video_hash: Optional[str] = None):
+    """Полный пайплайн обработки видео (DAG стадий)"""
+    # Спаны всех вложенных вызовов (LLM, ffmpeg, воркеры) относятся к этой задаче
+    current_task_id.set(task_id)
+    task_tracer.start(task_id)
     try:
-        tasks_status[task_id] = {
+        await report_progress(task_id, {
             "status": "processing",
             "progress": 5,
             "current_step": "Анализ видео...",
             "frames_extracted": 0,
             "water_removed_percent": 0
-        }
-        
-        # 1. Анализ и выделение ключевых моментов
-        analysis = await analyze_video_content(video_path)
-        tasks_status[task_id].update({
-            "progress": 25,
-            "current_step": "Генерация слайдов...",
-            "water_removed_percent": analysis["water_removed_percent"]
         })
         
-        # 2. Создание слайдов из ключевых моментов
-        slides = []
-        for i, moment in enumerate(analysis["key_moments"], 1):
-            slide_path = SLIDES_DIR / f"{task_id}_slide_{i}.jpg"
-            create_educational_slide(
-                moment["frame"],
-                moment["analysis"],
-                i,
-                slide_path
-            )
-            slides.append(slide_path)
+        frames_dir = FRAME_SPILL_DIR / f"{task_id}_frames"
         
-        tasks_status[task_id].update({
-            "progress": 45,
-            "current_step": "Генерация озвучки...",
-            "frames_extracted": len(slides)
-        })
+        # Контентный ключ исходника: повторная загрузка того же файла переиспользует стадии
+        if video_hash is None:
+            video_hash = await asyncio.to_thread(hash_file, video_path)
         
-        # 3. Генерация озвучки для каждого слайда
-        audio_files = []
-        for i, moment in enumerate(analysis["key_moments"], 1):
-            audio_path = OUTPUT_DIR / f"{task_id}_audio_{i}.mp3"
-            await generate_voiceover_for_slide(
-                moment["analysis"].get("description", ""),
-                i,
-                audio_path
+        # 1. Анализ и выделение ключевых моментов
+        # Сырые кадры ключевых сцен живут на диске только до рендера слайдов
+        async def analysis_stage():
+            analysis_key = cache_key(
+                "analysis", video_hash, PROMPT_VERSION, GEMINI_MODEL,
+                get_sampling_policy(), get_payload_settings(), SCENE_HASH_THRESHOLD, MAX_ANALYZED_SCENES,
+                SHARD_SECONDS, SHARD_MIN_DURATION
             )
-            audio_files.append(audio_path)
+            analysis = result_cache.get_json(analysis_key, kind="analysis")
+            if analysis is None:
+                analysis = await analyze_video_content(video_path, frames_dir)
+                result_cache.put_json(analysis_key, {
+                    **analysis,
+                    "key_moments": [
+                        {k: v for k, v in moment.items() if k != "frame_path"}
+                        for moment in analysis["key_moments"]
+                    ]
+                }, kind="analysis")
+            await report_progress(task_id, {
+                "water_removed_percent": analysis["water_removed_percent"],
+                "frames_deduplicated": analysis["frames_deduplicated"]
+            })
+            return analysis
         
-        tasks_status[task_id].update({
-            "progress": 65,
-            "current_step": "Сборка видео..."
-        })
+        # 2. Слайды из ключевых моментов (из кэша или пакетом в пуле процессов)
+        async def slides_stage(analysis):
+            slides = [
+                SLIDES_DIR / f"{task_id}_slide_{i}.jpg"
+                for i in range(1, len(analysis["key_moments"]) + 1)
+            ]
+            slide_keys = [
+                cache_key("slide", moment["fingerprint"], moment["analysis"], i, SLIDE_VERSION)
+                for i, moment in enumerate(analysis["key_moments"], 1)
+            ]
+            cache_hits = await asyncio.gather(*[
+                asyncio.to_thread(result_cache.get_file, slide_key, slide_path, "slide")
+                for slide_key, slide_path in zip(slide_keys, slides)
+            ])
+            
+            render_jobs = []
+            placeholders = set()  # слайды без кадра не кэшируются: следующий прогон попробует снова
+            for i, (moment, slide_path, hit) in enumerate(zip(analysis["key_moments"], slides, cache_hits), 1):
+                if hit:
+                    continue
+                frame = moment.get("frame_path")
+                if frame is None or not Path(frame).exists():
+                    # Анализ пришёл из кэша без фреймов — читаем нужный кадр из исходника
+                    frame = await asyncio.to_thread(read_frame_at, video_path, moment["timestamp"])
+                    if frame is None:
+                        # Кадр не читается — слайд только с текстом, чтобы не сбить порядок с озвучкой
+                        print(f"Frame at {moment['timestamp']}s unreadable, slide {i} without image")
+                        placeholders.add(i)
+                        frame = placeholder_frame()
+                render_jobs.append((frame, moment["analysis"], i, slide_path))
+            
+            await render_slides_parallel(render_jobs)
+            shutil.rmtree(frames_dir, ignore_errors=True)
+            for _, _, i, slide_path in render_jobs:
+                if i not in placeholders:
+                    await asyncio.to_thread(result_cache.put_file, slide_keys[i - 1], slide_path, "slide")
+            await report_artifact(task_id, "slides", {"frames_extracted": len(slides)})
+            return slides, slide_keys
         
-        # 4. Создание нового видео
-        new_video_path = OUTPUT_DIR / f"{task_id}_final.mp4"
-        create_video_from_slides(slides, audio_files, new_video_path)
+        # 3. Озвучка — зависит только от анализа, идёт параллельно со слайдами
+        async def voiceover_stage(analysis):
+            audio_files = [
+                OUTPUT_DIR / f"{task_id}_audio_{i}.mp3"
+                for i in range(1, len(analysis["key_moments"]) + 1)
+            ]
+            # Синтез параллельно по слайдам (в пределах лимита стадии tts)
+            durations = await asyncio.gather(*[
+                generate_voiceover_for_slide(moment["analysis"].get("description", ""), i, audio_path)
+                for i, (moment, audio_path) in enumerate(zip(analysis["key_moments"], audio_files), 1)
+            ])
+            audio_keys = await asyncio.gather(*[asyncio.to_thread(hash_file, path) for path in audio_files])
+            return audio_files, list(durations), audio_keys
         
-        tasks_status[task_id].update({
-            "progress": 80,
-            "current_step": "Генерация PDF и интерактивных материалов..."
-        })
+        # 4. Новое видео — единственная стадия, которой нужны и слайды, и озвучка
+        # Шардированное видео собирается посегментно (по шардам исходника) и склеивается без перекодирования
+        async def video_stage(analysis, slides_result, voiceover_result):
+            slides, slide_keys = slides_result
+            audio_files, durations, audio_keys = voiceover_result
+            new_video_path = OUTPUT_DIR / f"{task_id}_final.mp4"
+            ranges = shard_slide_ranges(analysis["key_moments"])
+            video_stats = {}
+            
+            async def build_video():
+                if len(ranges) > 1:
+                    video_stats.update(await create_video_from_segments(
+                        slides, audio_files, new_video_path, ranges, durations=durations
+                    ))
+                else:
+                    video_stats.update(await create_video_from_slides(
+                        slides, audio_files, new_video_path, durations=durations
+                    ))
+            
+            await cached_file(
+                "video", cache_key("video", slide_keys, audio_keys, get_encode_settings(), ranges), new_video_path,
+                build_video
+            )
+            await report_artifact(task_id, "video", {"new_video_url": f"/download/{task_id}_final.mp4"})
+            return video_stats or None
         
-        # 5. Генерация PDF
-        pdf_path = OUTPUT_DIR / f"{task_id}_course.pdf"
-        generate_pdf_from_slides(slides, analysis, pdf_path)
+        # 5. PDF — не ждёт видео
+        async def pdf_stage(analysis, slides_result):
+            slides, slide_keys = slides_result
+            pdf_path = OUTPUT_DIR / f"{task_id}_course.pdf"
+            pdf_key = cache_key(
+                "pdf", slide_keys, analysis["original_duration"],
+                analysis["water_removed_percent"], analysis["key_topics"], get_pdf_settings()
+            )
+            await cached_file(
+                "pdf", pdf_key, pdf_path,
+                lambda: run_in_worker("pdf", generate_pdf_from_slides, slides, analysis, pdf_path)
+            )
+            await report_artifact(task_id, "pdf", {"pdf_url": f"/download/{task_id}_course.pdf"})
         
-        # 6. Генерация квиза
-        quiz_data = await generate_quiz(analysis["key_moments"])
+        # 6-7. Квиз и флешкарты
+        async def quiz_stage(analysis):
+            topics_key = cache_key([m["analysis"] for m in analysis["key_moments"]], GEMINI_MODEL)
+            quiz = await cached_json(
+                "quiz", cache_key("quiz", topics_key),
+                lambda: generate_quiz(analysis["key_moments"]),
+                is_valid=lambda quiz: bool(quiz.get("questions"))
+            )
+            await report_artifact(task_id, "quiz", {"quiz_data": quiz})
+            return quiz
         
-        # 7. Генерация флешкарт
-        flashcards = await generate_flashcards(analysis["key_moments"])
+        async def flashcards_stage(analysis):
+            topics_key = cache_key([m["analysis"] for m in analysis["key_moments"]], GEMINI_MODEL)
+            cards = await cached_json(
+                "flashcards", cache_key("flashcards", topics_key),
+                lambda: generate_flashcards(analysis["key_moments"])
+            )
+            await report_artifact(task_id, "flashcards", {"flashcards": cards})
+            return cards
         
         # 8. Майндкарта
-        mindmap = generate_mindmap_data(analysis["key_moments"])
-        mindmap_path = OUTPUT_DIR / f"{task_id}_mindmap.json"
-        with open(mindmap_path, 'w', encoding='utf-8') as f:
-            json.dump(mindmap, f, ensure_ascii=False, indent=2)
-        
-        # Сохранение в Qdrant
-        for i, moment in enumerate(analysis["key_moments"]):
-            embedding_text = moment["analysis"].get("description", "")
-            embedding = generate_embedding(embedding_text)
-            await store_in_qdrant(f"{task_id}_{i}", moment["analysis"], embedding)
-        
-        tasks_status[task_id] = {
+        async def mindmap_stage(analysis):
+            mindmap = generate_mindmap_data(analysis["key_moments"])
+            mindmap_path = OUTPUT_DIR / f"{task_id}_mindmap.json"
+            with open(mindmap_path, 'w', encoding='utf-8') as f:
+                json.dump(mindmap, f, ensure_ascii=False, indent=2)
+            await asyncio.to_thread(write_precompressed, mindmap_path)
+            await report_artifact(task_id, "mindmap", {"mindmap_url": f"/download/{task_id}_mindmap.json"})
+        
+        # 9. Сохранение в Qdrant
+        async def index_stage(analysis):
+            return await index_key_moments(task_id, analysis["key_moments"], video_hash)
+        
+        graph = StageGraph(task_id)
+        graph.add("analysis", analysis_stage)
+        graph.add("slides", slides_stage, ("analysis",))
+        graph.add("voiceover", voiceover_stage, ("analysis",))
+        graph.add("video", video_stage, ("analysis", "slides", "voiceover"))
+        graph.add("pdf", pdf_stage, ("analysis", "slides"))
+        graph.add("quiz", quiz_stage, ("analysis",))
+        graph.add("flashcards", flashcards_stage, ("analysis",))
+        graph.add("mindmap", mindmap_stage, ("analysis",))
+        graph.add("index", index_stage, ("analysis",))
+        results = await graph.run()
+        
+        analysis = results["analysis"]
+        await finish_task(task_id, {
             "status": "completed",
             "progress": 100,
             "current_step": "Готово!",
-            "frames_extracted": len(slides),
+            "frames_extracted": len(results["slides"][0]),
             "water_removed_percent": analysis["water_removed_percent"],
+            "frames_deduplicated": analysis["frames_deduplicated"],
             "new_video_url": f"/download/{task_id}_final.mp4",
             "pdf_url": f"/download/{task_id}_course.pdf",
             "mindmap_url": f"/download/{task_id}_mindmap.json",
-            "quiz_data": quiz_data,
-            "flashcards": flashcards
-        }
+            "video_encode": results["video"],
+            "stage_timings": graph.timings,
+            "trace_url": task_tracer.dump(task_id),
+            "quiz_data": results["quiz"],
+            "flashcards": results["flashcards"]
+        })
         
     except Exception as e:
-        tasks_status[task_id] = {
+        await finish_task(task_id, {
             "status": "failed",
             "progress": 0,
             "current_step": "Ошибка",
-            "error": str(e)
-        }
+            "error": str(e),
+            "trace_url": task_tracer.dump(task_id)
+        })
+    finally:
+        shutil.rmtree(FRAME_SPILL_DIR / f"{task_id}_frames", ignore_errors=True)
+        shutil.rmtree(SHARD_DIR / f"{task_id}_frames", ignore_errors=True)
 
-def generate_embedding(text: str) -> List[float]:
+# === ИНДЕКСАЦИЯ В QDRANT ===
+
+EMBED_MODEL = "models/embedding-001"
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "100"))  # текстов в одном запросе
+UPSERT_BATCH_SIZE = int(os.getenv("UPSERT_BATCH_SIZE", "256"))  # точек в одном upsert
+POINT_ID_NAMESPACE = uuid.UUID("5b0c6f0e-8a51-4d5e-9a43-2f7c1d0b6e2a")
+
+def point_id(content_key: str) -> str:
+    """Детерминированный UUID точки из контентного ключа момента: одинаков во всех процессах,
+    повторная загрузка того же видео перезаписывает те же точки, а не добавляет дубликаты"""
+    return str(uuid.uuid5(POINT_ID_NAMESPACE, content_key))
+
+async def embed_batch(texts: List[str], task_type: str = "retrieval_document") -> List[List[float]]:
+    """Один запрос embed_content на пачку текстов; результат кэшируется по содержимому пачки"""
+    key = cache_key("embeddings", EMBED_MODEL, task_type, texts)
+    cached = result_cache.get_json(key, kind="embeddings")
+    if cached is not None:
+        return cached
     try:
-        result = genai.embed_content(
-            model="models/embedding-001",
-            content=text,
-            task_type="retrieval_document"
+        async with track_stage("embed", texts=len(texts)) as span:
+            span["bytes_out"] = payload_size(texts)
+            result = await llm_scheduler.run(
+                embed_content,
+                model=EMBED_MODEL,
+                content=texts,
+                task_type=task_type,
+                name="embed_batch"
+            )
+    except Exception as e:
+        # Случайные векторы-заглушки не кэшируем
+        print(f"Batch embedding error: {e}")
+        return np.random.randn(len(texts), 768).tolist()
+    result_cache.put_json(key, result['embedding'], kind="embeddings")
+    return result['embedding']
+
+async def generate_embeddings(texts: List[str], task_type: str = "retrieval_document") -> List[List[float]]:
+    """Эмбеддинги для всех текстов чанками по EMBED_BATCH_SIZE, чанки параллельно"""
+    chunks = [texts[i:i + EMBED_BATCH_SIZE] for i in range(0, len(texts), EMBED_BATCH_SIZE)]
+    results = await asyncio.gather(*[embed_batch(chunk, task_type) for chunk in chunks])
+    return [vector for chunk_vectors in results for vector in chunk_vectors]
+
+async def store_points_in_qdrant(points: List["qmodels.PointStruct"]):
+    """Bulk upsert чанками вне event loop"""
+    for i in range(0, len(points), UPSERT_BATCH_SIZE):
+        batch = points[i:i + UPSERT_BATCH_SIZE]
+        async with track_stage("upsert", points=len(batch)):
+            await asyncio.to_thread(
+                get_qdrant().upsert,
+                collection_name=COLLECTION_NAME,
+                points=batch,
+                wait=True
+            )
+
+async def index_key_moments(task_id: str, key_moments: List[Dict], video_hash: str) -> int:
+    """Пакетная индексация ключевых моментов: ceil(N/batch) эмбеддингов + bulk upsert.
+    ID точки — от хэша исходника и содержимого момента: повтор того же видео идемпотентен"""
+    if not key_moments:
+        return 0
+    texts = [moment["analysis"].get("description", "") for moment in key_moments]
+    embeddings = await generate_embeddings(texts)
+    points = [
+        qmodels.PointStruct(
+            id=point_id(cache_key("point", video_hash, moment["timestamp"], text)),
+            vector=embedding,
+            payload={
+                "frame_id": f"{task_id}_{i}",
+                "task_id": task_id,
+                "timestamp": moment["timestamp"],
+                "topic": moment["analysis"].get("topic", ""),
+                "description": moment["analysis"].get("description", "")
+            }
         )
-        return result['embedding']
-    except:
-        return np.random.randn(768).tolist()
-
-async def store_in_qdrant(frame_id: str, analysis: dict, embedding: List[float]):
-    point = PointStruct(
-        id=hash(frame_id) % (10**9),
-        vector=embedding,
-        payload={
-            "frame_id": frame_id,
-            "topic": analysis.get("topic", ""),
-            "description": analysis.get("description", "")
-        }
-    )
-    qdrant.upsert(collection_name=COLLECTION_NAME, points=[point])
+        for i, (moment, text, embedding) in enumerate(zip(key_moments, texts, embeddings))
+    ]
+    await store_points_in_qdrant(points)
+    return len(points)
+
+# === ПОИСК ===
+
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "10000"))
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "3600"))  # секунд
+SEARCH_MAX_LIMIT = 100
+
+class TTLCache:
+    """LRU-кэш в памяти с временем жизни записей"""
+    
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self.entries.pop(key, None)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+    
+    def set(self, key: str, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+    
+    def snapshot(self) -> Dict:
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
 
-def download_video(url: str, save_path: Path) -> Path:
+query_embedding_cache = TTLCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+query_embedding_inflight: Dict[str, asyncio.Future] = {}
+search_latency = LatencyStats()
+
+async def embed_query(query: str) -> List[float]:
+    """Эмбеддинг запроса: кэш LRU+TTL, одинаковые одновременные запросы делят один вызов"""
+    key = " ".join(query.lower().split())
+    cached = query_embedding_cache.get(key)
+    if cached is not None:
+        return cached
+    inflight = query_embedding_inflight.get(key)
+    if inflight is not None:
+        return await asyncio.shield(inflight)
+    
+    future = asyncio.get_running_loop().create_future()
+    query_embedding_inflight[key] = future
     try:
-        subprocess.run([
-            "yt-dlp", "-f", "best[ext=mp4]",
-            "-o", str(save_path), str(url)
-        ], check=True)
-        return save_path
-    except:
-        subprocess.run(["wget", "-O", str(save_path), str(url)], check=True)
+        result = await llm_scheduler.run(
+            embed_content,
+            model=EMBED_MODEL,
+            content=query,
+            task_type="retrieval_query",
+            name="embed_query"
+        )
+        embedding = result['embedding']
+        query_embedding_cache.set(key, embedding)
+        future.set_result(embedding)
+    except Exception as e:
+        # Случайный вектор-заглушку не кэшируем
+        print(f"Query embedding error: {e}")
+        embedding = np.random.randn(768).tolist()
+        future.set_result(embedding)
+    finally:
+        query_embedding_inflight.pop(key, None)
+        if not future.done():
+            # При отмене ждущие получат CancelledError, а не зависнут
+            future.cancel()
+    return embedding
+
+def build_search_filter(task_id: Optional[str] = None, topic: Optional[str] = None) -> Optional["qmodels.Filter"]:
+    conditions = [
+        qmodels.FieldCondition(key=field, match=qmodels.MatchValue(value=value))
+        for field, value in (("task_id", task_id), ("topic", topic))
+        if value
+    ]
+    return qmodels.Filter(must=conditions) if conditions else None
+
+# === ПОТОКОВАЯ ЗАГРУЗКА ===
+
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(4 * 1024 ** 3)))
+TUS_VERSION = "1.0.0"
+UPLOAD_EXPIRY = int(os.getenv("UPLOAD_EXPIRY", str(24 * 3600)))  # недокачанные загрузки живут столько, сек
+UPLOAD_FORM_OVERHEAD = 64 * 1024  # границы multipart и поля формы сверх самого файла
+
+# upload_id -> (offset, sha256 принятой части); кэш этого процесса, другой воркер мог дописать дальше
+upload_hashers: Dict[str, tuple] = {}
+
+def _write_chunk(f, hasher, chunk) -> None:
+    f.write(chunk)
+    hasher.update(chunk)
+
+async def stream_to_file(chunks, f, hasher, written: int = 0, max_bytes: int = MAX_UPLOAD_BYTES) -> int:
+    """Запись потока чанков на диск с инкрементальным sha256; память — один буфер"""
+    buffer = bytearray()
+    async for chunk in chunks:
+        written += len(chunk)
+        if written > max_bytes:
+            raise HTTPException(status_code=413, detail=f"Upload exceeds {max_bytes} bytes")
+        buffer += chunk
+        if len(buffer) >= UPLOAD_CHUNK_SIZE:
+            await asyncio.to_thread(_write_chunk, f, hasher, buffer)
+            buffer.clear()
+    if buffer:
+        await asyncio.to_thread(_write_chunk, f, hasher, buffer)
+    return written
+
+async def iter_upload_file(file: UploadFile):
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        yield chunk
+
+def check_content_length(content_length: Optional[int], limit: int = MAX_UPLOAD_BYTES):
+    if content_length is not None and content_length > limit:
+        raise HTTPException(status_code=413, detail=f"Upload exceeds {limit} bytes")
+
+class UploadAdmissionMiddleware:
+    """429 и 413 для POST /upload раньше, чем парсер формы спулит тело во временный файл:
+    заполненная очередь — до первого чтения тела, размер — по Content-Length,
+    для chunked — как только принято больше лимита.
+    HTTPException из receive обрабатывается как ошибка эндпоинта (с CORS-заголовками)."""
+    
+    def __init__(self, app, path: str = "/upload"):
+        self.app = app
+        self.path = path
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] != self.path:
+            await self.app(scope, receive, send)
+            return
+        limit = MAX_UPLOAD_BYTES + UPLOAD_FORM_OVERHEAD
+        content_length = dict(scope["headers"]).get(b"content-length", b"")
+        received = int(content_length) if content_length.isdigit() else 0
+        first_read = True
+        
+        async def limited_receive():
+            nonlocal received, first_read
+            if first_read and job_queue.is_full():
+                raise HTTPException(status_code=429, detail="Processing queue is full, retry later")
+            first_read = False
+            if received <= limit:
+                message = await receive()
+                if message["type"] != "http.request" or content_length.isdigit():
+                    return message
+                received += len(message.get("body", b""))
+                if received <= limit:
+                    return message
+            raise HTTPException(status_code=413, detail=f"Upload exceeds {MAX_UPLOAD_BYTES} bytes")
+        
+        await self.app(scope, limited_receive, send)
+
+app.add_middleware(UploadAdmissionMiddleware)
+
+def upload_meta_path(upload_id: str) -> Path:
+    return UPLOAD_DIR / f"{upload_id}.upload.json"
+
+def upload_part_path(upload_id: str) -> Path:
+    return UPLOAD_DIR / f"{upload_id}.mp4.part"
+
+def upload_lock_path(upload_id: str) -> Path:
+    return UPLOAD_DIR / f"{upload_id}.upload.lock"
+
+def try_lock_upload(upload_id: str) -> Optional[int]:
+    """flock на время PATCH: один писатель на загрузку во всех воркерах узла; None — занято"""
+    fd = os.open(upload_lock_path(upload_id), os.O_CREAT | os.O_RDWR)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+def unlock_upload(fd: int):
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    os.close(fd)
+
+def purge_stale_uploads() -> int:
+    """Удалить загрузки без активности дольше UPLOAD_EXPIRY (части, метаданные, lock-файлы)
+    и закэшированные sha256 загрузок, которых больше нет"""
+    cutoff = time.time() - UPLOAD_EXPIRY
+    purged = 0
+    for meta_path in UPLOAD_DIR.glob("*.upload.json"):
+        upload_id = meta_path.name[:-len(".upload.json")]
+        part_path = upload_part_path(upload_id)
+        try:
+            last_activity = max(path.stat().st_mtime for path in (meta_path, part_path) if path.exists())
+        except (ValueError, OSError):
+            continue
+        if last_activity > cutoff:
+            continue
+        fd = try_lock_upload(upload_id)
+        if fd is None:
+            continue  # в загрузку прямо сейчас пишут
+        try:
+            part_path.unlink(missing_ok=True)
+            meta_path.unlink(missing_ok=True)
+            upload_lock_path(upload_id).unlink(missing_ok=True)
+        finally:
+            unlock_upload(fd)
+        purged += 1
+    for upload_id in list(upload_hashers):
+        if not upload_part_path(upload_id).exists():
+            upload_hashers.pop(upload_id, None)
+    return purged
+
+def load_upload_meta(upload_id: str) -> Dict:
+    try:
+        uuid.UUID(upload_id)
+        return json.loads(upload_meta_path(upload_id).read_text())
+    except (ValueError, OSError):
+        raise HTTPException(status_code=404, detail="Upload not found")
+
+def resume_hasher(upload_id: str, offset: int):
+    """sha256 уже принятой части: из памяти или пересчётом файла (рестарт / другой воркер)"""
+    cached_offset, hasher = upload_hashers.get(upload_id, (None, None))
+    if cached_offset != offset:
+        hasher = hashlib.sha256()
+        with open(upload_part_path(upload_id), "rb") as f:
+            remaining = offset
+            while remaining > 0:
+                chunk = f.read(min(UPLOAD_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                remaining -= len(chunk)
+    return hasher
+
+# === ЗАГРУЗКА ПО URL ===
+
+DOWNLOAD_TIMEOUT = float(os.getenv("DOWNLOAD_TIMEOUT", "1800"))  # секунд на одну загрузку
+DOWNLOAD_CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY", "4"))
+
+download_semaphore = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+
+DOWNLOAD_SIZE_POLL_INTERVAL = 0.5  # как часто проверять размер скачиваемого файла
+
+class DownloadTooLarge(Exception):
+    """Источник больше MAX_UPLOAD_BYTES — повторять другим загрузчиком бессмысленно"""
+
+def download_part_paths(save_path: Path) -> List[Path]:
+    # yt-dlp пишет во временный .part и переименовывает в конце
+    return [save_path, save_path.with_name(save_path.name + ".part")]
+
+async def watch_download_size(proc, paths: List[Path], max_bytes: int, exceeded: Dict):
+    """Убить загрузчик, как только файл на диске перерос лимит (wget лимита не знает)"""
+    while proc.returncode is None:
+        size = 0
+        for path in paths:
+            try:
+                size = max(size, path.stat().st_size)
+            except OSError:
+                pass
+        if size > max_bytes:
+            exceeded["size"] = size
+            proc.kill()
+            return
+        await asyncio.sleep(DOWNLOAD_SIZE_POLL_INTERVAL)
+
+async def run_download_process(cmd: List[str], on_progress=None, save_path: Optional[Path] = None,
+                               max_bytes: int = 0):
+    """Асинхронный subprocess загрузчика с разбором процента из вывода и лимитом размера файла"""
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT
+    )
+    exceeded = {}
+    watchdog = None
+    if save_path is not None and max_bytes:
+        watchdog = asyncio.create_task(watch_download_size(proc, download_part_paths(save_path), max_bytes, exceeded))
+    try:
+        async for line in proc.stdout:
+            text = line.decode(errors="ignore")
+            if "larger than max-filesize" in text:
+                exceeded["size"] = max_bytes + 1  # yt-dlp отказался качать сам и выйдет с кодом 0
+            match = re.search(r"(\d{1,3}(?:\.\d+)?)%", text)
+            if match and on_progress:
+                await on_progress(min(float(match.group(1)), 100.0))
+        returncode = await proc.wait()
+    except asyncio.CancelledError:
+        # Таймаут или отмена — не оставляем висящий процесс
+        proc.kill()
+        await proc.wait()
+        raise
+    finally:
+        if watchdog is not None:
+            watchdog.cancel()
+    if exceeded:
+        raise DownloadTooLarge(f"Source exceeds {max_bytes} bytes")
+    if returncode != 0:
+        raise RuntimeError(f"{cmd[0]} exited with code {returncode}")
+
+async def download_video(url: str, save_path: Path, on_progress=None) -> Path:
+    """Загрузка видео через yt-dlp (fallback: wget) вне event loop, с лимитом параллельности и размера"""
+    async with download_semaphore:
+        deadline = time.monotonic() + DOWNLOAD_TIMEOUT
+        try:
+            await asyncio.wait_for(run_download_process([
+                "yt-dlp", "--newline", "-f", "best[ext=mp4]",
+                "--max-filesize", str(MAX_UPLOAD_BYTES),
+                "-o", str(save_path), str(url)
+            ], on_progress, save_path, MAX_UPLOAD_BYTES), DOWNLOAD_TIMEOUT)
+        except (asyncio.TimeoutError, DownloadTooLarge):
+            raise
+        except Exception:
+            await asyncio.wait_for(run_download_process([
+                "wget", "--progress=dot:mega", "-O", str(save_path), str(url)
+            ], on_progress, save_path, MAX_UPLOAD_BYTES), max(1.0, deadline - time.monotonic()))
         return save_path
 
+async def ingest_url_and_process(task_id: str, url: str, video_path: Path):
+    """Фоновая стадия: загрузка по URL, затем полный пайплайн"""
+    reported = {"percent": -1.0}
+    
+    async def on_progress(percent: float):
+        # Пишем в хранилище не чаще, чем раз в процент
+        if percent - reported["percent"] >= 1 or percent >= 100:
+            reported["percent"] = percent
+            await report_progress(task_id, {"download_progress": round(percent, 1)})
+    
+    try:
+        await download_video(url, video_path, on_progress)
+    except asyncio.CancelledError:
+        for path in download_part_paths(video_path):
+            path.unlink(missing_ok=True)
+        raise
+    except Exception as e:
+        for path in download_part_paths(video_path):
+            path.unlink(missing_ok=True)
+        reason = "timeout" if isinstance(e, asyncio.TimeoutError) else str(e)
+        await finish_task(task_id, {
+            "status": "failed",
+            "progress": 0,
+            "current_step": "Ошибка загрузки",
+            "error": f"Failed to download: {reason}"
+        })
+        return
+    
+    await job_queue.enqueue(task_id, process_video_full, task_id, video_path)
+
+# === РАЗДАЧА АРТЕФАКТОВ ===
+
+ARTIFACT_CHUNK_SIZE = 256 * 1024  # чанк потоковой отдачи, если сервер не умеет zero-copy
+ARTIFACT_NAME_RE = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]*$")
+# Год и immutable — только для имён с sha256 содержимого: под тем же именем другого байта не будет.
+# Артефакты задачи ({uuid}_...) перезаписываются при повторной обработке — no-cache и ревалидация по ETag
+IMMUTABLE_ARTIFACT_RE = re.compile(r"^[0-9a-f]{64}[._]")
+PRECOMPRESSED_SUFFIXES = {".json"}
+PRECOMPRESSED_ENCODINGS = [("br", ".br"), ("gzip", ".gz")] if brotli else [("gzip", ".gz")]
+
+mimetypes.add_type("video/mp4", ".mp4")
+mimetypes.add_type("audio/mpeg", ".mp3")
+mimetypes.add_type("application/json", ".json")
+
+def resolve_artifact(filename: str) -> Path:
+    """Путь к артефакту строго внутри OUTPUT_DIR (без ../, абсолютных путей и скрытых файлов)"""
+    if not ARTIFACT_NAME_RE.match(filename):
+        raise HTTPException(status_code=404, detail="File not found")
+    path = (OUTPUT_DIR / filename).resolve()
+    if path.parent != OUTPUT_DIR.resolve() or not path.is_file():
+        raise HTTPException(status_code=404, detail="File not found")
+    return path
+
+def write_precompressed(path: Path):
+    """gzip/brotli варианты рядом с файлом — отдаются без сжатия на лету"""
+    data = path.read_bytes()
+    for encoding, suffix in PRECOMPRESSED_ENCODINGS:
+        compressed = brotli.compress(data, quality=11) if encoding == "br" else gzip.compress(data, 9, mtime=0)
+        path.with_name(path.name + suffix).write_bytes(compressed)
+
+def pick_precompressed(path: Path, accept_encoding: str) -> tuple:
+    """(путь, Content-Encoding) — сжатый вариант, если клиент его принимает и он не устарел"""
+    if path.suffix not in PRECOMPRESSED_SUFFIXES:
+        return path, None
+    accepted = set()
+    for part in accept_encoding.lower().split(","):
+        coding, _, params = part.strip().partition(";")
+        try:
+            if params and float(params.strip().removeprefix("q=")) == 0:
+                continue  # q=0 — кодировка явно запрещена
+        except ValueError:
+            pass
+        accepted.add(coding.strip())
+    for encoding, suffix in PRECOMPRESSED_ENCODINGS:
+        variant = path.with_name(path.name + suffix)
+        if encoding in accepted and variant.is_file() and variant.stat().st_mtime_ns >= path.stat().st_mtime_ns:
+            return variant, encoding
+    return path, None
+
+def parse_range(header: Optional[str], size: int) -> Optional[tuple]:
+    """Один диапазон bytes=a-b -> (start, end) включительно; None — отдать целиком.
+    ValueError — диапазон вне файла (416)."""
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None  # мультидиапазоны и мусор игнорируются (RFC 9110 это допускает)
+    start, sep, end = header[6:].strip().partition("-")
+    if not sep or not (start + end).isdigit():
+        return None
+    if not start:
+        length = int(end)
+        if length == 0:
+            raise ValueError("Empty suffix range")
+        return max(size - length, 0), size - 1
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        raise ValueError("Range not satisfiable")
+    return start, end
+
+class ArtifactResponse(Response):
+    """Отдача файла: zero-copy через ASGI-расширения сервера (zerocopysend/pathsend),
+    иначе чанками из потока"""
+    
+    def __init__(self, path: Path, status_code: int = 200, headers: Optional[Dict] = None,
+                 offset: int = 0, count: int = 0, send_body: bool = True):
+        self.path = path
+        self.status_code = status_code
+        self.offset = offset
+        self.count = count
+        self.send_body = send_body
+        self.background = None
+        self.init_headers(headers)
+    
+    async def __call__(self, scope, receive, send):
+        extensions = scope.get("extensions") or {}
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if not self.send_body or not self.count:
+            await send({"type": "http.response.body", "body": b""})
+            return
+        
+        whole_file = self.offset == 0 and self.count == self.path.stat().st_size
+        if "http.response.pathsend" in extensions and whole_file:
+            await send({"type": "http.response.pathsend", "path": str(self.path)})
+            return
+        
+        with open(self.path, "rb") as f:
+            if "http.response.zerocopysend" in extensions:
+                await send({
+                    "type": "http.response.zerocopysend", "file": f,
+                    "offset": self.offset, "count": self.count
+                })
+                return
+            
+            f.seek(self.offset)
+            remaining = self.count
+            while remaining > 0:
+                chunk = await asyncio.to_thread(f.read, min(ARTIFACT_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+            if remaining > 0:
+                await send({"type": "http.response.body", "body": b""})  # файл укоротился
+
+def artifact_response(path: Path, request: Request) -> Response:
+    """Условные запросы (ETag/Last-Modified), Range/206 и кэш-заголовки для артефакта"""
+    media_type = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+    body_path, encoding = pick_precompressed(path, request.headers.get("accept-encoding", ""))
+    stat = body_path.stat()
+    etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}{"-" + encoding if encoding else ""}"'
+    last_modified = formatdate(stat.st_mtime, usegmt=True)
+    
+    headers = {
+        "content-type": media_type,
+        "accept-ranges": "bytes",
+        "etag": etag,
+        "last-modified": last_modified,
+        "cache-control": "public, max-age=31536000, immutable"
+        if IMMUTABLE_ARTIFACT_RE.match(path.name) else "no-cache",
+        "content-disposition": f'attachment; filename="{path.name}"',
+    }
+    if path.suffix in PRECOMPRESSED_SUFFIXES:
+        headers["vary"] = "Accept-Encoding"
+    if encoding:
+        headers["content-encoding"] = encoding
+    
+    # If-None-Match приоритетнее If-Modified-Since
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        if if_none_match.strip() == "*" or etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+            return Response(status_code=304, headers={k: v for k, v in headers.items() if k != "content-type"})
+    else:
+        if_modified_since = request.headers.get("if-modified-since")
+        if if_modified_since:
+            try:
+                if int(stat.st_mtime) <= parsedate_to_datetime(if_modified_since).timestamp():
+                    return Response(status_code=304, headers={k: v for k, v in headers.items() if k != "content-type"})
+            except (TypeError, ValueError):
+                pass
+    
+    send_body = request.method != "HEAD"
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and if_range and if_range.strip() not in (etag, last_modified):
+        range_header = None  # файл изменился с момента первой части — отдаём целиком
+    try:
+        byte_range = parse_range(range_header, stat.st_size)
+    except ValueError:
+        return Response(status_code=416, headers={"content-range": f"bytes */{stat.st_size}"})
+    
+    if byte_range is None:
+        headers["content-length"] = str(stat.st_size)
+        return ArtifactResponse(body_path, 200, headers, 0, stat.st_size, send_body)
+    
+    start, end = byte_range
+    headers["content-range"] = f"bytes {start}-{end}/{stat.st_size}"
+    headers["content-length"] = str(end - start + 1)
+    return ArtifactResponse(body_path, 206, headers, start, end - start + 1, send_body)
+
 # === API ENDPOINTS ===
 
+# В долгоживущем процессе тяжёлые модули и клиенты прогреваются в фоне после старта;
+# в serverless (Mangum, lifespan="off") хук не вызывается и всё инициализируется лениво
+WARMUP_ON_STARTUP = os.getenv("WARMUP_ON_STARTUP", "1") == "1"
+
+def warm_up():
+    """Импорт OpenCV/NumPy/PIL, открытие Qdrant, настройка Gemini и запуск пула процессов заранее"""
+    for module in (cv2, np, Image, ImageDraw, ImageFont):
+        getattr(module, "__name__")
+    get_qdrant()
+    if not LLM_FAKE:
+        get_genai()
+    # forkserver и воркеры пула стартуют заранее, а не на первой задаче
+    get_cpu_pool().submit(os.getpid).result()
+
+@app.on_event("startup")
+async def recover_tasks():
+    recovered = await asyncio.to_thread(task_store.recover_orphans)
+    if recovered:
+        print(f"Marked {recovered} orphaned tasks as failed")
+    asyncio.create_task(purge_expired_tasks_loop())
+    job_queue.start()
+    if WARMUP_ON_STARTUP:
+        asyncio.create_task(asyncio.to_thread(warm_up))
+
+@app.on_event("shutdown")
+async def shutdown_workers():
+    await asyncio.to_thread(result_cache.flush)
+    if _cpu_pool is not None:
+        _cpu_pool.shutdown(wait=False, cancel_futures=True)
+
 @app.get("/")
 async def root():
     return {"message": "LucyGenX API v2.0", "status": "running", "year": 2025}
 
 @app.post("/upload")
 async def upload_video(
-    background_tasks: BackgroundTasks,
     file: UploadFile = File(None),
-    video_request: VideoRequest = None
+    video_request: VideoRequest = None,
+    priority: int = DEFAULT_JOB_PRIORITY
 ):
+    if job_queue.is_full():
+        raise HTTPException(status_code=429, detail="Processing queue is full, retry later")
     task_id = str(uuid.uuid4())
     video_path = UPLOAD_DIR / f"{task_id}.mp4"
     
+    video_hash = None
+    
     if file:
-        with open(video_path, "wb") as f:
-            content = await file.read()
-            f.write(content)
-    elif video_request and video_request.url:
+        hasher = hashlib.sha256()
         try:
-            download_video(str(video_request.url), video_path)
-        except Exception as e:
-            raise HTTPException(status_code=400, detail=f"Failed to download: {str(e)}")
+            with open(video_path, "wb") as f:
+                await stream_to_file(iter_upload_file(file), f, hasher)
+        except HTTPException:
+            video_path.unlink(missing_ok=True)
+            raise
+        video_hash = hasher.hexdigest()
+    elif video_request and video_request.url:
+        # Загрузка идёт в фоне — task_id возвращается сразу, прогресс в /status
+        await asyncio.to_thread(task_store.set, task_id, {
+            "status": "downloading",
+            "progress": 0,
+            "current_step": "Загрузка видео...",
+            "download_progress": 0.0,
+            "frames_extracted": 0,
+            "water_removed_percent": 0
+        })
+        job_queue.run_detached(task_id, ingest_url_and_process(task_id, str(video_request.url), video_path))
+        return {
+            "task_id": task_id,
+            "message": "Video download started",
+            "status_url": f"/status/{task_id}"
+        }
     else:
         raise HTTPException(status_code=400, detail="No video provided")
     
-    background_tasks.add_task(process_video_full, task_id, video_path)
+    try:
+        await job_queue.submit(task_id, process_video_full, task_id, video_path, video_hash, priority=priority)
+    except HTTPException:
+        video_path.unlink(missing_ok=True)
+        raise
+    
+    return {
+        "task_id": task_id,
+        "message": "Video processing started",
+        "status_url": f"/status/{task_id}"
+    }
+
+@app.put("/upload/stream")
+async def upload_video_stream(
+    request: Request,
+    content_length: Optional[int] = Header(None),
+    priority: int = DEFAULT_JOB_PRIORITY
+):
+    """Загрузка сырым телом запроса (без multipart) прямо на диск"""
+    check_content_length(content_length)
+    if job_queue.is_full():
+        raise HTTPException(status_code=429, detail="Processing queue is full, retry later")
+    task_id = str(uuid.uuid4())
+    video_path = UPLOAD_DIR / f"{task_id}.mp4"
+    
+    hasher = hashlib.sha256()
+    try:
+        with open(video_path, "wb") as f:
+            written = await stream_to_file(request.stream(), f, hasher)
+    except HTTPException:
+        video_path.unlink(missing_ok=True)
+        raise
+    if written == 0:
+        video_path.unlink(missing_ok=True)
+        raise HTTPException(status_code=400, detail="No video provided")
+    
+    try:
+        await job_queue.submit(task_id, process_video_full, task_id, video_path, hasher.hexdigest(), priority=priority)
+    except HTTPException:
+        video_path.unlink(missing_ok=True)
+        raise
     
     return {
         "task_id": task_id,
@@ -618,45 +4117,229 @@ async def upload_video(
         "status_url": f"/status/{task_id}"
     }
 
+# Возобновляемая загрузка в стиле tus: POST создаёт загрузку, PATCH дописывает с Upload-Offset
+
+@app.post("/uploads", status_code=201)
+async def create_resumable_upload(upload_length: int = Header(...)):
+    check_content_length(upload_length)
+    upload_id = str(uuid.uuid4())
+    upload_part_path(upload_id).touch()
+    upload_meta_path(upload_id).write_text(json.dumps({"length": upload_length}))
+    return Response(status_code=201, headers={
+        "Location": f"/uploads/{upload_id}",
+        "Tus-Resumable": TUS_VERSION,
+        "Upload-Offset": "0",
+        "Upload-Length": str(upload_length)
+    })
+
+@app.head("/uploads/{upload_id}")
+async def resumable_upload_offset(upload_id: str):
+    meta = load_upload_meta(upload_id)
+    part_path = upload_part_path(upload_id)
+    offset = part_path.stat().st_size if part_path.exists() else meta["length"]
+    headers = {
+        "Tus-Resumable": TUS_VERSION,
+        "Upload-Offset": str(offset),
+        "Upload-Length": str(meta["length"]),
+        "Cache-Control": "no-store"
+    }
+    if meta.get("task_id"):
+        headers["Upload-Task-Id"] = meta["task_id"]
+    return Response(status_code=200, headers=headers)
+
+@app.patch("/uploads/{upload_id}")
+async def resumable_upload_append(
+    upload_id: str,
+    request: Request,
+    upload_offset: int = Header(...),
+    priority: int = DEFAULT_JOB_PRIORITY
+):
+    meta = load_upload_meta(upload_id)
+    if meta.get("task_id"):
+        raise HTTPException(status_code=409, detail="Upload already completed")
+    
+    fd = await asyncio.to_thread(try_lock_upload, upload_id)
+    if fd is None:
+        raise HTTPException(status_code=409, detail="Upload is being written by another request")
+    try:
+        part_path = upload_part_path(upload_id)
+        try:
+            offset = part_path.stat().st_size
+        except FileNotFoundError:
+            # Параллельный PATCH успел завершить загрузку (или она истекла)
+            raise HTTPException(status_code=409, detail="Upload already completed")
+        if upload_offset != offset:
+            raise HTTPException(status_code=409, detail=f"Upload-Offset mismatch, expected {offset}")
+        
+        hasher = await asyncio.to_thread(resume_hasher, upload_id, offset)
+        with open(part_path, "ab") as f:
+            try:
+                offset = await stream_to_file(request.stream(), f, hasher, offset, meta["length"])
+            except HTTPException:
+                # Принятая часть остаётся, клиент продолжит с актуального Upload-Offset
+                upload_hashers.pop(upload_id, None)
+                raise
+        upload_hashers[upload_id] = (offset, hasher)
+        
+        headers = {"Tus-Resumable": TUS_VERSION, "Upload-Offset": str(offset)}
+        if offset == meta["length"]:
+            task_id = upload_id
+            video_path = UPLOAD_DIR / f"{task_id}.mp4"
+            part_path.rename(video_path)
+            meta["task_id"] = task_id
+            upload_meta_path(upload_id).write_text(json.dumps(meta))
+            video_hash = upload_hashers.pop(upload_id)[1].hexdigest()
+            upload_lock_path(upload_id).unlink(missing_ok=True)
+            # Загрузка уже принята целиком — ждём места в очереди, а не отвечаем 429
+            await job_queue.enqueue(task_id, process_video_full, task_id, video_path, video_hash,
+                                    priority=priority)
+            headers["Upload-Task-Id"] = task_id
+    finally:
+        unlock_upload(fd)
+    
+    return Response(status_code=204, headers=headers)
+
 @app.get("/status/{task_id}")
-async def get_status(task_id: str):
-    if task_id not in tasks_status:
+async def get_status(task_id: str, if_none_match: Optional[str] = Header(None)):
+    status = await asyncio.to_thread(task_store.get, task_id)
+    if status is None:
         raise HTTPException(status_code=404, detail="Task not found")
-    return tasks_status[task_id]
+    # Неизменившийся статус — 304 без тела (квиз и флешкарты не пересылаются при каждом опросе)
+    etag = status_etag(status)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(status, headers=headers)
 
-@app.get("/download/{filename}")
-async def download_file(filename: str):
-    file_path = OUTPUT_DIR / filename
-    if not file_path.exists():
-        raise HTTPException(status_code=404, detail="File not found")
-    
-    media_type = "application/pdf" if filename.endswith(".pdf") else \
-                 "application/json" if filename.endswith(".json") else \
-                 "video/mp4"
+@app.get("/events/{task_id}")
+async def task_events_sse(task_id: str):
+    """Server-Sent Events: прогресс по стадиям и артефакты по мере готовности"""
+    async def event_source():
+        async for event, data in task_event_stream(task_id):
+            if event == "keepalive":
+                yield ": keepalive\n\n"
+                continue
+            yield f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
     
-    return FileResponse(file_path, media_type=media_type, filename=filename)
+    return StreamingResponse(event_source(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+@app.websocket("/ws/tasks/{task_id}")
+async def task_events_ws(websocket: WebSocket, task_id: str):
+    await websocket.accept()
+    try:
+        async for event, data in task_event_stream(task_id):
+            await websocket.send_json({"event": event, "data": data})
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+
+@app.delete("/tasks/{task_id}")
+async def cancel_task(task_id: str):
+    if not await job_queue.cancel(task_id):
+        raise HTTPException(status_code=409, detail="Task is not queued or running")
+    return {"task_id": task_id, "status": "cancelled"}
+
+@app.get("/queue/stats")
+async def queue_stats():
+    return job_queue.snapshot()
+
+@app.api_route("/download/{filename}", methods=["GET", "HEAD"])
+async def download_file(filename: str, request: Request):
+    return artifact_response(resolve_artifact(filename), request)
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Метрики в текстовом формате Prometheus"""
+    queue = job_queue.snapshot()
+    llm = llm_scheduler.snapshot()
+    cache = result_cache.snapshot()
+    extra = [
+        ("job_queue_depth", "gauge", "Jobs waiting in the processing queue", {}, queue["queued"]),
+        ("jobs_running", "gauge", "Jobs being processed", {}, queue["running"]),
+        ("llm_in_flight", "gauge", "LLM calls in progress", {}, llm["in_flight"]),
+        ("llm_calls_total", "counter", "LLM call attempts", {}, llm["calls"]),
+        ("llm_errors_total", "counter", "LLM calls failed after retries", {}, llm["errors"]),
+        ("cache_bytes", "gauge", "Result cache size on disk", {}, cache["total_bytes"]),
+        ("cache_entries", "gauge", "Result cache entries", {}, cache["entries"]),
+    ]
+    for kind, counts in cache["stages"].items():
+        for outcome, value in counts.items():
+            extra.append(("cache_lookups_total", "counter", "Result cache lookups", {"kind": kind, "outcome": outcome}, value))
+    return Response(metrics.render(extra), media_type="text/plain; version=0.0.4")
+
+@app.get("/debug/profile")
+async def profile_endpoint(seconds: float = 10.0):
+    """Сэмплирующий профиль процесса API в формате collapsed stacks (PROFILER_ENABLED=1)"""
+    if not PROFILER_ENABLED:
+        raise HTTPException(status_code=404, detail="Profiler is disabled")
+    return Response(await asyncio.to_thread(sample_stacks, seconds), media_type="text/plain")
+
+@app.get("/llm/stats")
+async def llm_stats():
+    return llm_scheduler.snapshot()
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return result_cache.snapshot()
+
+@app.get("/tts/stats")
+async def voiceover_stats():
+    return tts_stats.snapshot()
 
 @app.get("/search")
-async def search_content(query: str, limit: int = 5):
-    embedding = generate_embedding(query)
-    results = qdrant.search(
+async def search_content(
+    query: str,
+    limit: int = 5,
+    offset: int = 0,
+    task_id: Optional[str] = None,
+    topic: Optional[str] = None
+):
+    started = time.perf_counter()
+    limit = max(1, min(limit, SEARCH_MAX_LIMIT))
+    offset = max(0, offset)
+    
+    embedding = await embed_query(query)
+    results = await asyncio.to_thread(
+        get_qdrant().search,
         collection_name=COLLECTION_NAME,
         query_vector=embedding,
-        limit=limit
+        query_filter=build_search_filter(task_id, topic),
+        search_params=qdrant_search_params(),
+        limit=limit,
+        offset=offset
     )
+    search_latency.record(time.perf_counter() - started)
     
     return {
         "query": query,
+        "limit": limit,
+        "offset": offset,
+        "next_offset": offset + limit if len(results) == limit else None,
         "results": [
             {
                 "score": r.score,
                 "topic": r.payload["topic"],
-                "description": r.payload["description"]
+                "description": r.payload["description"],
+                "task_id": r.payload.get("task_id"),
+                "timestamp": r.payload.get("timestamp")
             }
             for r in results
         ]
     }
 
+@app.get("/search/stats")
+async def search_stats():
+    return {
+        "latency": search_latency.snapshot(),
+        "query_embedding_cache": query_embedding_cache.snapshot()
+    }
+
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    if sys.argv[1:2] == ["shard-worker"]:
+        run_shard_worker()
+    else:
+        import uvicorn
+        uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,68 @@
+"""Холодный старт: новый интерпретатор, импорт backend_main и первые запросы к / и /status.
+
+    python benchmarks/cold_start.py --runs 20
+    TASK_STORE=sqlite python benchmarks/cold_start.py
+
+Каждый прогон — отдельный процесс, как холодный старт serverless (Mangum, lifespan="off"):
+запросы идут через ASGI без lifespan-хука и прогрева. process_ms — от запуска процесса до
+ответа /status, измеряется снаружи; остальные столбцы — внутри процесса."""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import common
+
+
+def child():
+    started = time.perf_counter()
+    bm = common.load_backend()
+    imported = time.perf_counter()
+    from fastapi.testclient import TestClient
+    client = TestClient(bm.app)  # без with: lifespan не запускается
+    client_ready = time.perf_counter()
+    assert client.get("/").status_code == 200
+    root_done = time.perf_counter()
+    task_id = "cold-start-probe"
+    bm.task_store.set(task_id, {"status": "processing", "progress": 10, "current_step": "Анализ"})
+    stored = time.perf_counter()
+    assert client.get(f"/status/{task_id}").status_code == 200
+    status_done = time.perf_counter()
+    print(json.dumps({
+        "import_ms": (imported - started) * 1000,
+        "root_ms": (root_done - client_ready) * 1000,
+        "status_ms": (status_done - stored) * 1000,
+        "heavy_modules": sum(name in sys.modules for name in ("cv2", "numpy", "PIL", "reportlab",
+                                                              "google.generativeai", "qdrant_client")),
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child()
+        return
+
+    rows = []
+    for run in range(1, args.runs + 1):
+        started = time.perf_counter()
+        result = subprocess.run([sys.executable, os.path.abspath(__file__), "--child"],
+                                capture_output=True, text=True, check=True)
+        wall = time.perf_counter() - started
+        rows.append({"run": run, "process_ms": wall * 1000, **json.loads(result.stdout.strip().splitlines()[-1])})
+    common.print_table(rows)
+    print()
+    summary = []
+    for column in ("process_ms", "import_ms", "root_ms", "status_ms"):
+        values = sorted(row[column] for row in rows)
+        summary.append({"metric": column, "min": values[0], "p50": values[len(values) // 2], "max": values[-1]})
+    common.print_table(summary)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""Общая подготовка бенчмарков: импорт backend_main во временном cwd и вывод таблиц"""
+import os
+import sys
+import tempfile
+from pathlib import Path
+from typing import Dict, List
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def cpu_cores() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def load_backend(**env):
+    """backend_main читает конфигурацию и создаёт uploads/, outputs/, cache/ при импорте:
+    env задаёт значения по умолчанию (переменные окружения важнее), cwd — временный каталог"""
+    os.environ.setdefault("TASK_STORE", "memory")
+    os.environ.setdefault("WARMUP_ON_STARTUP", "0")
+    for key, value in env.items():
+        os.environ.setdefault(key, str(value))
+    os.chdir(tempfile.mkdtemp(prefix="lucygenx-bench-"))
+    sys.path.insert(0, str(ROOT))
+    import backend_main
+    return backend_main
+
+
+def print_table(rows: List[Dict]):
+    if not rows:
+        return
+    columns = list(rows[0])
+    cells = [[format_cell(row.get(column)) for column in columns] for row in rows]
+    widths = [max(len(column), *(len(line[i]) for line in cells)) for i, column in enumerate(columns)]
+    print("  ".join(column.rjust(width) for column, width in zip(columns, widths)))
+    for line in cells:
+        print("  ".join(cell.rjust(width) for cell, width in zip(line, widths)))
+
+
+def format_cell(value) -> str:
+    if isinstance(value, float):
+        return f"{value:.3f}"
+    return "-" if value is None else str(value)
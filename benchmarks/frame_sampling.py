@@ -0,0 +1,94 @@
+"""Скорость сэмплирования фреймов: seek на каждый сэмпл (старый цикл) против одного прохода
+grab()/retrieve() и режима только ключевых кадров.
+
+    python benchmarks/frame_sampling.py --minutes 10 60 180
+    python benchmarks/frame_sampling.py --video lecture.mp4
+
+Фикстуры — синтетическое H.264 (testsrc2, GOP --gop) заданной длительности; генерируются
+ffmpeg один раз и переиспользуются из --fixtures. frames/s — выданные сэмплы в секунду,
+x_realtime — секунды видео на секунду работы."""
+import argparse
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+import common
+
+
+def make_fixture(fixtures: Path, minutes: float, size: str, fps: int, gop: int) -> Path:
+    path = fixtures / f"testsrc_{minutes:g}min_{size}_{fps}fps_g{gop}.mp4"
+    if not path.exists():
+        print(f"generating {path.name}...", flush=True)
+        tmp_path = path.with_suffix(".tmp.mp4")
+        subprocess.run([
+            "ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "error",
+            "-f", "lavfi", "-i", f"testsrc2=size={size}:rate={fps}",
+            "-t", str(minutes * 60), "-c:v", "libx264", "-preset", "ultrafast",
+            "-g", str(gop), "-pix_fmt", "yuv420p", str(tmp_path), "-y"
+        ], check=True)
+        tmp_path.rename(path)
+    return path
+
+
+def sample_frames_seek(cv2, video_path: Path, interval: float):
+    """Цикл до user-001: cap.set(CAP_PROP_POS_FRAMES) перед каждым сэмплом"""
+    cap = cv2.VideoCapture(str(video_path))
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    duration = int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) / fps
+    try:
+        for i in range(0, int(duration), int(interval)):
+            cap.set(cv2.CAP_PROP_POS_FRAMES, int(i * fps))
+            ret, frame = cap.read()
+            if ret:
+                yield i, frame
+    finally:
+        cap.release()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--minutes", type=float, nargs="+", default=[10, 60, 180])
+    parser.add_argument("--video", type=Path, nargs="*", default=[], help="свои видео вместо фикстур")
+    parser.add_argument("--modes", nargs="+", default=["seek", "sequential", "keyframes"])
+    parser.add_argument("--interval", type=float, default=5.0)
+    parser.add_argument("--size", default="640x360")
+    parser.add_argument("--fps", type=int, default=25)
+    parser.add_argument("--gop", type=int, default=250)
+    parser.add_argument("--fixtures", type=Path, default=Path(tempfile.gettempdir()) / "lucygenx-bench-fixtures")
+    args = parser.parse_args()
+
+    args.fixtures.mkdir(parents=True, exist_ok=True)
+    videos = [path.resolve() for path in args.video] or [
+        make_fixture(args.fixtures.resolve(), minutes, args.size, args.fps, args.gop) for minutes in args.minutes
+    ]
+    bm = common.load_backend()
+    samplers = {
+        "seek": lambda path: sample_frames_seek(bm.cv2, path, args.interval),
+        "sequential": lambda path: bm.sample_frames_sequential(path, args.interval),
+        "keyframes": lambda path: bm.sample_frames_keyframes(path, args.interval),
+    }
+
+    rows = []
+    for video in videos:
+        duration = bm.probe_video(video)["duration"]
+        for mode in args.modes:
+            started = time.perf_counter()
+            frames = sum(1 for _ in samplers[mode](video))
+            wall = time.perf_counter() - started
+            rows.append({
+                "video": video.name,
+                "minutes": duration / 60,
+                "mode": mode,
+                "frames": frames,
+                "wall_s": wall,
+                "frames/s": frames / wall,
+                "x_realtime": duration / wall,
+            })
+            common.print_table(rows[-1:])
+    print()
+    common.print_table(rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Пропускная способность индексации ключевых моментов (points/s) при 10, 1k и 100k точек:
+пакетные эмбеддинги + bulk upsert против прежних 2N запросов (по точке).
+
+    python benchmarks/indexing.py --points 10 1000 100000
+    QDRANT_URL=http://localhost:6333 LLM_FAKE=0 GEMINI_API_KEY=... python benchmarks/indexing.py
+
+По умолчанию эмбеддинги — заглушка (LLM_FAKE=1) с задержкой --embed-latency на запрос
+(сетевой round trip до API), Qdrant — встроенный во временном каталоге.
+Коллекция QDRANT_COLLECTION (по умолчанию bench_indexing) удаляется после замера.
+Последовательный путь долгий, он меряется только до --per-point-max точек."""
+import argparse
+import asyncio
+import time
+import uuid
+
+import common
+
+
+def make_moments(count: int, run: str) -> list:
+    # Уникальные тексты: кэш эмбеддингов не должен срабатывать между прогонами
+    return [
+        {"timestamp": 5 * i, "analysis": {"description": f"{run} момент {i}: разбор примера", "topic": f"Тема {i % 50}"}}
+        for i in range(count)
+    ]
+
+
+async def index_per_point(bm, task_id: str, moments: list) -> int:
+    """Путь до user-011: embed_content и upsert на каждую точку"""
+    client = bm.get_qdrant()
+    for i, moment in enumerate(moments):
+        result = await asyncio.to_thread(
+            bm.embed_content, model=bm.EMBED_MODEL, content=moment["analysis"]["description"],
+            task_type="retrieval_document"
+        )
+        await asyncio.to_thread(
+            client.upsert, collection_name=bm.COLLECTION_NAME, wait=True,
+            points=[bm.qmodels.PointStruct(
+                id=bm.point_id(f"{task_id}_{i}"), vector=result["embedding"],
+                payload={"task_id": task_id, **moment["analysis"]}
+            )]
+        )
+    return len(moments)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--points", type=int, nargs="+", default=[10, 1000, 100000])
+    parser.add_argument("--per-point-max", type=int, default=1000)
+    parser.add_argument("--embed-latency", type=float, default=0.05, help="секунд на запрос заглушки")
+    args = parser.parse_args()
+
+    bm = common.load_backend(LLM_FAKE=1, QDRANT_COLLECTION="bench_indexing")
+    client = bm.get_qdrant()
+    calls = {"embed": 0, "upsert": 0}
+    embed_content, upsert = bm.embed_content, client.upsert
+
+    def counted_embed(**kwargs):
+        calls["embed"] += 1
+        if bm.LLM_FAKE:
+            time.sleep(args.embed_latency)
+        return embed_content(**kwargs)
+
+    def counted_upsert(*a, **kwargs):
+        calls["upsert"] += 1
+        return upsert(*a, **kwargs)
+
+    bm.embed_content, client.upsert = counted_embed, counted_upsert
+    modes = {
+        "batched": lambda task_id, moments: bm.index_key_moments(task_id, moments, task_id),
+        "per_point": lambda task_id, moments: index_per_point(bm, task_id, moments),
+    }
+    rows = []
+    try:
+        for count in args.points:
+            for mode, index in modes.items():
+                if mode == "per_point" and count > args.per_point_max:
+                    continue
+                run = uuid.uuid4().hex[:8]
+                moments = make_moments(count, run)
+                calls.update(embed=0, upsert=0)
+                started = time.perf_counter()
+                asyncio.run(index(run, moments))
+                wall = time.perf_counter() - started
+                rows.append({
+                    "points": count, "mode": mode, "wall_s": wall, "points/s": count / wall,
+                    "embed_requests": calls["embed"], "upserts": calls["upsert"],
+                })
+                common.print_table(rows[-1:])
+    finally:
+        client.delete_collection(bm.COLLECTION_NAME)
+    print()
+    common.print_table(rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Оценка подготовки кадров для Gemini: байты, латентность и совпадение ключевых моментов
+с полноразмерным базовым вариантом на наборе фикстур.
+
+    GEMINI_API_KEY=... python benchmarks/payload_eval.py lectures/*.mp4 \\
+        --profiles 1024:jpeg:85 768:jpeg:75 768:webp:80 1024:jpeg:85:auto
+
+Профиль — max_side:format:quality[:crop] (как ANALYSIS_MAX_SIDE/FORMAT/QUALITY/CROP); базовый
+вариант — кадр как есть, JPEG с качеством OpenCV по умолчанию (95), без кропа.
+Каждый кадр анализируется отдельным запросом analyze_frame без кэша через общий планировщик
+(LLM_CONCURRENCY, LLM_RATE_LIMIT); латентность — самих вызовов модели, без ожидания лимита.
+agreement — доля кадров с тем же решением «ключевой момент» (is_key_moment и importance >= 6),
+что у базового варианта, key_recall/key_precision — по его ключевым моментам,
+topic_match — совпадение темы.
+С LLM_FAKE=1 ответы одинаковы, осмысленны только байты и время подготовки."""
+import argparse
+import asyncio
+import time
+from pathlib import Path
+
+import common
+
+BASELINE = {"max_side": 0, "format": "jpeg", "quality": 95, "crop": ""}
+
+
+def parse_profile(value: str) -> dict:
+    max_side, image_format, quality, *crop = value.split(":", 3)
+    return {"max_side": int(max_side), "format": image_format, "quality": int(quality), "crop": crop[0] if crop else ""}
+
+
+def is_key(analysis) -> bool:
+    return bool(analysis and analysis.get("is_key_moment") and analysis.get("importance", 0) >= 6)
+
+
+def normalize_topic(analysis) -> str:
+    return " ".join((analysis or {}).get("topic", "").lower().split())
+
+
+async def analyze_all(bm, model, payloads: list, timestamps: list) -> tuple:
+    """Ответы по кадрам и латентность самих вызовов модели (без ожидания rate limit планировщика)"""
+    latency = bm.llm_scheduler.latency["analyze_frame"] = bm.LatencyStats()
+    results = await asyncio.gather(*[
+        bm.analyze_frame(model, timestamp, data, None, mime_type)
+        for timestamp, (data, mime_type) in zip(timestamps, payloads)
+    ])
+    return results, latency.snapshot()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("videos", type=Path, nargs="+")
+    parser.add_argument("--profiles", nargs="+", default=["1024:jpeg:85", "768:jpeg:75", "768:webp:80", "512:jpeg:70"])
+    parser.add_argument("--interval", type=float, default=30.0, help="секунд между сэмплами")
+    parser.add_argument("--max-frames", type=int, default=40, help="кадров с одного видео")
+    args = parser.parse_args()
+
+    videos = [path.resolve() for path in args.videos]
+    bm = common.load_backend()
+    if bm.LLM_FAKE:
+        print("LLM_FAKE=1: совпадение с базовым вариантом тривиально, смотрите bytes и prep_ms")
+    policy = bm.get_sampling_policy(mode="sequential", interval=args.interval, max_frames=args.max_frames)
+    frames, timestamps = [], []
+    for video in videos:
+        for timestamp, frame in bm.sample_video_frames(video, policy):
+            frames.append(frame)
+            timestamps.append(timestamp)
+    print(f"{len(frames)} frames from {len(videos)} videos")
+
+    # Все профили в одном event loop: планировщик LLM привязан к нему
+    rows = asyncio.run(evaluate(bm, frames, timestamps, args))
+    print()
+    common.print_table(rows)
+
+
+async def evaluate(bm, frames: list, timestamps: list, args) -> list:
+    model = bm.get_generative_model()
+    rows, baseline = [], None
+    for name, settings in [("baseline", BASELINE)] + [(p, parse_profile(p)) for p in args.profiles]:
+        started = time.perf_counter()
+        payloads = bm.prepare_payloads(frames, bm.get_payload_settings(**settings))
+        prep = time.perf_counter() - started
+        results, latency = await analyze_all(bm, model, payloads, timestamps)
+        baseline = baseline or results
+        pairs = [(a, b) for a, b in zip(baseline, results) if a is not None and b is not None]
+        base_keys = sum(is_key(a) for a, _ in pairs)
+        found_keys = sum(is_key(b) for _, b in pairs)
+        both_keys = sum(is_key(a) and is_key(b) for a, b in pairs)
+        rows.append({
+            "profile": name,
+            "kb_total": sum(len(data) for data, _ in payloads) / 1024,
+            "kb/frame": sum(len(data) for data, _ in payloads) / 1024 / max(len(payloads), 1),
+            "prep_ms/frame": prep * 1000 / max(len(frames), 1),
+            "p50_ms": latency["p50_ms"],
+            "p90_ms": latency["p90_ms"],
+            "failed": sum(result is None for result in results),
+            "agreement": sum(is_key(a) == is_key(b) for a, b in pairs) / len(pairs) if pairs else None,
+            "key_recall": both_keys / base_keys if base_keys else None,
+            "key_precision": both_keys / found_keys if found_keys else None,
+            "topic_match": sum(normalize_topic(a) == normalize_topic(b) for a, b in pairs) / len(pairs) if pairs else None,
+        })
+        common.print_table(rows[-1:])
+    return rows
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""Масштабирование шардированной обработки длинного видео на 1..--max-workers процессах:
+анализ (декодирование шардов в пуле) и сборка видео сегментами с concat без перекодирования.
+
+    python benchmarks/shard_scaling.py --minutes 180 --max-workers 8
+    python benchmarks/shard_scaling.py --video lecture.mp4 --shard-seconds 600
+
+LLM — заглушка без задержки (LLM_FAKE=1), чтобы мерить CPU-часть; кэш результатов свой на каждый
+прогон. Строка workers=baseline — без шардирования и одним ffmpeg. moments должно совпадать
+во всех строках: шардирование не меняет результат анализа."""
+import argparse
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+
+import common
+from frame_sampling import make_fixture
+
+
+def restart_pool(bm, workers: int):
+    if bm._cpu_pool is not None:
+        bm._cpu_pool.shutdown(wait=True)
+        bm._cpu_pool = None
+    bm.WORKER_PROCESSES = workers
+    for stage in ("decode", "encode"):
+        bm.STAGE_LIMITS[stage] = workers
+        bm.stage_semaphores[stage] = asyncio.Semaphore(workers)
+
+
+async def analyze(bm, video: Path, shard_seconds: float, run: str) -> tuple:
+    bm.SHARD_SECONDS, bm.SHARD_MIN_DURATION = shard_seconds, 0
+    bm.result_cache = bm.ContentCache(Path(tempfile.mkdtemp(prefix="cache_")), 10 ** 10)
+    started = time.perf_counter()
+    analysis = await bm.analyze_video_content(video, bm.FRAME_SPILL_DIR / f"{run}_frames")
+    return time.perf_counter() - started, analysis
+
+
+async def encode(bm, slides: list, ranges: list, run: str) -> float:
+    started = time.perf_counter()
+    await bm.create_video_from_segments(slides, [], bm.OUTPUT_DIR / f"{run}.mp4", ranges)
+    return time.perf_counter() - started
+
+
+def render_slides(bm, count: int) -> list:
+    slides_dir = Path("slides_bench")
+    slides_dir.mkdir()
+    return [
+        bm.create_educational_slide(bm.placeholder_frame(), {"topic": f"Тема {i}", "description": "Слайд"},
+                                    i, slides_dir / f"slide_{i}.jpg")
+        for i in range(1, count + 1)
+    ]
+
+
+def split(count: int, parts: int) -> list:
+    bounds = [round(count * k / parts) for k in range(parts + 1)]
+    return [(a, b) for a, b in zip(bounds, bounds[1:]) if b > a]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--video", type=Path)
+    parser.add_argument("--minutes", type=float, default=60)
+    parser.add_argument("--max-workers", type=int, default=common.cpu_cores())
+    parser.add_argument("--shard-seconds", type=float, default=0, help="0 — длительность / (2 * max-workers)")
+    parser.add_argument("--slides", type=int, default=120, help="слайдов в сборке видео")
+    parser.add_argument("--fixtures", type=Path, default=Path(tempfile.gettempdir()) / "lucygenx-bench-fixtures")
+    args = parser.parse_args()
+
+    if args.video:
+        video = args.video.resolve()
+    else:
+        args.fixtures.mkdir(parents=True, exist_ok=True)
+        video = make_fixture(args.fixtures.resolve(), args.minutes, "640x360", 25, 250)
+    bm = common.load_backend(LLM_FAKE=1, LLM_FAKE_LATENCY=0, LLM_FAKE_ERROR_RATE=0)
+    duration = bm.probe_video(video)["duration"]
+    shard_seconds = args.shard_seconds or max(duration / (2 * args.max_workers), 1.0)
+    slides = render_slides(bm, args.slides)
+
+    rows = []
+    for workers in ["baseline"] + list(range(1, args.max_workers + 1)):
+        restart_pool(bm, 1 if workers == "baseline" else workers)
+        run = f"bench_{workers}"
+        analyze_s, analysis = asyncio.run(analyze(bm, video, 0 if workers == "baseline" else shard_seconds, run))
+        ranges = split(len(slides), 1 if workers == "baseline" else 2 * workers)
+        encode_s = asyncio.run(encode(bm, slides, ranges, run))
+        rows.append({
+            "workers": workers,
+            "shards": analysis["shards"],
+            "moments": len(analysis["key_moments"]),
+            "analyze_s": analyze_s,
+            "analyze_speedup": rows[0]["analyze_s"] / analyze_s if rows else 1.0,
+            "segments": len(ranges),
+            "encode_s": encode_s,
+            "encode_speedup": rows[0]["encode_s"] / encode_s if rows else 1.0,
+        })
+        common.print_table(rows[-1:])
+    bm._cpu_pool.shutdown(wait=True)
+    print(f"\ncores: {common.cpu_cores()}, video: {duration / 60:.1f} min, shard: {shard_seconds:.0f}s")
+    common.print_table(rows)
+
+
+if __name__ == "__main__":
+    main()
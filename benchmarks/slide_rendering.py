@@ -0,0 +1,90 @@
+"""Рендер слайдов: slides/s последовательно и в пуле процессов на 1..--max-workers ядрах.
+
+    python benchmarks/slide_rendering.py --slides 200 --max-workers 8
+
+Вход — синтетические кадры 1280x720 (шум с градиентом, чтобы JPEG не вырождался).
+identical — совпадают ли байты всех слайдов пула с последовательным рендером."""
+import argparse
+import asyncio
+import time
+from pathlib import Path
+
+import common
+
+
+def make_frames(np, count: int):
+    rng = np.random.default_rng(0)
+    gradient = np.linspace(0, 255, 1280, dtype=np.float32)[None, :, None]
+    return [
+        np.clip(gradient * (i % 7 + 1) / 7 + rng.normal(0, 24, (720, 1280, 3)), 0, 255).astype(np.uint8)
+        for i in range(count)
+    ]
+
+
+def analysis(i: int) -> dict:
+    return {
+        "topic": f"Тема {i % 12}: производительность конвейера",
+        "description": "Ключевой момент лекции: разбор узкого места и способа его устранения " * 2,
+    }
+
+
+def render_serial(bm, frames, out_dir: Path) -> list:
+    out_dir.mkdir()
+    return [
+        bm.create_educational_slide(frame, analysis(i), i, out_dir / f"slide_{i}.jpg")
+        for i, frame in enumerate(frames, 1)
+    ]
+
+
+async def render_pool(bm, frames, out_dir: Path, workers: int) -> list:
+    out_dir.mkdir()
+    bm.stage_semaphores["render"] = asyncio.Semaphore(workers)
+    return await bm.render_slides_parallel([
+        (frame, analysis(i), i, out_dir / f"slide_{i}.jpg") for i, frame in enumerate(frames, 1)
+    ])
+
+
+def restart_pool(bm, frames, workers: int):
+    if bm._cpu_pool is not None:
+        bm._cpu_pool.shutdown(wait=True)
+        bm._cpu_pool = None
+    bm.WORKER_PROCESSES = workers
+    # Старт процессов и загрузка шрифтов в воркерах — вне замера
+    asyncio.run(render_pool(bm, frames[:workers * 2], Path(f"warmup_{workers}"), workers))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--slides", type=int, default=100)
+    parser.add_argument("--max-workers", type=int, default=common.cpu_cores())
+    args = parser.parse_args()
+
+    bm = common.load_backend()
+    frames = make_frames(bm.np, args.slides)
+    bm.load_slide_fonts()
+
+    started = time.perf_counter()
+    serial = render_serial(bm, frames, Path("serial"))
+    wall = time.perf_counter() - started
+    rows = [{"workers": "serial", "wall_s": wall, "slides/s": args.slides / wall, "speedup": 1.0, "identical": True}]
+    serial_wall = wall
+
+    for workers in range(1, args.max_workers + 1):
+        restart_pool(bm, frames, workers)
+        started = time.perf_counter()
+        rendered = asyncio.run(render_pool(bm, frames, Path(f"pool_{workers}"), workers))
+        wall = time.perf_counter() - started
+        rows.append({
+            "workers": workers,
+            "wall_s": wall,
+            "slides/s": args.slides / wall,
+            "speedup": serial_wall / wall,
+            "identical": all(Path(a).read_bytes() == Path(b).read_bytes() for a, b in zip(serial, rendered)),
+        })
+    bm._cpu_pool.shutdown(wait=True)
+    print(f"cores: {common.cpu_cores()}")
+    common.print_table(rows)
+
+
+if __name__ == "__main__":
+    main()
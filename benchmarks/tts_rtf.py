@@ -0,0 +1,59 @@
+"""Realtime factor TTS на ядро: N скриптов озвучиваются при параллельности 1..--max-concurrency.
+
+    TTS_ENGINE=piper PIPER_MODEL=ru_RU-irina-medium.onnx python benchmarks/tts_rtf.py --slides 20
+
+engine_rtf — секунды работы движка на секунду аудио (по задачам, как /tts/stats);
+core_rtf — ядро-секунды на секунду речи: wall * min(параллельность, ядра) / audio.
+Кэш озвучки не участвует: synthesize_speech вызывается напрямую."""
+import argparse
+import asyncio
+import time
+from pathlib import Path
+
+import common
+
+SCRIPT = ("Сегодня разберём, как устроен конвейер обработки видео: "
+          "от извлечения ключевых кадров до озвучки и сборки слайдов.")
+
+
+async def measure(bm, slides: int, concurrency: int, workdir: Path) -> dict:
+    bm.stage_semaphores["tts"] = asyncio.Semaphore(concurrency)
+    stats = bm.tts_stats = bm.TTSStats()
+    started = time.perf_counter()
+    await asyncio.gather(*[
+        bm.synthesize_speech(f"{SCRIPT} Слайд {i}.", workdir / f"c{concurrency}_{i}.mp3")
+        for i in range(1, slides + 1)
+    ])
+    wall = time.perf_counter() - started
+    audio = stats.audio_seconds
+    return {
+        "engine": bm.get_tts_engine().name,
+        "concurrency": concurrency,
+        "wall_s": wall,
+        "audio_s": audio,
+        "engine_rtf": stats.synth_seconds / audio if audio else None,
+        "core_rtf": wall * min(concurrency, common.cpu_cores()) / audio if audio else None,
+        "x_realtime": audio / wall,
+        "fallbacks": stats.fallbacks,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--slides", type=int, default=20)
+    parser.add_argument("--max-concurrency", type=int, default=common.cpu_cores())
+    args = parser.parse_args()
+
+    bm = common.load_backend()
+    workdir = Path("tts")
+    workdir.mkdir()
+    rows = [
+        asyncio.run(measure(bm, args.slides, concurrency, workdir))
+        for concurrency in range(1, args.max_concurrency + 1)
+    ]
+    print(f"cores: {common.cpu_cores()}")
+    common.print_table(rows)
+
+
+if __name__ == "__main__":
+    main()
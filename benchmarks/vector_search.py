@@ -0,0 +1,104 @@
+"""Recall@k против латентности поиска Qdrant по квантованию и hnsw_ef — для выбора настроек
+под корпус в миллионы фреймов.
+
+    docker run -p 6333:6333 -p 6334:6334 qdrant/qdrant
+    QDRANT_URL=http://localhost:6333 python benchmarks/vector_search.py --corpus 1000000 --ef 32 64 128 256
+
+Корпус — синтетические нормированные 768-d векторы с кластерами (как эмбеддинги похожих кадров),
+точный top-k считается перебором в numpy. Для каждого режима квантования создаётся своя
+коллекция bench_search_<режим> с HNSW из QDRANT_HNSW_M/QDRANT_HNSW_EF_CONSTRUCT, после замера
+удаляется. Встроенный режим (без QDRANT_URL) ищет перебором и параметры игнорирует."""
+import argparse
+import time
+
+import common
+
+
+def make_corpus(np, size: int, clusters: int, dim: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, clusters, size)] + 0.35 * rng.normal(size=(size, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def exact_top_k(np, corpus, queries, k: int, chunk: int = 100000):
+    best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+    best_ids = np.zeros((len(queries), 0), dtype=np.int64)
+    for start in range(0, len(corpus), chunk):
+        scores = queries @ corpus[start:start + chunk].T
+        ids = np.broadcast_to(np.arange(start, start + scores.shape[1]), scores.shape)
+        scores = np.concatenate([best_scores, scores], axis=1)
+        ids = np.concatenate([best_ids, ids], axis=1)
+        top = np.argsort(-scores, axis=1)[:, :k]
+        best_scores = np.take_along_axis(scores, top, axis=1)
+        best_ids = np.take_along_axis(ids, top, axis=1)
+    return [set(row) for row in best_ids.tolist()]
+
+
+def wait_indexed(client, collection: str, timeout: float = 3600):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        info = client.get_collection(collection)
+        if str(getattr(info.status, "value", info.status)) == "green":
+            return
+        time.sleep(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--corpus", type=int, default=100000)
+    parser.add_argument("--clusters", type=int, default=1000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--ef", type=int, nargs="+", default=[16, 32, 64, 128, 256])
+    parser.add_argument("--quantization", nargs="+", default=["none", "scalar", "product"])
+    args = parser.parse_args()
+
+    bm = common.load_backend()
+    np = bm.np
+    if not bm.QDRANT_URL:
+        print("QDRANT_URL не задан: встроенный режим ищет перебором, hnsw_ef и квантование не влияют")
+    vectors = make_corpus(np, args.corpus + args.queries, args.clusters, bm.VECTOR_SIZE)
+    corpus, queries = vectors[:args.corpus], vectors[args.corpus:]
+    truth = exact_top_k(np, corpus, queries, args.k)
+    client = bm.create_qdrant_client()
+
+    rows = []
+    for quantization in args.quantization:
+        bm.QDRANT_QUANTIZATION = quantization
+        bm.COLLECTION_NAME = f"bench_search_{quantization}"
+        try:
+            client.delete_collection(bm.COLLECTION_NAME)
+            bm.ensure_collection(client)
+            started = time.perf_counter()
+            client.upload_collection(bm.COLLECTION_NAME, vectors=corpus, ids=range(len(corpus)), batch_size=1024)
+            wait_indexed(client, bm.COLLECTION_NAME)
+            print(f"{quantization}: indexed {len(corpus)} vectors in {time.perf_counter() - started:.1f}s", flush=True)
+            for ef in args.ef:
+                bm.QDRANT_SEARCH_EF = ef
+                params = bm.qdrant_search_params()
+                latencies, hits = [], 0
+                for query, expected in zip(queries, truth):
+                    started = time.perf_counter()
+                    found = client.search(bm.COLLECTION_NAME, query_vector=query.tolist(),
+                                          search_params=params, limit=args.k)
+                    latencies.append(time.perf_counter() - started)
+                    hits += len(expected & {point.id for point in found})
+                latencies = np.array(latencies) * 1000
+                rows.append({
+                    "quantization": quantization,
+                    "hnsw_ef": ef,
+                    f"recall@{args.k}": hits / (args.k * len(queries)),
+                    "p50_ms": float(np.percentile(latencies, 50)),
+                    "p95_ms": float(np.percentile(latencies, 95)),
+                    "qps": len(queries) / (latencies.sum() / 1000),
+                })
+                common.print_table(rows[-1:])
+        finally:
+            client.delete_collection(bm.COLLECTION_NAME)
+    print()
+    common.print_table(rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,18 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# backend_main читает конфигурацию при импорте: заглушка LLM, хранилище в памяти, без прогрева
+os.environ.setdefault("LLM_FAKE", "1")
+os.environ.setdefault("LLM_FAKE_LATENCY", "0")
+os.environ.setdefault("LLM_FAKE_ERROR_RATE", "0")
+os.environ.setdefault("TASK_STORE", "memory")
+os.environ.setdefault("TTS_ENGINE", "silent")
+os.environ.setdefault("WARMUP_ON_STARTUP", "0")
+sys.path.insert(0, str(ROOT))
+
+# uploads/, outputs/, cache/ создаются относительно cwd — не в рабочем дереве
+os.chdir(tempfile.mkdtemp(prefix="lucygenx-tests-"))
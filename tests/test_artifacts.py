@@ -0,0 +1,83 @@
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+import backend_main as bm
+
+
+@pytest.mark.parametrize("header, expected", [
+    (None, None),
+    ("bytes=0-99", (0, 99)),
+    ("bytes=100-", (100, 999)),
+    ("bytes=-100", (900, 999)),
+    ("bytes=-5000", (0, 999)),
+    ("bytes=500-5000", (500, 999)),
+    ("bytes=0-1,5-6", None),
+    ("items=0-1", None),
+    ("bytes=abc", None),
+])
+def test_parse_range(header, expected):
+    assert bm.parse_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=1000-", "bytes=5-2", "bytes=-0"])
+def test_parse_range_unsatisfiable(header):
+    with pytest.raises(ValueError):
+        bm.parse_range(header, 1000)
+
+
+@pytest.fixture
+def artifact():
+    bm.OUTPUT_DIR.mkdir(exist_ok=True)
+    path = bm.OUTPUT_DIR / "a0b1c2d3-0000-4000-8000-000000000000_video.mp4"
+    path.write_bytes(bytes(range(256)) * 4)
+    yield path
+    path.unlink(missing_ok=True)
+
+
+def test_resolve_artifact(artifact):
+    assert bm.resolve_artifact(artifact.name) == artifact.resolve()
+
+
+@pytest.mark.parametrize("name", ["../backend_main.py", "..", ".hidden", "/etc/passwd", "sub%2Ffile", "missing.mp4"])
+def test_resolve_artifact_rejects(name):
+    with pytest.raises(HTTPException) as error:
+        bm.resolve_artifact(name)
+    assert error.value.status_code == 404
+
+
+def test_artifact_range_and_validators(artifact):
+    client = TestClient(bm.app)
+    url = f"/download/{artifact.name}"
+    full = client.get(url)
+    assert full.status_code == 200 and full.content == artifact.read_bytes()
+    assert full.headers["cache-control"] == "no-cache"
+
+    partial = client.get(url, headers={"Range": "bytes=10-19"})
+    assert partial.status_code == 206
+    assert partial.content == artifact.read_bytes()[10:20]
+    assert partial.headers["content-range"] == f"bytes 10-19/{artifact.stat().st_size}"
+
+    cached = client.get(url, headers={"If-None-Match": full.headers["etag"]})
+    assert cached.status_code == 304
+
+
+def test_cache_hit_keeps_artifact_validators(artifact, tmp_path):
+    cache = bm.ContentCache(tmp_path / "cache", 10 ** 6)
+    cache.put_file("ab12", artifact)
+    first = tmp_path / "first.mp4"
+    assert cache.get_file("ab12", first)
+    mtime = first.stat().st_mtime_ns
+    assert cache.get_file("ab12", tmp_path / "second.mp4")
+    assert first.stat().st_mtime_ns == mtime
+
+
+def test_only_content_hash_names_are_immutable():
+    bm.OUTPUT_DIR.mkdir(exist_ok=True)
+    path = bm.OUTPUT_DIR / f"{bm.hashlib.sha256(b'slide').hexdigest()}.jpg"
+    path.write_bytes(b"slide")
+    try:
+        response = TestClient(bm.app).get(f"/download/{path.name}")
+        assert response.headers["cache-control"] == "public, max-age=31536000, immutable"
+    finally:
+        path.unlink()
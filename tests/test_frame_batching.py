@@ -0,0 +1,89 @@
+import asyncio
+import json
+
+import backend_main as bm
+
+
+class PartialBatchModel(bm.FakeGenerativeModel):
+    """Пакетный ответ без указанных фреймов, обрезанный посередине или вовсе не JSON"""
+
+    def __init__(self, drop_frames=(), truncate=False, garbage=False):
+        super().__init__(latency=0, error_rate=0, malformed_rate=0)
+        self.drop_frames = set(drop_frames)
+        self.truncate = truncate
+        self.garbage = garbage
+        self.calls = []
+
+    def generate_content(self, contents, **kwargs):
+        response = super().generate_content(contents, **kwargs)
+        images = sum(isinstance(part, dict) for part in contents)
+        self.calls.append(images)
+        if images > 1:
+            items = [item for item in json.loads(response.text) if item["frame"] not in self.drop_frames]
+            response.text = json.dumps(items, ensure_ascii=False)
+            if self.truncate:
+                response.text = response.text[:len(response.text) // 2]
+            if self.garbage:
+                response.text = "Не могу разобрать изображения"
+        return response
+
+
+def make_scenes(count):
+    return [
+        {"timestamp": 10 * i, "image": b"jpeg", "mime_type": "image/jpeg", "fingerprint": None}
+        for i in range(count)
+    ]
+
+
+def analyze(model, count):
+    before = dict(bm.frame_analysis_stats)
+    results = asyncio.run(bm.analyze_frames_batch(model, make_scenes(count)))
+    delta = {key: value - before.get(key, 0) for key, value in bm.frame_analysis_stats.items()}
+    return results, delta
+
+
+def test_batch_uses_one_request():
+    model = PartialBatchModel()
+    results, delta = analyze(model, 4)
+    assert model.calls == [4]
+    assert all(result and result["is_key_moment"] for result in results)
+    assert delta.get("batch_requests") == 1 and delta.get("batch_frames") == 4
+    assert not delta.get("single_requests")
+
+
+def test_missing_items_fall_back_to_single_requests():
+    model = PartialBatchModel(drop_frames={2, 4})
+    results, delta = analyze(model, 4)
+    assert sorted(model.calls) == [1, 1, 4]
+    assert all(results)
+    assert delta.get("fallback_frames") == 2 and delta.get("single_requests") == 2
+
+
+def test_truncated_batch_keeps_complete_items():
+    model = PartialBatchModel(truncate=True)
+    results, delta = analyze(model, 3)
+    assert all(results)
+    assert not delta.get("parse_failures")
+    assert 0 < delta.get("fallback_frames") < 3
+    assert len(model.calls) == 1 + delta["fallback_frames"]
+
+
+def test_unparseable_batch_falls_back_for_every_frame():
+    model = PartialBatchModel(garbage=True)
+    results, delta = analyze(model, 3)
+    assert all(results)
+    assert delta.get("parse_failures") == 1 and delta.get("fallback_frames") == 3
+
+
+def test_single_frame_skips_batch_prompt():
+    model = PartialBatchModel()
+    results, delta = analyze(model, 1)
+    assert model.calls == [1] and results[0] is not None
+    assert not delta.get("batch_requests")
+
+
+def test_fake_model_reports_usage():
+    model = bm.FakeGenerativeModel(latency=0, error_rate=0)
+    response = model.generate_content(["prompt", {"mime_type": "image/jpeg", "data": b""}])
+    assert response.usage_metadata.prompt_token_count >= bm.FAKE_IMAGE_TOKENS
+    assert response.usage_metadata.candidates_token_count > 0
@@ -0,0 +1,26 @@
+import cv2
+import numpy as np
+
+import backend_main as bm
+
+
+def write_video(path, frames=20, fps=10):
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"mp4v"), fps, (64, 48))
+    for i in range(frames):
+        writer.write(np.full((48, 64, 3), i * 10, np.uint8))
+    writer.release()
+
+
+def test_read_frame_near_end_resamples_earlier(tmp_path):
+    video = tmp_path / "clip.mp4"
+    write_video(video)
+    # Таймстемп за последним кадром: seek не даёт кадра, берётся более ранний
+    assert bm.read_frame_at(video, 2.5).shape == (48, 64, 3)
+    assert bm.read_frame_at(video, 100.0) is None
+    assert bm.read_frame_at(tmp_path / "missing.mp4", 1.0) is None
+
+
+def test_placeholder_frame_renders_slide(tmp_path):
+    output = tmp_path / "slide.jpg"
+    bm.create_educational_slide(bm.placeholder_frame(), {"topic": "T", "description": "D"}, 1, output)
+    assert output.stat().st_size > 0
@@ -0,0 +1,33 @@
+"""Бюджет холодного старта: импорт backend_main без тяжёлых модулей и клиентов"""
+import os
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+IMPORT_TIME_BUDGET_MS = float(os.getenv("IMPORT_TIME_BUDGET_MS", "2000"))
+HEAVY_MODULES = ("cv2", "numpy", "PIL", "reportlab", "google.generativeai", "qdrant_client")
+
+
+def import_backend(tmp_path):
+    # Отдельный интерпретатор: в текущем backend_main мог быть уже импортирован тестами
+    env = dict(os.environ, PYTHONPATH=str(ROOT), LLM_FAKE="1", TASK_STORE="memory")
+    return subprocess.run(
+        [sys.executable, "-X", "importtime", "-c",
+         "import sys, backend_main; print(','.join(sorted(sys.modules)))"],
+        cwd=tmp_path, env=env, capture_output=True, text=True, check=True,
+    )
+
+
+def test_import_skips_heavy_modules(tmp_path):
+    loaded = set(import_backend(tmp_path).stdout.strip().split(","))
+    assert [name for name in HEAVY_MODULES if name in loaded] == []
+
+
+def test_import_time_budget(tmp_path):
+    stderr = import_backend(tmp_path).stderr
+    match = re.search(r"^import time:\s+\d+ \|\s+(\d+) \| backend_main$", stderr, re.M)
+    assert match, stderr[-2000:]
+    cumulative_ms = int(match.group(1)) / 1000
+    assert cumulative_ms < IMPORT_TIME_BUDGET_MS
@@ -0,0 +1,27 @@
+import asyncio
+
+import backend_main as bm
+
+
+def test_repeat_upload_reuses_embeddings_and_point_ids(monkeypatch):
+    embed_calls = []
+    stored = []
+    fake_embed = bm.embed_content
+    monkeypatch.setattr(bm, "embed_content", lambda **kwargs: embed_calls.append(kwargs) or fake_embed(**kwargs))
+
+    async def store(points):
+        stored.append(points)
+
+    monkeypatch.setattr(bm, "store_points_in_qdrant", store)
+    moments = [
+        {"timestamp": 10 * i, "analysis": {"description": f"момент {i}", "topic": "t"}}
+        for i in range(3)
+    ]
+    asyncio.run(bm.index_key_moments("task-a", moments, "video-hash"))
+    asyncio.run(bm.index_key_moments("task-b", moments, "video-hash"))
+    first, second = stored
+    assert len(embed_calls) == 1
+    assert [p.id for p in first] == [p.id for p in second]
+    assert len({p.id for p in first}) == 3
+    assert [p.vector for p in first] == [p.vector for p in second]
+    assert second[0].payload["task_id"] == "task-b"
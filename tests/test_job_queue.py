@@ -0,0 +1,73 @@
+import asyncio
+
+import backend_main as bm
+
+
+def test_submitted_jobs_always_start(tmp_path, monkeypatch):
+    # Воркер перечитывает состояние перед стартом — оно должно быть записано до постановки в очередь
+    monkeypatch.setattr(bm, "task_store", bm.SQLiteTaskStore(str(tmp_path / "tasks.db")))
+
+    async def scenario():
+        queue = bm.JobQueue(concurrency=2, maxsize=50)
+        done = []
+
+        async def job(task_id):
+            done.append(task_id)
+
+        task_ids = [f"queued-{i}" for i in range(20)]
+        for task_id in task_ids:
+            await queue.submit(task_id, job, task_id)
+        for _ in range(200):
+            if len(done) == len(task_ids):
+                break
+            await asyncio.sleep(0.01)
+        return task_ids, done
+
+    task_ids, done = asyncio.run(scenario())
+    assert sorted(done) == sorted(task_ids)
+
+
+def test_job_cancelled_in_store_is_skipped():
+    async def scenario():
+        queue = bm.JobQueue(concurrency=1, maxsize=10)
+        started = []
+        release = asyncio.Event()
+
+        async def job(task_id):
+            started.append(task_id)
+            await release.wait()
+
+        await queue.submit("blocker", job, "blocker")
+        await queue.submit("victim", job, "victim")
+        await asyncio.sleep(0.05)
+        # Отмену записал другой воркер: локально задача просто лежит в очереди
+        bm.task_store.update("victim", bm.cancelled_state())
+        release.set()
+        await asyncio.sleep(0.1)
+        return started
+
+    assert asyncio.run(scenario()) == ["blocker"]
+    assert bm.task_store.get("victim")["status"] == "cancelled"
+
+
+def test_enqueue_releases_ownership_when_cancelled():
+    async def scenario():
+        queue = bm.JobQueue(concurrency=1, maxsize=1)
+        release = asyncio.Event()
+
+        async def job(task_id):
+            await release.wait()
+
+        await queue.submit("running", job, "running")
+        await asyncio.sleep(0.05)
+        await queue.submit("waiting", job, "waiting")
+        # Очередь полна: enqueue ждёт места и отменяется
+        pending = asyncio.create_task(queue.enqueue("blocked", job, "blocked"))
+        await asyncio.sleep(0.05)
+        pending.cancel()
+        await asyncio.gather(pending, return_exceptions=True)
+        owned = dict(queue.owned)
+        release.set()
+        return owned
+
+    assert asyncio.run(scenario()) == {"running": 1, "waiting": 1}
@@ -0,0 +1,31 @@
+import backend_main as bm
+
+
+def test_plan_shards_cuts_on_keyframes():
+    keyframes = [0.0, 250.0, 590.0, 610.0, 1190.0, 1500.0, 1800.0]
+    shards = bm.plan_shards(keyframes, 2000.0, 600.0)
+    assert shards == [(0.0, 610.0), (610.0, 1500.0), (1500.0, 2000.0)]
+
+
+def test_plan_shards_covers_whole_video():
+    keyframes = [float(t) for t in range(0, 3600, 7)]
+    shards = bm.plan_shards(keyframes, 3600.0, 300.0)
+    assert shards[0][0] == 0.0 and shards[-1][1] == 3600.0
+    assert all(a[1] == b[0] for a, b in zip(shards, shards[1:]))
+    assert all(start in keyframes for start, _ in shards)
+    assert all(end - start >= 300.0 for start, end in shards[:-1])
+
+
+def test_plan_shards_no_short_tail():
+    # Ключевой кадр у самого конца не даёт шард короче половины длины
+    shards = bm.plan_shards([0.0, 600.0, 1150.0], 1200.0, 600.0)
+    assert shards == [(0.0, 600.0), (600.0, 1200.0)]
+
+
+def test_plan_shards_without_keyframes():
+    assert bm.plan_shards([], 900.0, 300.0) == [(0.0, 900.0)]
+
+
+def test_shard_slide_ranges_group_by_shard():
+    moments = [{"shard": 0}, {"shard": 0}, {"shard": 1}, {"shard": 2}, {"shard": 2}]
+    assert bm.shard_slide_ranges(moments) == [(0, 2), (2, 3), (3, 5)]
@@ -0,0 +1,77 @@
+import asyncio
+import time
+
+import pytest
+
+import backend_main as bm
+
+
+def stage(result, delay=0.0, log=None, name=None):
+    async def run(*deps):
+        if log is not None:
+            log.append(("start", name, deps))
+        await asyncio.sleep(delay)
+        if log is not None:
+            log.append(("end", name))
+        return result
+    return run
+
+
+def test_results_flow_to_dependents():
+    graph = bm.StageGraph("graph-results")
+    log = []
+    graph.add("analysis", stage("A", log=log, name="analysis"))
+    graph.add("slides", stage("S", log=log, name="slides"), deps=("analysis",))
+    graph.add("video", stage("V", log=log, name="video"), deps=("analysis", "slides"))
+    results = asyncio.run(graph.run())
+    assert results == {"analysis": "A", "slides": "S", "video": "V"}
+    assert ("start", "video", ("A", "S")) in log
+    assert log.index(("end", "slides")) < log.index(("start", "video", ("A", "S")))
+
+
+def test_independent_stages_run_concurrently():
+    graph = bm.StageGraph("graph-parallel")
+    graph.add("analysis", stage("A"))
+    for name in ("pdf", "quiz", "flashcards", "mindmap"):
+        graph.add(name, stage(name, delay=0.2), deps=("analysis",))
+    started = time.perf_counter()
+    asyncio.run(graph.run())
+    assert time.perf_counter() - started < 0.6
+    assert set(graph.timings) == {"analysis", "pdf", "quiz", "flashcards", "mindmap"}
+
+
+def test_progress_reported_per_stage():
+    graph = bm.StageGraph("graph-progress")
+    graph.add("analysis", stage("A"))
+    graph.add("pdf", stage("P"), deps=("analysis",))
+    asyncio.run(graph.run())
+    state = bm.task_store.get("graph-progress")
+    assert state["progress"] == 95
+    assert set(state["stage_timings"]) == {"analysis", "pdf"}
+
+
+def test_unknown_dependency_rejected():
+    graph = bm.StageGraph("graph-unknown")
+    with pytest.raises(ValueError):
+        graph.add("video", stage("V"), deps=("slides",))
+
+
+def test_failure_cancels_running_stages():
+    graph = bm.StageGraph("graph-failure")
+    cancelled = []
+
+    async def slow():
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def broken():
+        raise RuntimeError("stage failed")
+
+    graph.add("slow", slow)
+    graph.add("broken", broken)
+    with pytest.raises(RuntimeError):
+        asyncio.run(graph.run())
+    assert cancelled == [True]
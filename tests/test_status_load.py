@@ -0,0 +1,71 @@
+"""/status не должен тормозить, пока в фоне идут загрузки по URL"""
+import asyncio
+import os
+import statistics
+import time
+
+import httpx
+
+import backend_main as bm
+
+DOWNLOADS = 20
+FAKE_YT_DLP = """#!/bin/sh
+for percent in 10 30 50 70 90; do echo "[download] $percent.0% of 10.00MiB"; sleep 0.3; done
+exit 1
+"""
+
+
+def install_fake_downloaders(bin_dir):
+    bin_dir.mkdir()
+    for name, script in (("yt-dlp", FAKE_YT_DLP), ("wget", "#!/bin/sh\nexit 1\n")):
+        path = bin_dir / name
+        path.write_text(script)
+        path.chmod(0o755)
+
+
+async def sample_status(client, task_id, count):
+    latencies = []
+    for _ in range(count):
+        started = time.perf_counter()
+        response = await client.get(f"/status/{task_id}")
+        latencies.append(time.perf_counter() - started)
+        assert response.status_code == 200
+        await asyncio.sleep(0.01)
+    return latencies
+
+
+async def run_scenario():
+    transport = httpx.ASGITransport(app=bm.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        bm.task_store.set("probe", {"status": "processing", "progress": 50})
+        idle = await sample_status(client, "probe", 20)
+
+        task_ids = [f"download-{i}" for i in range(DOWNLOADS)]
+        for task_id in task_ids:
+            bm.task_store.set(task_id, {"status": "downloading", "progress": 0, "download_progress": 0.0})
+            bm.job_queue.run_detached(task_id, bm.ingest_url_and_process(
+                task_id, "http://example.invalid/video.mp4", bm.UPLOAD_DIR / f"{task_id}.mp4"
+            ))
+        await asyncio.sleep(0.5)
+        during = [bm.task_store.get(t) for t in task_ids]
+        busy = await sample_status(client, "probe", 30)
+
+        deadline = time.monotonic() + 30
+        while any(bm.task_store.get(t)["status"] not in bm.FINISHED_STATUSES for t in task_ids):
+            assert time.monotonic() < deadline, "downloads did not finish"
+            await asyncio.sleep(0.1)
+        return idle, busy, during, [bm.task_store.get(t) for t in task_ids]
+
+
+def test_status_latency_flat_during_downloads(tmp_path, monkeypatch):
+    install_fake_downloaders(tmp_path / "bin")
+    monkeypatch.setenv("PATH", f"{tmp_path / 'bin'}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setattr(bm, "download_semaphore", asyncio.Semaphore(DOWNLOADS))
+
+    idle, busy, during, finished = asyncio.run(run_scenario())
+
+    # Все загрузки шли одновременно с опросом и дошли до конца (фейковый загрузчик падает)
+    assert all(state["status"] == "downloading" and state["download_progress"] > 0 for state in during)
+    assert all(state["status"] == "failed" for state in finished)
+    assert statistics.median(busy) < max(5 * statistics.median(idle), 0.05)
+    assert max(busy) < 0.5
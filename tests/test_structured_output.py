@@ -0,0 +1,57 @@
+import pytest
+
+import backend_main as bm
+
+
+@pytest.mark.parametrize("text, expected", [
+    ('{"a": 1}', {"a": 1}),
+    ('```json\n{"a": [1, 2]}\n```', {"a": [1, 2]}),
+    ('Вот ответ: [1, 2] и всё', [1, 2]),
+    ('{"a": [1, 2,],}', {"a": [1, 2]}),
+    ('{"a": "x, ]", "b": [1,]}', {"a": "x, ]", "b": [1]}),
+    ('{"a": "keep ,} this"}', {"a": "keep ,} this"}),
+    ('{"q": "say \\"hi,}\\"", "n": [1, 2], "m": [3', {"q": 'say "hi,}"', "n": [1, 2]}),
+    ('[{"a": 1}, {"b": 2', [{"a": 1}]),
+])
+def test_extract_json(text, expected):
+    assert bm.extract_json(text) == expected
+
+
+def test_extract_json_without_json():
+    with pytest.raises(ValueError):
+        bm.extract_json("модель ответила текстом")
+
+
+def test_parse_structured_rejects_invalid_schema():
+    with pytest.raises(ValueError):
+        bm.parse_structured('{"question": "?"}', bm.QuizQuestion)
+
+
+def test_parse_structured_items_keeps_valid_items():
+    text = """{"cards": [
+        {"front": "A", "back": "a"},
+        {"front": "B"},
+        {"front": "C", "back": "c"},
+    ]}"""
+    items = bm.parse_structured_items(text, bm.Flashcard, "cards")
+    assert [item.front if item else None for item in items] == ["A", None, "C"]
+
+
+def test_parse_structured_items_top_level_list():
+    items = bm.parse_structured_items('[{"front": "A", "back": "a"}]', bm.Flashcard, "cards")
+    assert len(items) == 1 and items[0].back == "a"
+
+
+def test_parse_structured_items_requires_list():
+    with pytest.raises(ValueError):
+        bm.parse_structured_items('{"cards": "none"}', bm.Flashcard, "cards")
+
+
+def test_parse_batch_analysis_places_items_by_frame_number():
+    text = """[
+        {"frame": 2, "is_key_moment": true, "description": "b", "importance": 5, "topic": "t"},
+        {"frame": 1, "is_key_moment": false, "description": "a", "importance": 2, "topic": "t"},
+        {"frame": 3, "description": "без обязательных полей"}
+    ]"""
+    results = bm.parse_batch_analysis(text, 3)
+    assert [r["description"] if r else None for r in results] == ["a", "b", None]
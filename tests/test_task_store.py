@@ -0,0 +1,103 @@
+import os
+import socket
+
+import pytest
+
+import backend_main as bm
+
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return bm.MemoryTaskStore()
+    if request.param == "sqlite":
+        return bm.SQLiteTaskStore(str(tmp_path / "tasks.db"))
+    fakeredis = pytest.importorskip("fakeredis")
+    return bm.RedisTaskStore(client=fakeredis.FakeRedis())
+
+
+def test_set_get_update(store):
+    assert store.get("t1") is None
+    store.set("t1", {"status": "processing", "progress": 5, "current_step": "Анализ"})
+    store.update("t1", {"progress": 40})
+    assert store.get("t1") == {"status": "processing", "progress": 40, "current_step": "Анализ"}
+    store.set("t1", {"status": "processing"})
+    assert store.get("t1") == {"status": "processing"}
+
+
+def test_delete(store):
+    store.set("t1", {"status": "processing"})
+    store.delete("t1")
+    assert store.get("t1") is None
+
+
+def test_active_tasks_skip_finished(store):
+    store.set("running", {"status": "processing"})
+    store.set("done", {"status": "completed"})
+    active = store.active_tasks()
+    assert [(task_id, status) for task_id, status, _, _ in active] == [("running", "processing")]
+    assert active[0][2] == bm.WORKER_ID
+
+
+def test_finished_tasks_expire(store, monkeypatch):
+    monkeypatch.setattr(bm, "TASK_TTL", -1)
+    store.set("t1", {"status": "processing"})
+    store.update("t1", {"status": "completed"})
+    store.purge_expired()
+    assert store.get("t1") is None
+
+
+def test_unfinished_tasks_do_not_expire(store, monkeypatch):
+    monkeypatch.setattr(bm, "TASK_TTL", -1)
+    store.set("t1", {"status": "processing"})
+    assert store.purge_expired() == 0
+    assert store.get("t1") == {"status": "processing"}
+
+
+def test_recover_orphans_of_dead_local_worker(store, monkeypatch):
+    monkeypatch.setattr(bm, "WORKER_ID", f"{socket.gethostname()}:999999999")
+    store.set("orphan", {"status": "processing"})
+    monkeypatch.undo()
+    store.set("own", {"status": "processing"})
+    assert store.recover_orphans() == 1
+    assert store.get("orphan")["status"] == "failed"
+    assert store.get("own")["status"] == "processing"
+
+
+def test_recover_orphans_of_previous_run_with_same_pid(store, monkeypatch):
+    # Перезапущенный контейнер: тот же хост и PID, другой нонс запуска
+    monkeypatch.setattr(bm, "WORKER_ID", f"{socket.gethostname()}:{os.getpid()}:previous")
+    store.set("orphan", {"status": "processing"})
+    monkeypatch.undo()
+    assert store.recover_orphans() == 1
+    assert store.get("orphan")["status"] == "failed"
+
+
+def test_recover_orphans_of_silent_local_worker_with_reused_pid(store, monkeypatch):
+    # PID умершего воркера занят чужим живым процессом — спасает только таймаут heartbeat
+    monkeypatch.setattr(bm, "WORKER_ID", f"{socket.gethostname()}:{os.getppid()}:other")
+    store.set("stale", {"status": "processing"})
+    monkeypatch.undo()
+    assert store.recover_orphans() == 0
+    monkeypatch.setattr(bm, "TASK_ORPHAN_TIMEOUT", -1)
+    assert store.recover_orphans() == 1
+    assert store.get("stale")["status"] == "failed"
+
+
+def test_recover_orphans_of_silent_remote_worker(store, monkeypatch):
+    own_worker_id = bm.WORKER_ID
+    monkeypatch.setattr(bm, "WORKER_ID", "other-host:1")
+    store.set("stale", {"status": "processing"})
+    store.set("adopted", {"status": "queued"})
+    monkeypatch.setattr(bm, "WORKER_ID", own_worker_id)
+    store.touch(["adopted"])  # heartbeat живого владельца
+    monkeypatch.setattr(bm, "TASK_ORPHAN_TIMEOUT", -1)
+    assert store.recover_orphans() == 1
+    assert store.get("stale")["status"] == "failed"
+    assert store.get("adopted")["status"] == "queued"
+
+
+def test_touch_ignores_missing_tasks(store):
+    store.touch(["missing"])
+    assert store.get("missing") is None
+    assert store.active_tasks() == []
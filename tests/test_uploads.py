@@ -0,0 +1,104 @@
+import os
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+import backend_main as bm
+
+
+@pytest.fixture
+def client():
+    return TestClient(bm.app)
+
+
+def create_upload(client, length):
+    response = client.post("/uploads", headers={"Upload-Length": str(length)})
+    assert response.status_code == 201
+    return response.headers["location"].rsplit("/", 1)[1]
+
+
+def patch(client, upload_id, offset, body):
+    return client.patch(f"/uploads/{upload_id}", content=body, headers={"Upload-Offset": str(offset)})
+
+
+def multipart_body(size, boundary="upload-boundary"):
+    yield (f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"v.mp4\"\r\n"
+           "Content-Type: video/mp4\r\n\r\n").encode()
+    for _ in range(size // 1024):
+        yield b"x" * 1024
+    yield f"\r\n--{boundary}--\r\n".encode()
+
+
+@pytest.mark.parametrize("chunked", [False, True])
+def test_multipart_upload_rejected_before_spooling(client, monkeypatch, chunked):
+    monkeypatch.setattr(bm, "MAX_UPLOAD_BYTES", 1024)
+    spooled = []
+    monkeypatch.setattr(bm, "stream_to_file", lambda *args, **kwargs: spooled.append(args))
+    size = bm.UPLOAD_FORM_OVERHEAD + 2048
+    body = multipart_body(size) if chunked else b"".join(multipart_body(size))
+    response = client.post("/upload", content=body, headers={
+        "Content-Type": "multipart/form-data; boundary=upload-boundary"
+    })
+    assert response.status_code == 413
+    assert spooled == []
+
+
+def test_multipart_upload_rejected_when_queue_full(client, monkeypatch):
+    spooled = []
+    monkeypatch.setattr(bm, "stream_to_file", lambda *args, **kwargs: spooled.append(args))
+    monkeypatch.setattr(bm.job_queue, "is_full", lambda: True)
+    response = client.post("/upload", content=b"".join(multipart_body(4096)), headers={
+        "Content-Type": "multipart/form-data; boundary=upload-boundary"
+    })
+    assert response.status_code == 429
+    assert spooled == []
+
+
+def test_resumable_upload_in_parts(client, monkeypatch):
+    enqueued = []
+
+    async def enqueue(task_id, fn, *args, **kwargs):
+        enqueued.append((task_id, args[-1]))
+
+    monkeypatch.setattr(bm.job_queue, "enqueue", enqueue)
+    data = os.urandom(3000)
+    upload_id = create_upload(client, len(data))
+    assert patch(client, upload_id, 0, data[:1000]).headers["upload-offset"] == "1000"
+    # Кэш sha256 другого воркера устарел — пересчитывается по файлу, а не дописывается
+    bm.upload_hashers[upload_id] = (500, bm.hashlib.sha256(b"stale"))
+    assert patch(client, upload_id, 1000, data[1000:]).status_code == 204
+    assert enqueued == [(upload_id, bm.hashlib.sha256(data).hexdigest())]
+    assert not bm.upload_lock_path(upload_id).exists()
+
+
+def test_patch_while_locked_conflicts(client):
+    upload_id = create_upload(client, 100)
+    fd = bm.try_lock_upload(upload_id)
+    try:
+        assert patch(client, upload_id, 0, b"x" * 10).status_code == 409
+    finally:
+        bm.unlock_upload(fd)
+    assert patch(client, upload_id, 0, b"x" * 10).status_code == 204
+
+
+def test_patch_after_part_removed_conflicts(client):
+    upload_id = create_upload(client, 100)
+    bm.upload_part_path(upload_id).unlink()
+    assert patch(client, upload_id, 0, b"x" * 10).status_code == 409
+
+
+def test_purge_stale_uploads(client, monkeypatch):
+    stale_id = create_upload(client, 100)
+    fresh_id = create_upload(client, 100)
+    assert patch(client, stale_id, 0, b"x" * 10).status_code == 204
+    old = time.time() - 2 * bm.UPLOAD_EXPIRY
+    for path in (bm.upload_meta_path(stale_id), bm.upload_part_path(stale_id)):
+        os.utime(path, (old, old))
+
+    assert bm.purge_stale_uploads() >= 1
+    assert not bm.upload_part_path(stale_id).exists()
+    assert not bm.upload_meta_path(stale_id).exists()
+    assert stale_id not in bm.upload_hashers
+    assert bm.upload_part_path(fresh_id).exists()
+    assert client.head(f"/uploads/{stale_id}").status_code == 404
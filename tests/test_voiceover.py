@@ -0,0 +1,27 @@
+import asyncio
+
+import backend_main as bm
+
+
+def test_fallback_audio_not_cached_under_engine_key(tmp_path, monkeypatch):
+    engine = bm.TTS_ENGINES["espeak"]
+    monkeypatch.setattr(bm, "get_tts_engine", lambda: engine)
+    calls = []
+
+    async def synthesize(script, output_path, used_engine):
+        calls.append(used_engine.name)
+        output_path.write_bytes(b"mp3")
+        return 1.0, used_engine
+
+    # Движок упал — озвучила тишина: под ключом espeak ничего не кэшируется
+    monkeypatch.setattr(bm, "synthesize_speech", lambda s, p: synthesize(s, p, bm.TTS_ENGINES["silent"]))
+    asyncio.run(bm.generate_voiceover_for_slide("текст", 1, tmp_path / "a.mp3"))
+    monkeypatch.setattr(bm, "synthesize_speech", lambda s, p: synthesize(s, p, engine))
+    asyncio.run(bm.generate_voiceover_for_slide("текст", 1, tmp_path / "b.mp3"))
+    assert calls == ["silent", "espeak"]
+
+    # Настоящий результат закэширован и отдаётся без синтеза
+    monkeypatch.setattr(bm, "probe_media_duration", lambda path: asyncio.sleep(0, 1.0))
+    asyncio.run(bm.generate_voiceover_for_slide("текст", 1, tmp_path / "c.mp3"))
+    assert calls == ["silent", "espeak"]
+    assert (tmp_path / "c.mp3").read_bytes() == b"mp3"